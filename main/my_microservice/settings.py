@@ -9,9 +9,10 @@ https://docs.djangoproject.com/en/3.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
+import os
+import sys
 from datetime import timedelta
 from pathlib import Path
-import py_eureka_client.eureka_client as eureka_client
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -50,6 +51,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "utils.metrics.MetricsMiddleware",
+    "utils.db_router.ReplicaRoutingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -80,17 +83,22 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "my_microservice.wsgi.application"
 
+# Threads answering the async/ product endpoints under ASGI, see `property.domain.async_views`.
+ASYNC_VIEWS = {
+    "THREADS": 32,
+}
+
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
 DATABASES = {
     'default': {
         'ENGINE': 'mysql.connector.django',
-        'NAME': 'mydatabase',
-        'USER': 'mydatabaseuser',
-        'PASSWORD': 'mypassword',
-        'HOST': 'db',
-        'PORT': '3306',
+        'NAME': os.environ.get('MYSQL_DATABASE', 'mydatabase'),
+        'USER': os.environ.get('MYSQL_USER', 'mydatabaseuser'),
+        'PASSWORD': os.environ.get('MYSQL_PASSWORD', 'mypassword'),
+        'HOST': os.environ.get('MYSQL_HOST', 'db'),
+        'PORT': os.environ.get('MYSQL_PORT', '3306'),
     },
     'TEST': {
         'NAME': 'test',
@@ -105,6 +113,41 @@ DATABASES = {
     }
 }
 
+# A local SQLite file instead of MySQL, e.g. to run `manage.py run_benchmarks` offline.
+if os.environ.get('SQLITE_PATH'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['SQLITE_PATH'],
+    }
+
+# Read replicas of `default`, served by `utils.db_router` to the product search, list, detail and
+# stats reads: MYSQL_REPLICA_HOSTS=replica1,replica2 (same credentials as the primary), or
+# SQLITE_REPLICA_PATHS with SQLITE_PATH to try it locally with copies of the SQLite file.
+# Replicas lagging more than MAX_LAG seconds are skipped, their state is checked every
+# CHECK_INTERVAL seconds, and a user who wrote reads from the primary for PIN_SECONDS.
+DATABASE_REPLICAS = {
+    "ALIASES": [],
+    "MAX_LAG": 5,
+    "CHECK_INTERVAL": 5,
+    "PIN_SECONDS": 5,
+}
+if os.environ.get('SQLITE_PATH'):
+    replicas = [{'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+                for path in os.environ.get('SQLITE_REPLICA_PATHS', '').split(',') if path]
+else:
+    replicas = [{**DATABASES['default'], 'HOST': host, 'OPTIONS': {'connection_timeout': 2}}
+                for host in os.environ.get('MYSQL_REPLICA_HOSTS', '').split(',') if host]
+for number, replica in enumerate(replicas, 1):
+    DATABASES[f'replica{number}'] = {**replica, 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS["ALIASES"].append(f'replica{number}')
+
+# The routing tests read from a database of their own, not a TEST MIRROR of `default`, so it can
+# hold other rows than the primary and show which database served each read.
+if sys.argv[1:2] == ['test']:
+    DATABASES['replica_test'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+
+DATABASE_ROUTERS = ["utils.db_router.ReplicaRouter"]
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -152,14 +195,68 @@ SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
-        "LOCATION": "redis://127.0.0.1:6379/1",
+        "LOCATION": f"redis://{REDIS_HOST}:{REDIS_PORT}/1",
         "OPTIONS": {
-            "CLIENT_CLASS": "django_redis.client.DefaultClient"
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            "SOCKET_CONNECT_TIMEOUT": 2,
+            "SOCKET_TIMEOUT": 2,
         },
         "KEY_PREFIX": "my_microservice"
     }
 }
 
+# Response cache of the product endpoints, entries are evicted through tags
+# bumped by Product writes and expire after TIMEOUT seconds at the latest.
+PRODUCT_CACHE = {
+    "ALIAS": "default",
+    "TIMEOUT": 300,
+    "ENABLED": True,
+}
+
+# Product search backend, swap for "property.domain.services.search_service.DatabaseSearchBackend"
+# to fall back to plain `icontains` queries. The in-process index learns the writes of the other
+# processes through the cache `cache_alias`.
+PRODUCT_SEARCH = {
+    "BACKEND": "property.domain.services.search_service.InvertedIndexSearchBackend",
+    "OPTIONS": {
+        "max_results": 1000,
+        "ngram_size": 3,
+        "cache_alias": "default",
+    },
+}
+
+# Facets of `search/?facets=true`: lower bounds of the price and rating histogram buckets and
+# the number of categories and brands returned.
+PRODUCT_FACETS = {
+    "PRICE_BUCKETS": (0, 50, 100, 250, 500),
+    "RATING_BUCKETS": (0, 1, 2, 3, 4),
+    "SIZE": 20,
+}
+
+# Cart storage. "property.domain.services.cart_store.RedisCartStore" keeps active carts in
+# Redis (db 2 by default) and writes them to the database from a django_q task.
+CART_STORE = {
+    "BACKEND": "property.domain.services.cart_store.DatabaseCartStore",
+    "OPTIONS": {},
+}
+
+# Domain events are written to the `OutboxEvent` table with the change they describe and
+# published by `manage.py relay_outbox`, published events are kept RETENTION_DAYS days.
+OUTBOX = {
+    "BATCH_SIZE": 100,
+    "POLL_INTERVAL": 1.0,
+    "RETENTION_DAYS": 7,
+}
+
+# Request metrics of `utils.metrics`, served on /metrics. A SAMPLE_RATE share of the requests also
+# counts its SQL, cache and serializer time and answers with a Server-Timing header; a statement
+# repeated DUPLICATE_THRESHOLD times in one request is logged as a likely N+1.
+METRICS = {
+    "SAMPLE_RATE": float(os.environ.get("METRICS_SAMPLE_RATE", 0.1)),
+    "SERVER_TIMING": True,
+    "DUPLICATE_THRESHOLD": 5,
+}
+
 # settings.py example
 Q_CLUSTER = {
     "name": "myproject",
@@ -184,7 +281,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'user.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
@@ -217,8 +314,20 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
 }
 
-your_rest_server_port = 8000
-# The flowing code will register your server to eureka server and also start to send heartbeat every 30 seconds
-eureka_client.init(eureka_server="service-registry:8761",
-                   app_name="django_main_service",
-                   instance_port=your_rest_server_port)
+# In process caches of `user.authentication.CachedJWTAuthentication`: up to TOKENS verified access
+# tokens, kept until they expire, and USERS users, reloaded after USER_TTL seconds.
+JWT_AUTH_CACHE = {
+    "TOKENS": 10_000,
+    "USERS": 1_000,
+    "USER_TTL": 60,
+}
+
+# Eureka registration, started in the background by the WSGI/ASGI application (see
+# `utils.discovery`), the client then sends a heartbeat every 30 seconds.
+EUREKA = {
+    "SERVER": "service-registry:8761",
+    "APP_NAME": "django_main_service",
+    "INSTANCE_PORT": 8000,
+    "RETRY_DELAY": 5,
+    "MAX_RETRY_DELAY": 60,
+}
@@ -6,6 +6,7 @@ from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from django.contrib import admin
 from property.domain.views import ProductViewSet, CartViewSet
+from utils.metrics import metrics_view
 
 router = routers.DefaultRouter()
 router.register(r"users", user_views.UserViewSet)
@@ -56,6 +57,8 @@ urlpatterns = [
     ),
     # Admin
     path("admin/", admin.site.urls),
+    # Prometheus
+    path("metrics/", metrics_view, name="metrics"),
     #   todo_app
     path("", include("property.urls")),
 ]
@@ -26,3 +26,31 @@ def write_test_file(text):
 def print_result(task):
     logger.warning("Task.result:")
     logger.warning(task.result)
+
+
+def flush_carts():
+    """
+    Write the carts changed in the Redis cart store to the database. Queued by
+    `RedisCartStore.schedule_flush`, it can also run as a django_q schedule to
+    catch up after an outage.
+    """
+    from property.domain.services.cart_store import get_cart_store
+
+    flushed = get_cart_store().flush()
+    if flushed:
+        logger.info("flushed %s carts", flushed)
+    return flushed
+
+
+def reconcile_product_stats():
+    """
+    Rebuild the product statistics from the products, run as a django_q
+    schedule (`manage.py reconcile_product_stats --schedule`) to fix the
+    drift of writes which bypassed the signals.
+    """
+    from property.domain.services import stats_service
+
+    fixed = stats_service.reconcile()
+    if fixed:
+        logger.warning("reconciled %s product stats groups", fixed)
+    return fixed
@@ -0,0 +1,71 @@
+"""
+Async versions of the read-heavy product endpoints, for the ASGI server
+(`uvicorn my_microservice.asgi:application`).
+
+Under ASGI Django 3.2 runs every sync view on one shared thread, so a
+process serves one request at a time. These views answer from a pool of
+`ASYNC_VIEWS["THREADS"]` threads instead: the event loop keeps accepting
+requests while the pool waits on MySQL and Redis. Django 3.2 has no async
+ORM and redis-py 3.5 no asyncio client, so the queries themselves stay
+blocking calls, made on the pool; the pool size bounds the database
+connections of a process.
+
+The responses are the ones of the sync views, which are run as they are.
+"""
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from utils import metrics
+
+from .views import ProductSearchView, ProductViewSet
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.ASYNC_VIEWS["THREADS"],
+                                           thread_name_prefix="async-view")
+    return _executor
+
+
+def _respond(view, request, *args, **kwargs):
+    # What request_started/request_finished do for the thread serving a sync request.
+    close_old_connections()
+    try:
+        with metrics.sql_counted():
+            response = view(request, *args, **kwargs)
+            if hasattr(response, "render"):
+                response.render()
+        return response
+    finally:
+        close_old_connections()
+
+
+def as_async(view):
+    """
+    Return an async view running the sync `view` on the view thread pool.
+    """
+    async def async_view(request, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # The copied context carries the request metrics to the pool thread.
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(get_executor(),
+                                          partial(context.run, _respond, view, request, *args, **kwargs))
+
+    async_view.csrf_exempt = getattr(view, "csrf_exempt", False)
+    return async_view
+
+
+product_search = as_async(ProductSearchView.as_view())
+product_list = as_async(ProductViewSet.as_view({"get": "list"}))
+product_detail = as_async(ProductViewSet.as_view({"get": "retrieve"}))
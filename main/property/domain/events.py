@@ -1,3 +1,9 @@
 from django import dispatch
 
 some_task_done = dispatch.Signal(providing_args=["task_id"])
+
+# Sent after products were written in bulk (bulk_create/bulk_update/queryset
+# delete), which bypasses the post_save/post_delete signals. `products` are the
+# written instances (their pk may be unset after a bulk_create on MySQL),
+# `deleted_ids` the removed ones and `tags` the response cache tags to evict.
+products_changed = dispatch.Signal(providing_args=["products", "deleted_ids", "tags"])
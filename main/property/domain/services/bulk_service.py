@@ -0,0 +1,163 @@
+"""
+Batch writes of products for the bulk endpoints of `ProductViewSet`.
+
+A batch is validated as a whole, with `many=True`, and is written in one
+transaction with `bulk_create`, `bulk_update` or one `DELETE ... IN`: it is
+applied completely or not at all, and an invalid batch reports the errors
+of each of its items. Instead of one signal and one event per product, a
+batch sends one `products_changed` signal (search index, response cache,
+stats, carts) and records one `products_changed` outbox event.
+"""
+from django.db import connections, router, transaction
+
+from property.domain import events
+from property.domain.services import cache_service, cart_service, outbox_service
+from property.models import CartItem, Product
+from property.serializers import ProductPostSerializer
+
+MAX_ITEMS = 1000
+WRITE_FIELDS = ("name", "description", "price", "category", "brand", "rating")
+
+
+class BatchError(Exception):
+    """
+    The batch is invalid, `errors` lists {"index", "errors"} of the items at fault.
+    """
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def _check_size(items):
+    if not isinstance(items, list) or not items:
+        raise BatchError([{"index": None, "errors": {"non_field_errors": ["Expected a non empty list of items."]}}])
+    if len(items) > MAX_ITEMS:
+        raise BatchError([{"index": None, "errors": {"non_field_errors": [f"At most {MAX_ITEMS} items per batch."]}}])
+
+
+def _validate(items, partial=False):
+    serializer = ProductPostSerializer(data=items, many=True, partial=partial)
+    if not serializer.is_valid():
+        errors = serializer.errors
+        if isinstance(errors, dict):
+            raise BatchError([{"index": None, "errors": errors}])
+        raise BatchError([{"index": index, "errors": item} for index, item in enumerate(errors) if item])
+    return serializer.validated_data
+
+
+def _tags(products):
+    tags = {cache_service.ALL_PRODUCTS_TAG}
+    for product in products:
+        tags.update((f"category:{product.category}", f"brand:{product.brand}"))
+        if product.pk is not None:
+            tags.add(f"product:{product.pk}")
+    return tags
+
+
+def _changed(action, products=(), deleted_ids=(), tags=()):
+    events.products_changed.send(sender=Product, products=list(products), deleted_ids=list(deleted_ids),
+                                 tags=sorted(tags))
+    ids = [product.pk for product in products if product.pk is not None] or list(deleted_ids)
+    outbox_service.enqueue("products_changed", {"action": action, "ids": ids, "count": len(products) or len(ids)},
+                           aggregate_type="product")
+
+
+def _insert(products):
+    """
+    Insert `products` and set their primary key. The backends that cannot
+    return the rows of a bulk insert (MySQL, SQLite) get one INSERT per
+    product instead, still without the post_save signal of each of them.
+    """
+    using = router.db_for_write(Product)
+    if connections[using].features.can_return_rows_from_bulk_insert:
+        Product.objects.using(using).bulk_create(products, batch_size=MAX_ITEMS)
+        return
+    meta = Product._meta
+    fields = [field for field in meta.concrete_fields if field is not meta.auto_field]
+    for product in products:
+        # What `bulk_create` does for one row, which reads back its id.
+        row = Product.objects.using(using)._insert([product], fields=fields, returning_fields=meta.db_returning_fields)
+        for value, field in zip(row[0], meta.db_returning_fields):
+            setattr(product, field.attname, value)
+        product._state.adding = False
+        product._state.db = using
+
+
+def create_products(items):
+    """
+    Insert the products described by `items`.
+    """
+    _check_size(items)
+    products = [Product(**data) for data in _validate(items)]
+    with transaction.atomic():
+        _insert(products)
+        _changed("created", products, tags=_tags(products))
+    return products
+
+
+def update_products(items):
+    """
+    Apply the partial updates of `items`, each with the `id` of its product.
+    """
+    _check_size(items)
+    errors, ids = [], []
+    for index, item in enumerate(items):
+        pk = item.get("id") if isinstance(item, dict) else None
+        if not isinstance(pk, int) or isinstance(pk, bool):
+            errors.append({"index": index, "errors": {"id": ["A valid integer is required."]}})
+        elif pk in ids:
+            errors.append({"index": index, "errors": {"id": ["Duplicate id in the batch."]}})
+        ids.append(pk)
+    if errors:
+        raise BatchError(errors)
+    changes = _validate(items, partial=True)
+
+    with transaction.atomic():
+        products = Product.objects.select_for_update().in_bulk(ids)
+        missing = [{"index": index, "errors": {"id": ["Product not found."]}}
+                   for index, pk in enumerate(ids) if pk not in products]
+        if missing:
+            raise BatchError(missing)
+        # The cache tags and stats groups of the values being replaced.
+        tags = _tags(products.values())
+        fields = set()
+        for pk, data in zip(ids, changes):
+            for name, value in data.items():
+                if name in WRITE_FIELDS:
+                    setattr(products[pk], name, value)
+                    fields.add(name)
+        updated = [products[pk] for pk in ids]
+        if fields:
+            Product.objects.bulk_update(updated, sorted(fields), batch_size=MAX_ITEMS)
+        _changed("updated", updated, tags=tags | _tags(updated))
+    return updated
+
+
+def delete_products(ids):
+    """
+    Delete the products `ids` with their cart items.
+    """
+    _check_size(ids)
+    if not all(isinstance(pk, int) and not isinstance(pk, bool) for pk in ids):
+        raise BatchError([{"index": index, "errors": {"id": ["A valid integer is required."]}}
+                          for index, pk in enumerate(ids) if not isinstance(pk, int) or isinstance(pk, bool)])
+    ids = list(dict.fromkeys(ids))
+
+    with transaction.atomic():
+        products = list(Product.objects.select_for_update().filter(pk__in=ids).only("pk", "category", "brand"))
+        found = {product.pk for product in products}
+        missing = [{"index": index, "errors": {"id": ["Product not found."]}}
+                   for index, pk in enumerate(ids) if pk not in found]
+        if missing:
+            raise BatchError(missing)
+        items = CartItem.objects.filter(product__in=ids)
+        cart_ids = set(items.values_list("cart", flat=True))
+        # QuerySet.delete() would load the products and send post_delete for each of them.
+        items._raw_delete(items.db)
+        deleted = Product.objects.filter(pk__in=ids)
+        deleted._raw_delete(deleted.db)
+        if cart_ids:
+            cart_service.refresh_cart_summaries(cart_ids)
+        _changed("deleted", deleted_ids=ids, tags=_tags(products))
+    return ids
@@ -0,0 +1,194 @@
+import datetime
+import decimal
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.response import Response
+
+from utils import db_router, metrics
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "product-cache"
+ALL_PRODUCTS_TAG = "products"
+
+
+def get_config():
+    return {"ALIAS": "default", "TIMEOUT": 300, "ENABLED": True, **getattr(settings, "PRODUCT_CACHE", {})}
+
+
+def get_cache():
+    return caches[get_config()["ALIAS"]]
+
+
+class CacheStats:
+    """
+    Per process hit/miss/invalidation counters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+
+    def record(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+stats = CacheStats()
+
+
+def _normalize(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value.normalize())
+    return value
+
+
+def make_key(namespace, params):
+    """
+    Build a cache key from the normalized `params` of a request, so equivalent
+    queries (different parameter order, `20` vs `20.00`, ...) share an entry.
+    """
+    normalized = {name: _normalize(value) for name, value in params.items() if value not in (None, "")}
+    digest = hashlib.sha1(json.dumps(normalized, sort_keys=True, default=str).encode()).hexdigest()
+    return f"{KEY_PREFIX}:{namespace}:{digest}"
+
+
+def tag_key(tag):
+    return f"{KEY_PREFIX}:tag:{tag}"
+
+
+def tags_for_filters(category=None, brand=None):
+    """
+    The tags a cached list depends on: only the filtered category/brand when the
+    list is restricted to them, every product otherwise.
+    """
+    tags = []
+    if category:
+        tags.append(f"category:{category}")
+    if brand:
+        tags.append(f"brand:{brand}")
+    return tags or [ALL_PRODUCTS_TAG]
+
+
+def tags_for_product(product):
+    """
+    The tags a write to `product` invalidates, including the category and brand
+    it had when it was loaded.
+    """
+    loaded = getattr(product, "_loaded_values", {})
+    tags = {ALL_PRODUCTS_TAG, f"product:{product.pk}"}
+    for field in ("category", "brand"):
+        for value in (getattr(product, field), loaded.get(field)):
+            if value:
+                tags.add(f"{field}:{value}")
+    return sorted(tags)
+
+
+def _tag_versions(cache, tags, values):
+    """
+    Current version of every tag. A missing tag gets a fresh, time based version
+    so an evicted tag never takes back a version stored in an older entry.
+    """
+    versions = {}
+    for tag in tags:
+        key = tag_key(tag)
+        version = values.get(key)
+        if version is None:
+            version = time.time_ns()
+            if not cache.add(key, version, None):
+                version = cache.get(key)
+        versions[tag] = version
+    return versions
+
+
+def cached_response(namespace, params, tags, build_response):
+    """
+    Return the cached data of the request described by `params` or build, cache
+    and return it.
+
+    Entries store the versions their tags had before the response was built and
+    are only served while these versions are current, which costs one
+    `get_many` round trip and makes an invalidation a single `incr` per tag.
+
+    The responses built from a read replica are kept apart: read right after
+    a write, a lagging replica would store its old rows under the new tag
+    versions, and serve them to the writer pinned to the primary.
+    """
+    config = get_config()
+    if not config["ENABLED"]:
+        return build_response()
+
+    cache = get_cache()
+    replica = db_router.read_replica()
+    key = make_key(f"{namespace}@{replica}" if replica else namespace, params)
+    try:
+        values = cache.get_many([key, *map(tag_key, tags)])
+        versions = _tag_versions(cache, tags, values)
+    except Exception:
+        # The cache is down: answer uncached rather than fail the request.
+        logger.exception("cannot read the product cache")
+        return build_response()
+
+    entry = values.get(key)
+    if entry is not None and entry["versions"] == versions:
+        stats.record("hits")
+        metrics.record_cache(hit=True)
+        return Response(entry["data"])
+
+    stats.record("misses")
+    metrics.record_cache(hit=False)
+    response = build_response()
+    if response.status_code == 200:
+        try:
+            cache.set(key, {"versions": versions, "data": response.data}, config["TIMEOUT"])
+        except Exception:
+            logger.exception("cannot store %s in the product cache", key)
+    return response
+
+
+def invalidate(tags):
+    """
+    Evict every entry depending on one of `tags` by bumping the tag versions.
+
+    It runs in `post_save` and `on_commit` handlers, so a cache failure is
+    logged and not raised: the write has happened and the entries expire
+    after `TIMEOUT` at the latest.
+    """
+    if not get_config()["ENABLED"]:
+        return
+    cache = get_cache()
+    for tag in tags:
+        key = tag_key(tag)
+        try:
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, time.time_ns(), None)
+        except Exception:
+            logger.exception("cannot invalidate the product cache tag %s", tag)
+            continue
+        stats.record("invalidations")
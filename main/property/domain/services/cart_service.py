@@ -0,0 +1,216 @@
+from decimal import Decimal
+
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, QuerySet, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from property.models import Cart, CartItem, Product
+
+CART_FIELDS = ("id", "user", "item_count", "subtotal", "created_at", "updated_at")
+ITEM_FIELDS = ("id", "quantity", "created_at", "updated_at")
+PRODUCT_FIELDS = ("id", "name", "price", "category", "brand", "rating")
+
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+
+
+def refresh_cart_summaries(carts):
+    """
+    Recompute `item_count` and `subtotal` of `carts` (a Cart queryset or ids)
+    from their items with one UPDATE.
+    """
+    if not isinstance(carts, QuerySet):
+        carts = Cart.objects.filter(pk__in=list(carts))
+    items = CartItem.objects.filter(cart=OuterRef("pk")).order_by().values("cart")
+    count = items.annotate(total=Sum("quantity")).values("total")
+    subtotal = items.annotate(
+        total=Sum(ExpressionWrapper(F("quantity") * F("product__price"), output_field=MONEY))
+    ).values("total")
+    return carts.update(
+        item_count=Coalesce(Subquery(count), 0),
+        subtotal=Coalesce(Subquery(subtotal, output_field=MONEY), Value(Decimal("0")), output_field=MONEY),
+    )
+
+
+def refresh_product_carts(product_ids):
+    """
+    Refresh the summaries of the carts holding one of `product_ids`, after a price change.
+    """
+    return refresh_cart_summaries(Cart.objects.filter(cartitem__product__in=list(product_ids)))
+
+
+def get_cart_detail(user):
+    """
+    Return the first cart of `user` with its items and their products as
+    nested dicts, read with one LEFT JOIN query, or None when the user has no
+    cart.
+    """
+    first_cart = Cart.objects.filter(user=user).order_by("pk").values("pk")[:1]
+    rows = (
+        Cart.objects.filter(pk=Subquery(first_cart))
+        .order_by("cartitem__pk")
+        .values(
+            *CART_FIELDS,
+            *(f"cartitem__{name}" for name in ITEM_FIELDS),
+            *(f"cartitem__product__{name}" for name in PRODUCT_FIELDS),
+        )
+    )
+    cart = None
+    for row in rows:
+        if cart is None:
+            cart = {name: row[name] for name in CART_FIELDS}
+            cart["items"] = []
+        if row["cartitem__id"] is None:
+            continue
+        item = {name: row[f"cartitem__{name}"] for name in ITEM_FIELDS}
+        item["product"] = {name: row[f"cartitem__product__{name}"] for name in PRODUCT_FIELDS}
+        item["line_total"] = item["quantity"] * item["product"]["price"]
+        cart["items"].append(item)
+    return cart
+
+
+def get_or_create_cart(user):
+    """
+    Return the cart of `user`, created if needed. Call it outside of a
+    transaction: on a concurrent create the unique user constraint fails and
+    the row committed by the other request is read instead.
+    """
+    cart, _ = Cart.objects.get_or_create(user=user)
+    return cart
+
+
+def _upsert_sql(connection, increment):
+    """
+    Return the vendor specific INSERT ... SELECT upserting one item of the
+    cart of a user, or None when the database has no upsert syntax.
+    """
+    quote = connection.ops.quote_name
+    item, cart, product = CartItem._meta, Cart._meta, Product._meta
+    table = quote(item.db_table)
+    quantity, updated_at = quote(item.get_field("quantity").column), quote(item.get_field("updated_at").column)
+    columns = ", ".join(quote(item.get_field(name).column)
+                        for name in ("cart", "product", "quantity", "created_at", "updated_at"))
+    insert = (
+        f"INSERT INTO {table} ({columns}) "
+        f"SELECT c.{quote(cart.pk.column)}, p.{quote(product.pk.column)}, %s, %s, %s "
+        f"FROM {quote(cart.db_table)} c, {quote(product.db_table)} p "
+        f"WHERE c.{quote(cart.get_field('user').column)} = %s AND p.{quote(product.pk.column)} = %s"
+    )
+    new_quantity = f"{table}.{quantity} + %s" if increment else "%s"
+    assignments = f"{quantity} = {new_quantity}, {updated_at} = %s"
+    if connection.vendor == "mysql":
+        return f"{insert} ON DUPLICATE KEY UPDATE {assignments}"
+    if connection.vendor == "postgresql" or (
+            connection.vendor == "sqlite" and connection.Database.sqlite_version_info >= (3, 24, 0)):
+        conflict = ", ".join(quote(item.get_field(name).column) for name in ("cart", "product"))
+        return f"{insert} ON CONFLICT ({conflict}) DO UPDATE SET {assignments}"
+    return None
+
+
+def _upsert_item(user, product_id, quantity, increment):
+    """
+    Add `quantity` to (or set it as) the quantity of `product_id` in the cart
+    of `user` with one statement. Return False when the user has no cart or
+    the product does not exist.
+    """
+    connection = connections[router.db_for_write(CartItem)]
+    now = timezone.now()
+    sql = _upsert_sql(connection, increment)
+    if sql is None:
+        return _update_or_create_item(user, product_id, quantity, increment, now)
+
+    stamp = connection.ops.adapt_datetimefield_value(now)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [quantity, stamp, stamp, user.pk, product_id, quantity, stamp])
+        return cursor.rowcount > 0
+
+
+def _update_or_create_item(user, product_id, quantity, increment, now):
+    cart = Cart.objects.filter(user=user).first()
+    if cart is None:
+        return False
+    items = CartItem.objects.filter(cart=cart, product_id=product_id)
+    value = F("quantity") + quantity if increment else quantity
+    if items.update(quantity=value, updated_at=now):
+        return True
+    if not Product.objects.filter(pk=product_id).exists():
+        return False
+    try:
+        with transaction.atomic():
+            CartItem.objects.create(cart=cart, product_id=product_id, quantity=quantity)
+    except IntegrityError:
+        items.update(quantity=value, updated_at=now)
+    return True
+
+
+def _user_carts(user):
+    return Cart.objects.filter(user=user)
+
+
+def _user_items(user, product_id):
+    # A subquery on the cart table rather than a join, so the UPDATE/DELETE stays one statement.
+    return CartItem.objects.filter(cart__in=Subquery(_user_carts(user).values("pk")), product_id=product_id)
+
+
+def add_item(user, product_id, quantity=1):
+    """
+    Add `quantity` of a product to the cart of `user`, creating the cart on
+    its first item. Adding a product already in the cart increments its
+    quantity. Raise `Product.DoesNotExist` for an unknown product.
+    """
+    for attempt in range(2):
+        with transaction.atomic():
+            if _upsert_item(user, product_id, quantity, increment=True):
+                refresh_cart_summaries(_user_carts(user))
+                return
+        if attempt or not Product.objects.filter(pk=product_id).exists():
+            break
+        get_or_create_cart(user)
+    raise Product.DoesNotExist(f"Product {product_id} does not exist")
+
+
+def set_item_quantity(user, product_id, quantity):
+    """
+    Set the quantity of a product already in the cart of `user`, removing it
+    at 0. Return whether the cart held the product.
+    """
+    if quantity <= 0:
+        return remove_item(user, product_id)
+    with transaction.atomic():
+        updated = _user_items(user, product_id).update(quantity=quantity, updated_at=timezone.now())
+        if updated:
+            refresh_cart_summaries(_user_carts(user))
+    return bool(updated)
+
+
+def remove_item(user, product_id):
+    """
+    Remove a product from the cart of `user`, return whether it was there.
+    The summary is refreshed by the CartItem post_delete receiver.
+    """
+    with transaction.atomic():
+        deleted, _ = _user_items(user, product_id).delete()
+    return bool(deleted)
+
+
+def apply_changes(user, changes):
+    """
+    Apply a batch of {"op": "add" | "set" | "remove", "product", "quantity"}
+    changes to the cart of `user` in one transaction.
+
+    The cart row is locked first and the items are written in product order,
+    so concurrent batches of the same user run one after the other instead of
+    deadlocking. An unknown product rolls back the whole batch with
+    `Product.DoesNotExist`.
+    """
+    cart = get_or_create_cart(user)
+    with transaction.atomic():
+        Cart.objects.select_for_update().filter(pk=cart.pk).values_list("pk").get()
+        for change in sorted(changes, key=lambda change: change["product"]):
+            op, product_id, quantity = change["op"], change["product"], change.get("quantity", 1)
+            if op == "remove" or (op == "set" and quantity <= 0):
+                _user_items(user, product_id).delete()
+            elif not _upsert_item(user, product_id, quantity, increment=op == "add"):
+                raise Product.DoesNotExist(f"Product {product_id} does not exist")
+        refresh_cart_summaries(_user_carts(user))
+    return cart
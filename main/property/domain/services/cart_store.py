@@ -0,0 +1,459 @@
+import datetime
+import json
+import logging
+import threading
+from decimal import Decimal
+from itertools import islice
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from property.domain.services import cart_service
+from property.models import Cart, CartItem, Product
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = "property.domain.services.cart_store.DatabaseCartStore"
+
+
+class BaseCartStore:
+    """
+    Where `CartViewSet` reads and writes carts. Every method takes the
+    authenticated user, `get_cart_detail` returns the dict rendered by
+    `CartDetailSerializer` or None when the user has no cart.
+    """
+
+    def get_cart_detail(self, user):
+        raise NotImplementedError
+
+    def add_item(self, user, product_id, quantity=1):
+        raise NotImplementedError
+
+    def set_item_quantity(self, user, product_id, quantity):
+        raise NotImplementedError
+
+    def remove_item(self, user, product_id):
+        raise NotImplementedError
+
+    def apply_changes(self, user, changes):
+        raise NotImplementedError
+
+    def product_changed(self, product_id):
+        """
+        Called when a product is saved or deleted.
+        """
+
+    def flush(self):
+        """
+        Persist the pending changes, return the number of carts written.
+        """
+        return 0
+
+
+class DatabaseCartStore(BaseCartStore):
+    """
+    Carts read and written straight from the database by `cart_service`.
+    """
+
+    def get_cart_detail(self, user):
+        return cart_service.get_cart_detail(user)
+
+    def add_item(self, user, product_id, quantity=1):
+        cart_service.add_item(user, product_id, quantity)
+
+    def set_item_quantity(self, user, product_id, quantity):
+        return cart_service.set_item_quantity(user, product_id, quantity)
+
+    def remove_item(self, user, product_id):
+        return cart_service.remove_item(user, product_id)
+
+    def apply_changes(self, user, changes):
+        cart_service.apply_changes(user, changes)
+
+
+def _timestamp():
+    return timezone.now().isoformat()
+
+
+def _parse_timestamp(value):
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
+class RedisCartStore(BaseCartStore):
+    """
+    Active carts kept in Redis hashes and written to the database behind the
+    requests (write-behind).
+
+    The cart of a user is one hash holding its database `id`, timestamps, a
+    `version` bumped by every change and per product `q:<id>` (quantity),
+    `c:<id>` (added at) and `u:<id>` (updated at) fields. A cart missing from
+    Redis is loaded from the database on first use, so Redis can be emptied
+    at any time once flushed (see `rebuild`). Product fields shown in carts
+    come from short-lived snapshots, so reading or changing a warm cart does
+    not touch the database.
+
+    Every change marks the user dirty in one MULTI/EXEC and, unless a flush
+    is already queued, queues the `flush_task` django_q task. The flush copies
+    the state of a batch of dirty carts to `Cart`/`CartItem` in one
+    transaction and only clears the dirty mark of carts whose version did not
+    change meanwhile. Writing the full state makes it idempotent: a flush run
+    twice, or interrupted and retried, writes the same rows.
+    """
+
+    def __init__(self, client=None, url=None, key_prefix="cart", ttl=7 * 24 * 3600, product_ttl=600,
+                 batch_size=500, flush_task="property.domain.Tasks.flush_carts", flush_timeout=300):
+        self.client = client or redis.StrictRedis.from_url(
+            url or f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/2",
+            socket_connect_timeout=2,
+            socket_timeout=2,
+        )
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.product_ttl = product_ttl
+        self.batch_size = batch_size
+        self.flush_task = flush_task
+        self.flush_timeout = flush_timeout
+        self.dirty_key = f"{key_prefix}:dirty"
+        self.flush_key = f"{key_prefix}:flush-queued"
+
+    def cart_key(self, user_id):
+        return f"{self.key_prefix}:user:{user_id}"
+
+    def product_key(self, product_id):
+        return f"{self.key_prefix}:product:{product_id}"
+
+    # Reads
+
+    def get_cart_detail(self, user):
+        data = self._read(self._ensure_loaded(user.pk))
+        if not data.get("id") and not int(data.get("version") or 0):
+            return None
+        quantities = {int(name[2:]): int(value) for name, value in data.items() if name.startswith("q:")}
+        products = self.get_products(sorted(quantities))
+        items = []
+        for product_id in sorted(quantities, key=lambda product_id: data.get(f"c:{product_id}") or ""):
+            product = products.get(product_id)
+            if product is None:
+                continue
+            quantity = quantities[product_id]
+            items.append({
+                "id": None,
+                "product": product,
+                "quantity": quantity,
+                "line_total": quantity * product["price"],
+                "created_at": _parse_timestamp(data.get(f"c:{product_id}")),
+                "updated_at": _parse_timestamp(data.get(f"u:{product_id}")),
+            })
+        return {
+            "id": int(data["id"]) if data.get("id") else None,
+            "user": user.pk,
+            "item_count": sum(item["quantity"] for item in items),
+            "subtotal": sum((item["line_total"] for item in items), Decimal("0.00")),
+            "created_at": _parse_timestamp(data.get("created_at")),
+            "updated_at": _parse_timestamp(data.get("updated_at")),
+            "items": items,
+        }
+
+    def get_products(self, product_ids):
+        """
+        Return {id: product fields} from the Redis snapshots, loading the
+        missing ones from the database. Deleted products are left out.
+        """
+        if not product_ids:
+            return {}
+        products = {}
+        missing = []
+        for product_id, raw in zip(product_ids, self.client.mget([self.product_key(pk) for pk in product_ids])):
+            if raw is None:
+                missing.append(product_id)
+            else:
+                products[product_id] = self._decode_product(raw)
+        if missing:
+            rows = Product.objects.filter(pk__in=missing).values(*cart_service.PRODUCT_FIELDS)
+            pipe = self.client.pipeline(transaction=False)
+            for row in rows:
+                products[row["id"]] = row
+                pipe.set(self.product_key(row["id"]), json.dumps({**row, "price": str(row["price"])}),
+                         ex=self.product_ttl)
+            pipe.execute()
+        return products
+
+    @staticmethod
+    def _decode_product(raw):
+        product = json.loads(raw)
+        product["price"] = Decimal(product["price"])
+        return product
+
+    def _read(self, key):
+        return {name.decode(): value.decode() for name, value in self.client.hgetall(key).items()}
+
+    def _ensure_loaded(self, user_id):
+        """
+        Return the key of the cart of `user_id`, copying the cart from the
+        database first when Redis does not hold it. The copy is written under
+        WATCH, so it never lands over a change made by a concurrent request.
+        """
+        key = self.cart_key(user_id)
+        if self.client.exists(key):
+            return key
+
+        def load(pipe):
+            if pipe.exists(key):
+                return
+            fields = self._database_fields(user_id)
+            pipe.multi()
+            pipe.hset(key, mapping=fields)
+            pipe.expire(key, self.ttl)
+
+        self.client.transaction(load, key)
+        return key
+
+    @staticmethod
+    def _database_fields(user_id):
+        fields = {"created_at": _timestamp(), "version": 0}
+        cart = Cart.objects.filter(user_id=user_id).values("id", "created_at", "updated_at").first()
+        if cart is None:
+            return fields
+        fields.update(id=cart["id"], created_at=cart["created_at"].isoformat(),
+                      updated_at=cart["updated_at"].isoformat())
+        items = CartItem.objects.filter(cart_id=cart["id"]).values_list("product", "quantity", "created_at",
+                                                                         "updated_at")
+        for product_id, quantity, created_at, updated_at in items:
+            fields.update({f"q:{product_id}": quantity, f"c:{product_id}": created_at.isoformat(),
+                           f"u:{product_id}": updated_at.isoformat()})
+        return fields
+
+    # Writes
+
+    def _check_products(self, product_ids):
+        found = self.get_products(sorted(set(product_ids)))
+        for product_id in product_ids:
+            if product_id not in found:
+                raise Product.DoesNotExist(f"Product {product_id} does not exist")
+
+    def _touch(self, pipe, key, user_id, now):
+        pipe.hset(key, "updated_at", now)
+        pipe.hincrby(key, "version", 1)
+        pipe.expire(key, self.ttl)
+        pipe.sadd(self.dirty_key, user_id)
+
+    def _write_item(self, pipe, key, product_id, quantity, now, increment):
+        if increment:
+            pipe.hincrby(key, f"q:{product_id}", quantity)
+        else:
+            pipe.hset(key, f"q:{product_id}", quantity)
+        pipe.hsetnx(key, f"c:{product_id}", now)
+        pipe.hset(key, f"u:{product_id}", now)
+
+    def add_item(self, user, product_id, quantity=1):
+        self._check_products([product_id])
+        key = self._ensure_loaded(user.pk)
+        now = _timestamp()
+        pipe = self.client.pipeline()
+        self._write_item(pipe, key, product_id, quantity, now, increment=True)
+        self._touch(pipe, key, user.pk, now)
+        pipe.execute()
+        self.schedule_flush()
+
+    def set_item_quantity(self, user, product_id, quantity):
+        if quantity <= 0:
+            return self.remove_item(user, product_id)
+        key = self._ensure_loaded(user.pk)
+
+        def update(pipe):
+            if not pipe.hexists(key, f"q:{product_id}"):
+                return False
+            now = _timestamp()
+            pipe.multi()
+            self._write_item(pipe, key, product_id, quantity, now, increment=False)
+            self._touch(pipe, key, user.pk, now)
+            return True
+
+        updated = self.client.transaction(update, key, value_from_callable=True)
+        if updated:
+            self.schedule_flush()
+        return updated
+
+    def remove_item(self, user, product_id):
+        key = self._ensure_loaded(user.pk)
+        pipe = self.client.pipeline()
+        pipe.hdel(key, f"q:{product_id}", f"c:{product_id}", f"u:{product_id}")
+        self._touch(pipe, key, user.pk, _timestamp())
+        removed = pipe.execute()[0] > 0
+        self.schedule_flush()
+        return removed
+
+    def apply_changes(self, user, changes):
+        self._check_products([change["product"] for change in changes
+                              if change["op"] == "add" or (change["op"] == "set" and change.get("quantity", 1) > 0)])
+        key = self._ensure_loaded(user.pk)
+        now = _timestamp()
+        pipe = self.client.pipeline()
+        for change in changes:
+            op, product_id, quantity = change["op"], change["product"], change.get("quantity", 1)
+            if op == "remove" or (op == "set" and quantity <= 0):
+                pipe.hdel(key, f"q:{product_id}", f"c:{product_id}", f"u:{product_id}")
+            else:
+                self._write_item(pipe, key, product_id, quantity, now, increment=op == "add")
+        self._touch(pipe, key, user.pk, now)
+        pipe.execute()
+        self.schedule_flush()
+
+    def product_changed(self, product_id):
+        self.client.delete(self.product_key(product_id))
+
+    # Write-behind
+
+    def schedule_flush(self):
+        """
+        Queue one flush task unless one is already queued. The flag is
+        cleared when the task starts, so changes made while it runs queue the
+        next one.
+        """
+        if not self.flush_task or not self.client.set(self.flush_key, 1, nx=True, ex=self.flush_timeout):
+            return
+        from django_q.tasks import async_task
+
+        try:
+            async_task(self.flush_task, save=False)
+        except Exception:
+            self.client.delete(self.flush_key)
+            logger.exception("cannot queue the cart flush, the changes stay pending in Redis")
+
+    def flush(self):
+        self.client.delete(self.flush_key)
+        flushed = 0
+        user_ids = (int(user_id) for user_id in self.client.sscan_iter(self.dirty_key, count=self.batch_size))
+        while True:
+            batch = list(islice(user_ids, self.batch_size))
+            if not batch:
+                return flushed
+            flushed += self.flush_users(batch)
+
+    def flush_users(self, user_ids):
+        keys = [self.cart_key(user_id) for user_id in user_ids]
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        states = {}
+        for user_id, data in zip(user_ids, pipe.execute()):
+            if data:
+                states[user_id] = {name.decode(): value.decode() for name, value in data.items()}
+
+        cart_ids = self._write_carts(states) if states else {}
+
+        def clear(pipe):
+            current = [pipe.hget(key, "version") for key in keys]
+            pipe.multi()
+            for user_id, key, version in zip(user_ids, keys, current):
+                state = states.get(user_id)
+                if state is None:
+                    # Expired before it was flushed, nothing left to write.
+                    pipe.srem(self.dirty_key, user_id)
+                    continue
+                if version is None:
+                    # Expired since it was read, what was read is written.
+                    pipe.srem(self.dirty_key, user_id)
+                    continue
+                pipe.hset(key, "id", cart_ids[user_id])
+                if version.decode() == state.get("version"):
+                    pipe.srem(self.dirty_key, user_id)
+
+        self.client.transaction(clear, *keys)
+        return len(states)
+
+    def _write_carts(self, states):
+        """
+        Make the database rows of the carts match `states`, return {user id: cart id}.
+        """
+        wanted = {
+            user_id: {int(name[2:]): (int(value), _parse_timestamp(state.get(f"u:{name[2:]}")))
+                      for name, value in state.items() if name.startswith("q:")}
+            for user_id, state in states.items()
+        }
+        with transaction.atomic():
+            carts = dict(Cart.objects.filter(user_id__in=list(states)).values_list("user_id", "id"))
+            missing = [user_id for user_id in states if user_id not in carts]
+            if missing:
+                Cart.objects.bulk_create([Cart(user_id=user_id) for user_id in missing], ignore_conflicts=True)
+                carts.update(Cart.objects.filter(user_id__in=missing).values_list("user_id", "id"))
+
+            product_ids = {product_id for items in wanted.values() for product_id in items}
+            known = set(Product.objects.filter(pk__in=product_ids).values_list("pk", flat=True))
+            existing = {
+                (cart_id, product_id): (item_id, quantity)
+                for item_id, cart_id, product_id, quantity in CartItem.objects.filter(
+                    cart_id__in=list(carts.values())).values_list("id", "cart", "product", "quantity")
+            }
+            to_create, to_update = [], []
+            for user_id, items in wanted.items():
+                cart_id = carts[user_id]
+                for product_id, (quantity, updated_at) in items.items():
+                    if product_id not in known:
+                        continue
+                    current = existing.pop((cart_id, product_id), None)
+                    if current is None:
+                        to_create.append(CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity))
+                    elif current[1] != quantity:
+                        to_update.append(CartItem(pk=current[0], quantity=quantity,
+                                                  updated_at=updated_at or timezone.now()))
+            CartItem.objects.bulk_create(to_create)
+            CartItem.objects.bulk_update(to_update, ["quantity", "updated_at"])
+            # Whatever is left in the database is no longer in the Redis carts.
+            CartItem.objects.filter(pk__in=[item_id for item_id, _ in existing.values()]).delete()
+            cart_service.refresh_cart_summaries(list(carts.values()))
+        return carts
+
+    def rebuild(self):
+        """
+        Flush, then drop the carts and product snapshots from Redis so they
+        are reloaded from the database on their next use. Carts changed
+        during the rebuild stay in Redis. Return the number of dropped keys.
+        """
+        self.flush()
+        cart_prefix = self.cart_key("")
+        dropped = 0
+        for key in self.client.scan_iter(match=f"{self.key_prefix}:*", count=1000):
+            key = key.decode()
+            if key in (self.dirty_key, self.flush_key):
+                continue
+            if not key.startswith(cart_prefix):
+                dropped += self.client.delete(key)
+                continue
+
+            def drop(pipe, key=key):
+                if pipe.sismember(self.dirty_key, key[len(cart_prefix):]):
+                    return 0
+                pipe.multi()
+                pipe.delete(key)
+                return 1
+
+            dropped += self.client.transaction(drop, key, value_from_callable=True)
+        return dropped
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_cart_store():
+    """
+    Return the process wide store configured by `settings.CART_STORE`.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = getattr(settings, "CART_STORE", {})
+                store_class = import_string(config.get("BACKEND", DEFAULT_BACKEND))
+                _store = store_class(**config.get("OPTIONS", {}))
+    return _store
+
+
+def reset_cart_store():
+    global _store
+    with _store_lock:
+        _store = None
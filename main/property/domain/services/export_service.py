@@ -0,0 +1,68 @@
+import csv
+import io
+import zlib
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from property.serializers import product_values
+
+FORMATS = ("csv", "jsonl")
+CONTENT_TYPES = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson"}
+ROWS_PER_CHUNK = 500
+CURSOR_CHUNK_SIZE = 2000
+
+
+def iter_batches(queryset):
+    """
+    Yield lists of product dicts read from a server side cursor, formatted like
+    the API output by `product_values` without instantiating models.
+    """
+    batch = []
+    for row in product_values.values(queryset).iterator(chunk_size=CURSOR_CHUNK_SIZE):
+        batch.append(row)
+        if len(batch) >= ROWS_PER_CHUNK:
+            yield product_values.to_representation(batch)
+            batch = []
+    if batch:
+        yield product_values.to_representation(batch)
+
+
+def iter_jsonl(queryset):
+    encoder = JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    for batch in iter_batches(queryset):
+        yield "".join(encoder.encode(record) + "\n" for record in batch).encode()
+
+
+def iter_csv(queryset):
+    names = [name for name, _, _ in product_values.compile()]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=names)
+    writer.writeheader()
+    for batch in iter_batches(queryset):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def gzip_stream(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_products(queryset, file_format, compress=False):
+    """
+    Stream `queryset` as CSV or JSONL bytes, optionally gzipped, ordered by
+    primary key. Memory use does not depend on the number of products.
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"Unsupported format {file_format!r}, expected one of {', '.join(FORMATS)}")
+    queryset = queryset.order_by("pk")
+    chunks = iter_csv(queryset) if file_format == "csv" else iter_jsonl(queryset)
+    return gzip_stream(chunks) if compress else chunks
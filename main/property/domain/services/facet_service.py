@@ -0,0 +1,75 @@
+"""
+Facet counts of a product search: the matching products per category and
+brand, and histograms of their prices and ratings.
+
+The four GROUP BYs are sent as a single UNION ALL statement, so the facets of
+a search page cost one round trip whatever their number.
+"""
+from django.conf import settings
+from django.db.models import Case, CharField, Count, F, Value, When
+
+DEFAULT_CONFIG = {
+    # Lower bounds of the histogram buckets, the last bucket is open ended.
+    "PRICE_BUCKETS": (0, 50, 100, 250, 500),
+    "RATING_BUCKETS": (0, 1, 2, 3, 4),
+    # Most frequent values returned for the category and brand facets.
+    "SIZE": 20,
+}
+
+
+def get_config():
+    return {**DEFAULT_CONFIG, **getattr(settings, "PRODUCT_FACETS", {})}
+
+
+def _bucket(field, bounds):
+    """
+    Index of the bucket of `field`, as a string like the term facets.
+    """
+    return Case(
+        *[When(**{f"{field}__gte": bound}, then=Value(str(index))) for index, bound in reversed(list(enumerate(bounds)))],
+        output_field=CharField(),
+    )
+
+
+def _grouped(queryset, facet, value):
+    return (queryset.order_by()
+            .annotate(facet=Value(facet, output_field=CharField()), value=value)
+            .values("facet", "value")
+            .annotate(count=Count("pk")))
+
+
+def _terms(counts, size):
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:size]
+    return [{"value": value, "count": count} for value, count in ranked]
+
+
+def _histogram(counts, bounds):
+    return [
+        {"min": bound, "max": bounds[index + 1] if index + 1 < len(bounds) else None, "count": counts.get(str(index), 0)}
+        for index, bound in enumerate(bounds)
+    ]
+
+
+def count_facets(queryset):
+    """
+    Return the category, brand, price and rating facets of the products of
+    `queryset`.
+    """
+    config = get_config()
+    queries = [
+        _grouped(queryset, "category", F("category")),
+        _grouped(queryset, "brand", F("brand")),
+        _grouped(queryset, "price", _bucket("price", config["PRICE_BUCKETS"])),
+        _grouped(queryset, "rating", _bucket("rating", config["RATING_BUCKETS"])),
+    ]
+    counts = {"category": {}, "brand": {}, "price": {}, "rating": {}}
+    for row in queries[0].union(*queries[1:], all=True):
+        if row["value"] is not None:
+            counts[row["facet"]][row["value"]] = row["count"]
+
+    return {
+        "category": _terms(counts["category"], config["SIZE"]),
+        "brand": _terms(counts["brand"], config["SIZE"]),
+        "price": _histogram(counts["price"], config["PRICE_BUCKETS"]),
+        "rating": _histogram(counts["rating"], config["RATING_BUCKETS"]),
+    }
@@ -0,0 +1,167 @@
+import codecs
+import csv
+import json
+import logging
+import time
+from itertools import islice
+
+from django.db import DatabaseError, transaction
+
+from property.domain import events
+from property.domain.services import cache_service
+from property.models import Product
+from property.serializers import ProductPostSerializer
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("csv", "jsonl")
+CHUNK_SIZE = 1000
+IMPORT_FIELDS = ("name", "description", "price", "category", "brand", "rating")
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.monotonic()
+
+    def add_error(self, row, errors):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "errors": errors})
+
+    def as_dict(self):
+        seconds = time.monotonic() - self.started
+        return {
+            "rows": self.rows,
+            "created": self.created,
+            "updated": self.updated,
+            "failed": self.failed,
+            "errors": self.errors,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.rows / seconds, 1) if seconds else None,
+        }
+
+
+def guess_format(name=None, content_type=None):
+    """
+    Tell the file format from a file name or a content type.
+    """
+    if content_type:
+        content_type = content_type.split(";")[0].strip()
+        if content_type in ("text/csv", "application/csv"):
+            return "csv"
+        if content_type in ("application/x-ndjson", "application/jsonl", "application/x-jsonlines"):
+            return "jsonl"
+    if name:
+        extension = name.rsplit(".", 1)[-1].lower()
+        if extension == "csv":
+            return "csv"
+        if extension in ("jsonl", "ndjson"):
+            return "jsonl"
+    return None
+
+
+def iter_rows(lines, file_format):
+    """
+    Parse an iterable of byte lines incrementally, yielding (row number, dict).
+    """
+    text = codecs.iterdecode(lines, "utf-8-sig")
+    if file_format == "csv":
+        for number, row in enumerate(csv.DictReader(text), start=1):
+            yield number, row
+    elif file_format == "jsonl":
+        number = 0
+        for line in text:
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                row = error
+            yield number, row
+    else:
+        raise ValueError(f"Unsupported format {file_format!r}, expected one of {', '.join(FORMATS)}")
+
+
+def import_products(rows, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Validate and upsert (row number, dict) pairs chunk by chunk.
+
+    Rows carrying the `id` of an existing product update it, the others are
+    inserted. Each chunk is validated with `ProductPostSerializer` and written
+    with one `bulk_create` and one `bulk_update` in its own transaction, so
+    memory stays bounded by `chunk_size` whatever the size of the input.
+    """
+    report = ImportReport()
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        report.rows += len(chunk)
+        import_chunk(chunk, report)
+        if progress:
+            progress(report)
+    return report
+
+
+def import_chunk(chunk, report):
+    valid = {}
+    for number, row in chunk:
+        if not isinstance(row, dict):
+            report.add_error(number, {"row": [str(row) if isinstance(row, Exception) else "Expected an object."]})
+            continue
+        try:
+            pk = int(row["id"]) if row.get("id") not in (None, "") else None
+        except (TypeError, ValueError):
+            report.add_error(number, {"id": ["A valid integer is required."]})
+            continue
+        serializer = ProductPostSerializer(data={field: row.get(field) for field in IMPORT_FIELDS if field in row})
+        if serializer.is_valid():
+            # A later row with the same id wins, as it would with one request per row.
+            valid[pk if pk is not None else ("row", number)] = (number, pk, serializer.validated_data)
+        else:
+            report.add_error(number, serializer.errors)
+    if not valid:
+        return
+
+    try:
+        with transaction.atomic():
+            created, updated = write_chunk(valid.values())
+    except DatabaseError as error:
+        logger.exception("product import chunk failed")
+        for number, _, _ in valid.values():
+            report.add_error(number, {"row": [str(error)]})
+        return
+    report.created += created
+    report.updated += updated
+
+
+def write_chunk(rows):
+    ids = [pk for _, pk, _ in rows if pk is not None]
+    existing = {
+        pk: (category, brand)
+        for pk, category, brand in Product.objects.filter(pk__in=ids).values_list("pk", "category", "brand")
+    }
+    to_create, to_update = [], []
+    tags = {cache_service.ALL_PRODUCTS_TAG}
+    for _, pk, data in rows:
+        product = Product(pk=pk, **data)
+        tags.update((f"category:{product.category}", f"brand:{product.brand}"))
+        if pk in existing:
+            category, brand = existing[pk]
+            tags.update((f"product:{pk}", f"category:{category}", f"brand:{brand}"))
+            to_update.append(product)
+        else:
+            to_create.append(product)
+
+    Product.objects.bulk_create(to_create)
+    Product.objects.bulk_update(to_update, list(IMPORT_FIELDS))
+    events.products_changed.send(sender=Product, products=to_create + to_update, tags=sorted(tags))
+    return len(to_create), len(to_update)
@@ -0,0 +1,84 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from property.models import OutboxEvent
+from utils import envelope, producer, routing
+
+logger = logging.getLogger(__name__)
+
+
+def get_config():
+    return {"BATCH_SIZE": 100, "POLL_INTERVAL": 1.0, "RETENTION_DAYS": 7, **getattr(settings, "OUTBOX", {})}
+
+
+def enqueue(event_type, payload, aggregate_type="", aggregate_id="", lane=None):
+    """
+    Record an event in the current transaction, it is published once the
+    transaction committed, by the relay. Rolled back changes publish nothing.
+    `lane` overrides the default lane of the event, see `routing.routing_key`.
+    """
+    return OutboxEvent.objects.create(
+        event_type=event_type,
+        payload=payload,
+        aggregate_type=aggregate_type,
+        aggregate_id=str(aggregate_id),
+        routing_key=routing.routing_key(event_type, lane),
+    )
+
+
+def relay_batch(batch_size=None, publisher=None):
+    """
+    Publish the oldest unpublished events, at most `batch_size`, and mark
+    them published. Return the number of events published.
+
+    The events are locked while they are published, so concurrent relays
+    take turns instead of publishing the same events or overtaking each
+    other. They are sent with one broker transaction and marked published
+    once it committed: a crash in between publishes them again (at least
+    once delivery), consumers recognise duplicates by the envelope id, the
+    event id. A failed batch is rolled back and retried in the same order.
+    """
+    batch_size = batch_size or get_config()["BATCH_SIZE"]
+    publisher = publisher or producer.publisher
+    event_ids = []
+    try:
+        with transaction.atomic():
+            events = list(
+                OutboxEvent.objects.select_for_update()
+                .filter(published_at__isnull=True)
+                .order_by("id")[:batch_size]
+            )
+            event_ids = [event.pk for event in events]
+            if not events:
+                return 0
+            with publisher.batch():
+                for event in events:
+                    message = envelope.Envelope(event.event_type, event.payload, id=str(event.pk),
+                                                occurred_at=event.created_at.timestamp())
+                    publisher.publish(event.event_type, message, routing_key=event.routing_key, properties={
+                        "delivery_mode": 2,
+                        "headers": {"aggregate_type": event.aggregate_type, "aggregate_id": event.aggregate_id},
+                    })
+            OutboxEvent.objects.filter(pk__in=event_ids).update(
+                published_at=timezone.now(), attempts=F("attempts") + 1, last_error=""
+            )
+    except Exception as error:
+        if event_ids:
+            OutboxEvent.objects.filter(pk__in=event_ids).update(attempts=F("attempts") + 1, last_error=repr(error))
+        raise
+    return len(event_ids)
+
+
+def purge_published(older_than=None):
+    """
+    Delete the events published more than `older_than` ago.
+    """
+    if older_than is None:
+        older_than = timedelta(days=get_config()["RETENTION_DAYS"])
+    deleted, _ = OutboxEvent.objects.filter(published_at__lt=timezone.now() - older_than).delete()
+    return deleted
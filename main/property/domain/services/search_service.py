@@ -0,0 +1,383 @@
+import bisect
+import logging
+import math
+import re
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from property.models import Product
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = "property.domain.services.search_service.InvertedIndexSearchBackend"
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+VERSION_KEY = "product-search:version"
+
+
+def tokenize(text):
+    """
+    Split `text` into lower-cased word tokens.
+    """
+    return TOKEN_RE.findall((text or "").casefold())
+
+
+def ngrams(token, size):
+    return {token[i:i + size] for i in range(len(token) - size + 1)}
+
+
+def change_key(version):
+    return f"product-search:change:{version}"
+
+
+class BaseSearchBackend:
+    """
+    A product search backend returns product ids ranked by relevance.
+    """
+
+    fields = ("name", "description", "brand")
+
+    def __init__(self, max_results=1000, **options):
+        self.max_results = max_results
+
+    def search(self, query, fields=None, limit=None):
+        raise NotImplementedError
+
+    def index_product(self, product):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+    def update(self, products=(), deleted_ids=()):
+        for product in products:
+            self.index_product(product)
+        for product_id in deleted_ids:
+            self.remove_product(product_id)
+
+    def invalidate(self):
+        pass
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """
+    Fallback backend running `icontains` lookups against the database.
+    """
+
+    def search(self, query, fields=None, limit=None):
+        condition = Q()
+        for field in fields or self.fields:
+            condition |= Q(**{f"{field}__icontains": query})
+        ids = Product.objects.filter(condition).order_by("name").values_list("pk", flat=True)
+        return list(ids[: limit or self.max_results])
+
+
+class InvertedIndexSearchBackend(BaseSearchBackend):
+    """
+    In-process inverted index over the product catalogue.
+
+    Every field keeps its own postings (term -> {product id: term frequency}), so a
+    query can be restricted to some fields and scored with a per field BM25. Query
+    tokens match indexed terms exactly, by prefix (binary search over the sorted
+    vocabulary) or, for tokens of at least `ngram_size` characters, anywhere inside
+    a term through a character n-gram index. All query tokens must match.
+
+    The index is built lazily from the database on the first search and is kept up
+    to date by the `Product` save/delete receivers in `signals.py`. As these only
+    run in the process making the write, every change is also published in the
+    shared cache `cache_alias`: a version counter and, per version, the changed
+    product ids. Before each search the index compares its version with the shared
+    one and reloads the products changed by the other processes (web workers,
+    `import_products`, django_q tasks), or rebuilds itself when more than
+    `max_replay` changes or an unknown change happened since.
+    """
+
+    field_weights = {"name": 3.0, "brand": 2.0, "description": 1.0}
+    exact_boost = 1.0
+    prefix_boost = 0.8
+    ngram_boost = 0.5
+
+    def __init__(self, max_results=1000, k1=1.2, b=0.75, ngram_size=3, cache_alias="default", max_replay=500,
+                 change_timeout=3600, **options):
+        super().__init__(max_results=max_results, **options)
+        self.k1 = k1
+        self.b = b
+        self.ngram_size = ngram_size
+        self.cache_alias = cache_alias
+        self.max_replay = max_replay
+        self.change_timeout = change_timeout
+        self._lock = threading.RLock()
+        self._built = False
+        self._version = None
+        self._reset()
+
+    def _reset(self):
+        self._postings = {field: defaultdict(dict) for field in self.fields}
+        self._doc_lengths = {field: {} for field in self.fields}
+        self._total_lengths = dict.fromkeys(self.fields, 0)
+        self._doc_terms = {}
+        self._term_refs = defaultdict(int)
+        self._vocabulary = []
+        self._grams = defaultdict(set)
+
+    @property
+    def size(self):
+        return len(self._doc_terms)
+
+    def build(self):
+        with self._lock:
+            self._reset()
+            # Read before the rows: a change published meanwhile is replayed by the next search.
+            self._version = self._shared_version()
+            # From the primary: the index outlives the request, a lagging replica would stay in it.
+            rows = Product.objects.using(DEFAULT_DB_ALIAS).values_list("pk", *self.fields).iterator(chunk_size=2000)
+            for pk, *values in rows:
+                self._add(pk, dict(zip(self.fields, values)))
+            self._built = True
+            logger.info("search index built with %s products", self.size)
+
+    def invalidate(self):
+        with self._lock:
+            self._reset()
+            self._built = False
+        self._publish(None)
+
+    def index_product(self, product):
+        self.update(products=[product])
+
+    def remove_product(self, product_id):
+        self.update(deleted_ids=[product_id])
+
+    def update(self, products=(), deleted_ids=()):
+        with self._lock:
+            if self._built:
+                for product in products:
+                    self._remove(product.pk)
+                    self._add(product.pk, {field: getattr(product, field) for field in self.fields})
+                for product_id in deleted_ids:
+                    self._remove(product_id)
+        self._publish([*(product.pk for product in products), *deleted_ids])
+
+    def _shared_version(self):
+        try:
+            return caches[self.cache_alias].get(VERSION_KEY)
+        except Exception:
+            logger.warning("cannot read the search index version", exc_info=True)
+            return None
+
+    def _publish(self, ids):
+        """
+        Record a change of the products `ids` for the other processes, None
+        when they must rebuild their index.
+        """
+        cache = caches[self.cache_alias]
+        try:
+            # Time based, so a counter evicted from the cache never goes back to a known version.
+            cache.add(VERSION_KEY, time.time_ns(), None)
+            version = cache.incr(VERSION_KEY)
+            cache.set(change_key(version), ids, self.change_timeout)
+        except Exception:
+            logger.warning("cannot publish a search index change", exc_info=True)
+            return
+        with self._lock:
+            # This process has applied the change already, unless it has missed an earlier one.
+            if ids is not None and self._built and self._version == version - 1:
+                self._version = version
+
+    def _sync(self):
+        """
+        Apply the changes published by the other processes since the index
+        was last synchronized.
+        """
+        current = self._shared_version()
+        if current is None or current == self._version:
+            return
+        behind = current - self._version if self._version is not None else -1
+        changes = {}
+        if 0 < behind <= self.max_replay:
+            try:
+                changes = caches[self.cache_alias].get_many(
+                    [change_key(version) for version in range(self._version + 1, current + 1)])
+            except Exception:
+                logger.warning("cannot read the search index changes", exc_info=True)
+        # Too far behind, expired changes or a change without ids: start over.
+        if len(changes) != behind or any(ids is None for ids in changes.values()):
+            self.build()
+            return
+
+        ids = set()
+        for changed_ids in changes.values():
+            ids.update(changed_ids)
+        found = set()
+        rows = Product.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=ids).values_list("pk", *self.fields)
+        for pk, *values in rows:
+            self._remove(pk)
+            self._add(pk, dict(zip(self.fields, values)))
+            found.add(pk)
+        for pk in ids - found:
+            self._remove(pk)
+        self._version = current
+
+    def search(self, query, fields=None, limit=None):
+        fields = [field for field in (fields or self.fields) if field in self._postings]
+        tokens = tokenize(query)
+        if not tokens or not fields:
+            return []
+
+        with self._lock:
+            if not self._built:
+                self.build()
+            else:
+                self._sync()
+            scores = None
+            for token in dict.fromkeys(tokens):
+                token_scores = self._score_token(token, fields)
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {pk: score + token_scores[pk] for pk, score in scores.items() if pk in token_scores}
+                if not scores:
+                    return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [pk for pk, _ in ranked[: limit or self.max_results]]
+
+    def _add(self, pk, values):
+        terms = set()
+        for field in self.fields:
+            tokens = tokenize(values.get(field))
+            frequencies = defaultdict(int)
+            for token in tokens:
+                frequencies[token] += 1
+            for term, frequency in frequencies.items():
+                self._postings[field][term][pk] = frequency
+            self._doc_lengths[field][pk] = len(tokens)
+            self._total_lengths[field] += len(tokens)
+            terms.update(frequencies)
+
+        self._doc_terms[pk] = terms
+        for term in terms:
+            self._term_refs[term] += 1
+            if self._term_refs[term] == 1:
+                bisect.insort(self._vocabulary, term)
+                for gram in ngrams(term, self.ngram_size):
+                    self._grams[gram].add(term)
+
+    def _remove(self, pk):
+        terms = self._doc_terms.pop(pk, None)
+        if terms is None:
+            return
+        for field in self.fields:
+            self._total_lengths[field] -= self._doc_lengths[field].pop(pk, 0)
+            postings = self._postings[field]
+            for term in terms:
+                if pk in postings.get(term, ()):
+                    del postings[term][pk]
+                    if not postings[term]:
+                        del postings[term]
+
+        for term in terms:
+            self._term_refs[term] -= 1
+            if self._term_refs[term] == 0:
+                del self._term_refs[term]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, term)]
+                for gram in ngrams(term, self.ngram_size):
+                    self._grams[gram].discard(term)
+                    if not self._grams[gram]:
+                        del self._grams[gram]
+
+    def _expand(self, token):
+        """
+        Return the indexed terms matched by a query token with their boost.
+        """
+        matches = {}
+        vocabulary = self._vocabulary
+        position = bisect.bisect_left(vocabulary, token)
+        while position < len(vocabulary) and vocabulary[position].startswith(token):
+            term = vocabulary[position]
+            matches[term] = self.exact_boost if term == token else self.prefix_boost
+            position += 1
+
+        if len(token) >= self.ngram_size:
+            candidates = None
+            for gram in ngrams(token, self.ngram_size):
+                terms = self._grams.get(gram, set())
+                candidates = terms if candidates is None else candidates & terms
+                if not candidates:
+                    break
+            for term in candidates or ():
+                if term not in matches and token in term:
+                    matches[term] = self.ngram_boost
+        return matches
+
+    def _score_token(self, token, fields):
+        scores = defaultdict(float)
+        total_docs = self.size
+        for term, boost in self._expand(token).items():
+            for field in fields:
+                postings = self._postings[field].get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                average_length = self._total_lengths[field] / total_docs or 1
+                lengths = self._doc_lengths[field]
+                weight = self.field_weights.get(field, 1.0) * boost * idf
+                for pk, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * lengths[pk] / average_length)
+                    scores[pk] += weight * frequency * (self.k1 + 1) / (frequency + norm)
+        return scores
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_search_backend():
+    """
+    Return the process wide backend configured by `settings.PRODUCT_SEARCH`.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                config = getattr(settings, "PRODUCT_SEARCH", {})
+                backend_class = import_string(config.get("BACKEND", DEFAULT_BACKEND))
+                _backend = backend_class(**config.get("OPTIONS", {}))
+    return _backend
+
+
+def reset_search_backend():
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+def search_products(query=None, name=None):
+    """
+    Return the ids matching a free text `query` over all indexed fields and/or a
+    `name` query, best match first, or None when neither is given, and whether
+    they were cut at the `max_results` of the backend.
+    """
+    backend = get_search_backend()
+    ranked_ids, truncated = None, False
+    for text, fields in ((query, None), (name, ("name",))):
+        if not text:
+            continue
+        # One more than kept, to tell a cut list from one of exactly max_results.
+        ids = backend.search(text, fields=fields, limit=backend.max_results + 1)
+        if len(ids) > backend.max_results:
+            ids, truncated = ids[:backend.max_results], True
+        if ranked_ids is None:
+            ranked_ids = ids
+        else:
+            matched = set(ids)
+            ranked_ids = [pk for pk in ranked_ids if pk in matched]
+    return ranked_ids, truncated
@@ -0,0 +1,87 @@
+import random
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from property.domain import events
+from property.domain.services import cart_service, cache_service
+from property.models import Cart, CartItem, Product
+
+PRODUCT_PREFIX = "bench product"
+USER_PREFIX = "bench-user"
+BRANDS = 50
+
+
+def seed_products(count, batch_size=5000, seed=0):
+    """
+    Top the benchmark catalogue up to `count` products and return how many
+    were created. The rows are derived from their number, so a catalogue
+    seeded in several runs holds the same products as one seeded at once.
+    """
+    existing = Product.objects.filter(name__startswith=PRODUCT_PREFIX).count()
+    created = 0
+    for start in range(existing, count, batch_size):
+        products = [_product(number, seed) for number in range(start, min(start + batch_size, count))]
+        with transaction.atomic():
+            Product.objects.bulk_create(products)
+            events.products_changed.send(sender=Product, products=products, tags=sorted(
+                {cache_service.ALL_PRODUCTS_TAG}
+                | {f"category:{product.category}" for product in products}
+                | {f"brand:{product.brand}" for product in products}
+            ))
+        created += len(products)
+    return created
+
+
+def _product(number, seed):
+    rng = random.Random(seed * 1_000_003 + number)
+    return Product(
+        name=f"{PRODUCT_PREFIX} {number:07d}",
+        description=f"benchmark product number {number}",
+        price=Decimal(rng.randrange(100, 99_900)) / 100,
+        category=rng.choice(Product.CATEGORY_CHOICES)[0],
+        brand=f"brand{number % BRANDS}",
+        rating=round(rng.uniform(1, 5), 1),
+    )
+
+
+def seed_users(count, password):
+    """
+    Create the missing benchmark users, up to `count`, all with `password`
+    (hashed once), and return the users in a stable order.
+    """
+    User = get_user_model()
+    usernames = [f"{USER_PREFIX}-{number}" for number in range(count)]
+    existing = set(User.objects.filter(username__in=usernames).values_list("username", flat=True))
+    hashed = make_password(password)
+    User.objects.bulk_create(
+        [User(username=username, password=hashed) for username in usernames if username not in existing],
+        batch_size=1000,
+    )
+    users = User.objects.in_bulk(usernames, field_name="username")
+    return [users[username] for username in usernames]
+
+
+def seed_carts(users, items_per_cart=5, seed=0):
+    """
+    Give every user of `users` without a cart one with `items_per_cart`
+    benchmark products, return how many carts were created.
+    """
+    product_ids = list(Product.objects.filter(name__startswith=PRODUCT_PREFIX).values_list("pk", flat=True)[:10_000])
+    if not product_ids:
+        return 0
+    with_cart = set(Cart.objects.filter(user__in=users).values_list("user", flat=True))
+    carts = [Cart(user=user) for user in users if user.pk not in with_cart]
+    with transaction.atomic():
+        Cart.objects.bulk_create(carts, batch_size=1000)
+        carts = list(Cart.objects.filter(user__in=[cart.user for cart in carts]))
+        items = []
+        for cart in carts:
+            rng = random.Random(seed * 1_000_003 + cart.user_id)
+            for product_id in rng.sample(product_ids, min(items_per_cart, len(product_ids))):
+                items.append(CartItem(cart=cart, product_id=product_id, quantity=rng.randint(1, 3)))
+        CartItem.objects.bulk_create(items, batch_size=5000)
+        cart_service.refresh_cart_summaries(Cart.objects.filter(pk__in=[cart.pk for cart in carts]))
+    return len(carts)
@@ -1,9 +1,16 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
-from utils import producer
-import logger
 from property.domain import events
-from property.domain.services import todo_service
+from property.domain.services import (
+    cache_service, cart_service, cart_store, outbox_service, search_service, stats_service, todo_service
+)
+from property.models import CartItem, Product
+
+logger = logging.getLogger(__name__)
 
 
 @receiver(events.some_task_done)
@@ -11,4 +18,88 @@ def my_task_done(sender, task_id, **kwargs):
     logger.info(f"signal received: {sender}, {task_id}")
 
     todo_service.schedule_task()
-    producer.publish("quote_created", {"message": "user_created"})
+    outbox_service.enqueue("quote_created", {"message": "user_created"}, aggregate_type="task", aggregate_id=task_id)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    backend = search_service.get_search_backend()
+    transaction.on_commit(lambda: backend.index_product(instance))
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    backend = search_service.get_search_backend()
+    product_id = instance.pk
+    transaction.on_commit(lambda: backend.remove_product(product_id))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    # Invalidate right away and again once committed, so a response built from
+    # the pre-commit rows in between cannot outlive the transaction.
+    tags = cache_service.tags_for_product(instance)
+    cache_service.invalidate(tags)
+    transaction.on_commit(lambda: cache_service.invalidate(tags))
+
+
+@receiver(events.products_changed)
+def products_changed(sender, products=(), deleted_ids=(), tags=(), **kwargs):
+    backend = search_service.get_search_backend()
+
+    def update_index():
+        if any(product.pk is None for product in products):
+            backend.invalidate()
+            return
+        backend.update(products=products, deleted_ids=deleted_ids)
+
+    transaction.on_commit(update_index)
+    stats_service.refresh_groups(
+        stats_service.groups_from_tags(tags)
+        | {(dimension, getattr(product, dimension)) for product in products for dimension in stats_service.DIMENSIONS}
+    )
+    cache_service.invalidate(tags)
+    transaction.on_commit(lambda: cache_service.invalidate(tags))
+    product_ids = [product.pk for product in products if product.pk is not None]
+    if product_ids:
+        cart_service.refresh_product_carts(product_ids)
+    if product_ids or deleted_ids:
+        store = cart_store.get_cart_store()
+
+        def forget_cart_products():
+            for product_id in [*product_ids, *deleted_ids]:
+                store.product_changed(product_id)
+
+        transaction.on_commit(forget_cart_products)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def forget_cart_product(sender, instance, **kwargs):
+    store = cart_store.get_cart_store()
+    product_id = instance.pk
+    transaction.on_commit(lambda: store.product_changed(product_id))
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_carts(sender, instance, created, **kwargs):
+    loaded_values = getattr(instance, "_loaded_values", None)
+    if not created and (loaded_values is None or loaded_values.get("price") != instance.price):
+        cart_service.refresh_product_carts([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def count_saved_product(sender, instance, created, **kwargs):
+    stats_service.product_saved(instance, created)
+
+
+@receiver(post_delete, sender=Product)
+def count_deleted_product(sender, instance, **kwargs):
+    stats_service.product_deleted(instance)
+
+
+@receiver(post_save, sender=CartItem)
+@receiver(post_delete, sender=CartItem)
+def refresh_cart_summary(sender, instance, **kwargs):
+    cart_service.refresh_cart_summaries([instance.cart_id])
@@ -0,0 +1,183 @@
+"""
+Per category and per brand product statistics (`ProductStats`).
+
+A product write moves its count, rating and price between the rows of its
+old and new groups with relative UPDATEs in the transaction of the write,
+so they cost two small statements and no aggregate over `Product`. Only the
+price bounds of a group a product left are looked up again, with one
+`ORDER BY price LIMIT 1` per bound on the (category|brand, price) indexes.
+
+Bulk writes rebuild the groups they touched, and `reconcile` (the
+`reconcile_product_stats` task) rebuilds all of them to fix any drift, e.g.
+from writes made with `QuerySet.update()` which sends no signal.
+"""
+import math
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Count, F, Max, Min, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce, Greatest, Least
+from django.utils import timezone
+
+from property.models import Product, ProductStats
+
+DIMENSIONS = ("category", "brand")
+FIELDS = ("category", "brand", "price", "rating")
+STATS_FIELDS = ("product_count", "rating_sum", "price_sum", "price_min", "price_max")
+PRICE = ProductStats._meta.get_field("price_min")
+CENT = Decimal("0.01")
+
+
+def _values(product):
+    return {field: getattr(product, field) for field in FIELDS}
+
+
+def _change(changes, values, sign):
+    for dimension in DIMENSIONS:
+        change = changes[(dimension, values[dimension])]
+        change["count"] += sign
+        change["rating"] += sign * values["rating"]
+        change["price"] += sign * Decimal(str(values["price"]))
+        if sign > 0:
+            change["added_prices"].append(values["price"])
+        else:
+            change["removed"] = True
+
+
+def _new_changes():
+    return defaultdict(lambda: {"count": 0, "rating": 0.0, "price": Decimal(0), "added_prices": [], "removed": False})
+
+
+def product_saved(product, created):
+    loaded = {} if created else getattr(product, "_loaded_values", None) or {}
+    if not created and any(field not in loaded for field in FIELDS):
+        # Saved without having been loaded: its previous groups are unknown.
+        refresh_groups((dimension, getattr(product, dimension)) for dimension in DIMENSIONS)
+        return
+    new = _values(product)
+    if not created and all(loaded[field] == new[field] for field in FIELDS):
+        return
+    changes = _new_changes()
+    if not created:
+        _change(changes, {field: loaded[field] for field in FIELDS}, -1)
+    _change(changes, new, +1)
+    _apply(changes)
+
+
+def product_deleted(product):
+    changes = _new_changes()
+    _change(changes, _values(product), -1)
+    _apply(changes)
+
+
+def _apply(changes):
+    now = timezone.now()
+    for (dimension, value), change in changes.items():
+        updates = {
+            "product_count": F("product_count") + change["count"],
+            "rating_sum": F("rating_sum") + change["rating"],
+            "price_sum": F("price_sum") + change["price"],
+            "updated_at": now,
+        }
+        if change["removed"]:
+            prices = Product.objects.filter(**{dimension: value}).values("price")
+            updates["price_min"] = Subquery(prices.order_by("price")[:1], output_field=PRICE)
+            updates["price_max"] = Subquery(prices.order_by("-price")[:1], output_field=PRICE)
+        elif change["added_prices"]:
+            # Cast: SQLite binds decimals as text, which compares above any number.
+            low = Cast(Value(min(change["added_prices"])), PRICE)
+            high = Cast(Value(max(change["added_prices"])), PRICE)
+            updates["price_min"] = Coalesce(Least("price_min", low), low)
+            updates["price_max"] = Coalesce(Greatest("price_max", high), high)
+        stats = ProductStats.objects.filter(dimension=dimension, value=value)
+        if not stats.update(**updates):
+            ProductStats.objects.bulk_create([ProductStats(dimension=dimension, value=value)], ignore_conflicts=True)
+            stats.update(**updates)
+
+
+def groups_from_tags(tags):
+    """
+    The (dimension, value) groups named by response cache tags like "brand:x".
+    """
+    groups = set()
+    for tag in tags:
+        dimension, _, value = tag.partition(":")
+        if dimension in DIMENSIONS and value:
+            groups.add((dimension, value))
+    return groups
+
+
+def refresh_groups(groups):
+    """
+    Rebuild the statistics of `groups`, (dimension, value) pairs, from the
+    products, with one grouped query per dimension.
+    """
+    values = defaultdict(set)
+    for dimension, value in groups:
+        values[dimension].add(value)
+    return sum(_rebuild(dimension, group_values) for dimension, group_values in values.items())
+
+
+def reconcile():
+    """
+    Rebuild every group from the products and return how many were fixed.
+    """
+    return sum(_rebuild(dimension) for dimension in DIMENSIONS)
+
+
+def _rebuild(dimension, values=None):
+    products = Product.objects.order_by()
+    stats = ProductStats.objects.filter(dimension=dimension)
+    if values is not None:
+        products = products.filter(**{f"{dimension}__in": values})
+        stats = stats.filter(value__in=values)
+    actual = {}
+    for row in products.values(dimension).annotate(
+        product_count=Count("pk"), rating_sum=Sum("rating"), price_sum=Sum("price"),
+        price_min=Min("price"), price_max=Max("price"),
+    ):
+        # SQLite sums decimals as floats.
+        for name in ("price_sum", "price_min", "price_max"):
+            row[name] = row[name].quantize(CENT)
+        actual[row.pop(dimension)] = row
+    empty = {"product_count": 0, "rating_sum": 0.0, "price_sum": Decimal(0), "price_min": None, "price_max": None}
+    existing = {row.value: row for row in stats}
+
+    to_create, to_update = [], []
+    for value in actual.keys() | existing.keys():
+        row = actual.get(value, empty)
+        current = existing.get(value)
+        if current is None:
+            to_create.append(ProductStats(dimension=dimension, value=value, **row))
+        elif not _same(current, row):
+            for name in STATS_FIELDS:
+                setattr(current, name, row[name])
+            to_update.append(current)
+    now = timezone.now()
+    for row in to_update:
+        row.updated_at = now
+    ProductStats.objects.bulk_create(to_create, batch_size=1000, ignore_conflicts=True)
+    ProductStats.objects.bulk_update(to_update, [*STATS_FIELDS, "updated_at"], batch_size=1000)
+    return len(to_create) + len(to_update)
+
+
+def _same(stats, row):
+    return (
+        stats.product_count == row["product_count"]
+        and math.isclose(stats.rating_sum, row["rating_sum"] or 0.0, abs_tol=1e-6)
+        and stats.price_sum == (row["price_sum"] or 0)
+        and stats.price_min == row["price_min"]
+        and stats.price_max == row["price_max"]
+    )
+
+
+def get_stats(dimension=None, value=None):
+    """
+    The non empty groups, optionally of one dimension or one group.
+    """
+    stats = ProductStats.objects.filter(product_count__gt=0)
+    if dimension:
+        stats = stats.filter(dimension=dimension)
+    if value is not None:
+        stats = stats.filter(value=value)
+    return stats
@@ -1,27 +1,39 @@
+from django.http import StreamingHttpResponse
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_vary_headers
 from django_filters.rest_framework import DjangoFilterBackend
+from functools import partial
+
+from rest_framework.decorators import action
 from rest_framework.generics import RetrieveAPIView
 from rest_framework.mixins import CreateModelMixin
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from rest_framework.parsers import MultiPartParser
+from rest_framework.views import APIView
 import logging
-import redis
-from my_microservice import settings
 from rest_framework import viewsets, status
-from ..models import Product, Cart, CartItem
+from ..models import Product, Cart
 from rest_framework.filters import SearchFilter, OrderingFilter
 from rest_framework.permissions import IsAuthenticated
 from ..filters import ProductFilter
+from ..pagination import KeysetPaginationMixin
+from utils.db_router import ReplicaReadMixin
+from .services import (
+    bulk_service, cache_service, cart_store, export_service, facet_service, import_service, search_service,
+    stats_service,
+)
 from drf_yasg.utils import swagger_auto_schema
-# Connect to our Redis instance
 from ..serializers import (
     ProductSearchSerializer,
     ProductSerializer,
     CartSerializer,
-    CartItemSerializer)
+    CartBatchSerializer,
+    CartChangeSerializer,
+    CartDetailSerializer,
+    ProductStatsSerializer,
+    product_values)
 
-redis_instance = redis.StrictRedis(
-    host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=0
-)
 logger = logging.getLogger(__name__)
 
 
@@ -30,7 +42,20 @@ class CustomCreateModelMixin(CreateModelMixin):
         serializer.save(created_by=self.request.user)
 
 
-class ProductSearchView(RetrieveAPIView):
+class ProductCacheMixin:
+    cache_query_params = ('sort_by', 'limit', 'offset', 'pagination', 'cursor', 'count')
+
+    def get_cache_params(self, request, **params):
+        """
+        Everything a cached product response depends on besides the product rows.
+        """
+        for name in self.cache_query_params:
+            params.setdefault(name, request.query_params.get(name))
+        params['url'] = request.build_absolute_uri(request.path)
+        return params
+
+
+class ProductSearchView(ReplicaReadMixin, ProductCacheMixin, KeysetPaginationMixin, RetrieveAPIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = ProductSearchSerializer
     queryset = Product.objects.all()
@@ -42,148 +67,300 @@ class ProductSearchView(RetrieveAPIView):
     def get(self, request, format=None):
         serializer = ProductSearchSerializer(data=request.query_params)
         if serializer.is_valid():
-            queryset = Product.objects.all()
-
-            name = serializer.validated_data.get('name')
-            if name:
-                queryset = queryset.filter(name__icontains=name)
-
-            category = serializer.validated_data.get('category')
-            if category:
-                queryset = queryset.filter(category=category)
-
-            brand = serializer.validated_data.get('brand')
-            if brand:
-                queryset = queryset.filter(brand=brand)
-
-            min_price = serializer.validated_data.get('min_price')
-            max_price = serializer.validated_data.get('max_price')
-            if min_price and max_price:
-                queryset = queryset.filter(price__range=(min_price, max_price))
-
-            min_quantity = serializer.validated_data.get('min_quantity')
-            max_quantity = serializer.validated_data.get('max_quantity')
-            if min_quantity and max_quantity:
-                queryset = queryset.filter(quantity__range=(min_quantity, max_quantity))
-
-            created_at = serializer.validated_data.get('created_at')
-            if created_at:
-                queryset = queryset.filter(created_at=created_at)
-
-            rating = serializer.validated_data.get('rating')
-            if rating:
-                queryset = queryset.filter(rating=rating)
-
-            sort_by = self.request.query_params.get('sort_by')
-            if sort_by:
-                if sort_by and hasattr(Product, sort_by):
-                    queryset = queryset.order_by(sort_by)
-                else:
-                    return Response({"detail": "Invalid 'sort_by' field"}, status=status.HTTP_400_BAD_REQUEST)
-            else:
-                queryset = queryset.order_by('name')
+            validated_data = serializer.validated_data
+            return cache_service.cached_response(
+                'search',
+                self.get_cache_params(request, **validated_data),
+                cache_service.tags_for_filters(validated_data.get('category'), validated_data.get('brand')),
+                lambda: self.search(request, validated_data),
+            )
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            paginator = LimitOffsetPagination()
-            results = paginator.paginate_queryset(queryset, request)
+    def search(self, request, validated_data):
+        queryset = Product.objects.all()
 
-            serializer = ProductSerializer(results, many=True)
-            return paginator.get_paginated_response(serializer.data)
+        ranked_ids, truncated = search_service.search_products(
+            query=validated_data.get('q'),
+            name=validated_data.get('name'),
+        )
+        if ranked_ids is not None:
+            queryset = queryset.filter(pk__in=ranked_ids)
+
+        category = validated_data.get('category')
+        if category:
+            queryset = queryset.filter(category=category)
+
+        brand = validated_data.get('brand')
+        if brand:
+            queryset = queryset.filter(brand=brand)
+
+        min_price = validated_data.get('min_price')
+        max_price = validated_data.get('max_price')
+        if min_price and max_price:
+            queryset = queryset.filter(price__range=(min_price, max_price))
+
+        min_quantity = validated_data.get('min_quantity')
+        max_quantity = validated_data.get('max_quantity')
+        if min_quantity and max_quantity:
+            queryset = queryset.filter(quantity__range=(min_quantity, max_quantity))
+
+        created_at = validated_data.get('created_at')
+        if created_at:
+            queryset = queryset.filter(created_at=created_at)
+
+        rating = validated_data.get('rating')
+        if rating:
+            queryset = queryset.filter(rating=rating)
+
+        facets = facet_service.count_facets(queryset) if validated_data.get('facets') else None
+
+        sort_by = self.request.query_params.get('sort_by')
+        if sort_by:
+            if sort_by in Product.valid_sort_fields:
+                queryset = queryset.order_by(sort_by)
+            else:
+                return Response({"detail": "Invalid 'sort_by' field"}, status=status.HTTP_400_BAD_REQUEST)
+        elif ranked_ids is not None:
+            # Keep the relevance order of the index and only load the rows of the requested page.
+            matching_ids = set(queryset.values_list('pk', flat=True))
+            paginator = self.paginator
+            page_ids = paginator.paginate_queryset([pk for pk in ranked_ids if pk in matching_ids], request, view=self)
+            rows = {row['id']: row for row in product_values.values(Product.objects.filter(pk__in=page_ids))}
+            # A product deleted since the ids were read is left out of the page.
+            data = product_values.to_representation(rows[pk] for pk in page_ids if pk in rows)
+            return self.get_search_response(data, facets, ranked_ids, truncated)
         else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.order_by('name')
+
+        paginator = self.paginator
+        results = paginator.paginate_queryset(product_values.values(queryset), request, view=self)
+        return self.get_search_response(product_values.to_representation(results), facets, ranked_ids, truncated)
+
+    def get_search_response(self, data, facets, ranked_ids=None, truncated=False):
+        response = self.paginator.get_paginated_response(data)
+        if facets is not None:
+            response.data['facets'] = facets
+        if ranked_ids is not None:
+            # The text search keeps its best `max_results` matches, the count is then a lower bound.
+            response.data['truncated'] = truncated
+        return response
 
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(ReplicaReadMixin, ProductCacheMixin, KeysetPaginationMixin, viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated,)
+    replica_actions = ('list', 'retrieve')
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
 
+    def list(self, request, *args, **kwargs):
+        return cache_service.cached_response(
+            'product-list',
+            self.get_cache_params(request),
+            [cache_service.ALL_PRODUCTS_TAG],
+            partial(self.list_values, request),
+        )
+
+    def list_values(self, request):
+        """
+        `ListModelMixin.list` reading the page with `.values()` and `product_values`.
+        """
+        queryset = product_values.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(product_values.to_representation(page))
+        return Response(product_values.to_representation(queryset))
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs.get(self.lookup_field)
+        return cache_service.cached_response(
+            'product-detail',
+            self.get_cache_params(request, pk=pk),
+            [f'product:{pk}'],
+            partial(super().retrieve, request, *args, **kwargs),
+        )
+
+    @action(detail=False, methods=['post', 'patch', 'delete'])
+    def bulk(self, request):
+        """
+        Write a batch of products in one transaction: POST a list of products to create them, PATCH a
+        list of partial products with their `id` to update them, DELETE `{"ids": [...]}` to delete
+        them. An invalid batch writes nothing and answers 400 with the errors of each item.
+        """
+        try:
+            if request.method == 'POST':
+                products = bulk_service.create_products(request.data)
+                return Response({'created': len(products), 'ids': [product.pk for product in products]},
+                                status=status.HTTP_201_CREATED)
+            if request.method == 'PATCH':
+                products = bulk_service.update_products(request.data)
+                return Response({'updated': len(products), 'results': ProductSerializer(products, many=True).data})
+            ids = request.data.get('ids') if isinstance(request.data, dict) else None
+            return Response({'deleted': len(bulk_service.delete_products(ids))})
+        except bulk_service.BatchError as error:
+            return Response({'errors': error.errors}, status=status.HTTP_400_BAD_REQUEST)
+
     @swagger_auto_schema(query_serializer=ProductSerializer)
     def get_queryset(self):
         queryset = super().get_queryset()
         sort_by = self.request.query_params.get('sort_by')
         if sort_by:
-            if sort_by in ('name', 'category', 'brand', 'rating', 'price', 'quantity', 'created_at'):
+            if sort_by in Product.valid_sort_fields:
                 queryset = queryset.order_by(sort_by)
             else:
-                return Response({"detail": "Invalid 'sort_by' field"}, status=status.HTTP_400_BAD_REQUEST)
+                raise ValidationError({"detail": "Invalid 'sort_by' field"})
         else:
             queryset = queryset.order_by('name')
         return queryset
 
 
+class ProductCacheStatsView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, format=None):
+        """
+        Hit/miss counters of the product response cache in this process.
+        """
+        return Response(cache_service.stats.as_dict())
+
+
+class ProductStatsView(ReplicaReadMixin, APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @swagger_auto_schema(responses={200: ProductStatsSerializer(many=True)})
+    def get(self, request, format=None):
+        """
+        Product count, average rating and price range per category and brand, read from the
+        `ProductStats` rollup. Filter with `dimension` (category or brand) and `value`.
+        """
+        dimension = request.query_params.get('dimension')
+        if dimension and dimension not in stats_service.DIMENSIONS:
+            return Response({"detail": "Invalid 'dimension'"}, status=status.HTTP_400_BAD_REQUEST)
+        stats = stats_service.get_stats(dimension, request.query_params.get('value'))
+        return Response(ProductStatsSerializer(stats, many=True).data)
+
+
+class ProductImportView(APIView):
+    """
+    Bulk insert or update products from a CSV or JSONL file, either uploaded as
+    the `file` field of a multipart form or sent as the raw request body
+    (`text/csv`, `application/x-ndjson`). The file is parsed line by line and
+    written in chunks, the response is the import report.
+    """
+    permission_classes = (IsAuthenticated,)
+    parser_classes = (MultiPartParser,)
+
+    def post(self, request, format=None):
+        file_format = request.query_params.get('type')
+        if request.content_type.startswith('multipart/'):
+            upload = request.FILES.get('file')
+            if upload is None:
+                raise ValidationError({'file': ['No file was submitted.']})
+            lines = upload
+            file_format = file_format or import_service.guess_format(upload.name, upload.content_type)
+        else:
+            lines = iter(request.stream.readline, b'') if request.stream is not None else ()
+            file_format = file_format or import_service.guess_format(content_type=request.content_type)
+        if file_format not in import_service.FORMATS:
+            raise ValidationError({'type': [f"Expected one of {', '.join(import_service.FORMATS)}."]})
+
+        try:
+            chunk_size = min(int(request.query_params.get('chunk_size', import_service.CHUNK_SIZE)), 10000)
+        except ValueError:
+            raise ValidationError({'chunk_size': ['A valid integer is required.']})
+        report = import_service.import_products(
+            import_service.iter_rows(lines, file_format), chunk_size=max(chunk_size, 1))
+        summary = report.as_dict()
+        logger.info("imported %s products (%s created, %s updated, %s failed) in %ss",
+                    summary['rows'], summary['created'], summary['updated'], summary['failed'], summary['seconds'])
+        return Response(summary)
+
+
+class ProductExportView(APIView):
+    """
+    Stream the products matching the `ProductFilter` query parameters as JSONL
+    (default) or CSV (`?type=csv`), in one response read from a database
+    cursor. The body is gzipped when the client accepts it.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, format=None):
+        file_format = request.query_params.get('type', 'jsonl')
+        if file_format not in export_service.FORMATS:
+            raise ValidationError({'type': [f"Expected one of {', '.join(export_service.FORMATS)}."]})
+        filterset = ProductFilter(request.query_params, queryset=Product.objects.all(), request=request)
+        if not filterset.is_valid():
+            raise ValidationError(filterset.errors)
+
+        compress = bool(re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+        response = StreamingHttpResponse(
+            export_service.export_products(filterset.qs, file_format, compress=compress),
+            content_type=export_service.CONTENT_TYPES[file_format],
+        )
+        response['Content-Disposition'] = f'attachment; filename="products.{file_format}"'
+        if compress:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+
 class CartViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated,)
     queryset = Cart.objects.all()
     serializer_class = CartSerializer
 
+    @property
+    def store(self):
+        return cart_store.get_cart_store()
+
     def get_serializer_class(self):
         if self.action == 'list':
-            return CartItemSerializer
+            return CartDetailSerializer
+        if self.action == 'batch':
+            return CartBatchSerializer
         return self.serializer_class
 
     @swagger_auto_schema(query_serializer=CartSerializer)
     def list(self, request):
         """
-        Retrieve the cart and its items of the authenticated user.
+        Retrieve the cart of the authenticated user with its items, their
+        products and the cart totals, read in one query.
         """
-        user_cart = Cart.objects.filter(user=request.user)
-        if user_cart.exists():
-            cart_items = CartItem.objects.filter(cart=user_cart.first())
-            serializer = CartItemSerializer(cart_items, many=True)
-            return Response(serializer.data)
-        else:
+        return self.cart_response(request)
+
+    def cart_response(self, request):
+        cart = self.store.get_cart_detail(request.user)
+        if cart is None:
             return Response({"detail": "Cart not found for user"})
+        return Response(CartDetailSerializer(cart).data)
 
-    @swagger_auto_schema(query_serializer=CartItemSerializer)
+    @swagger_auto_schema(query_serializer=CartChangeSerializer)
     def create(self, request, format=None):
         """
-        Add a product to the cart of the authenticated user.
+        Add a product to the cart of the authenticated user, adding to its
+        quantity when it is already there. Returns the updated cart.
         """
-        product_id = request.query_params.get('product')
-        quantity = request.query_params.get('quantity', 1)
+        serializer = CartChangeSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
         try:
-            product = Product.objects.get(id=product_id)
+            self.store.add_item(request.user, serializer.validated_data['product'],
+                                serializer.validated_data['quantity'])
         except Product.DoesNotExist:
             return Response({"detail": "Product not found"})
+        return self.cart_response(request)
 
-        user_cart = Cart.objects.filter(user=request.user)
-        if user_cart.exists():
-            cart = user_cart.first()
-        else:
-            cart = Cart.objects.create(user=request.user)
-
-        cart_item = CartItem.objects.create(
-            cart=cart,
-            product=product,
-            quantity=quantity
-        )
-        serializer = CartItemSerializer(cart_item)
-        return Response(serializer.data)
-
-    @swagger_auto_schema(query_serializer=CartItemSerializer)
+    @swagger_auto_schema(query_serializer=CartChangeSerializer)
     def update(self, request, pk, format=None):
         """
-        Update the quantity of a cart item for the authenticated user.
+        Update the quantity of a cart item for the authenticated user,
+        removing it at 0.
         """
-        product_id = request.query_params.get('product')
-        quantity = request.query_params.get('quantity', 1)
-        try:
-            product = Product.objects.get(id=product_id)
-        except Product.DoesNotExist:
-            return Response({"detail": "Product not found"})
-
-        user_cart = Cart.objects.filter(user=request.user)
-        if user_cart.exists():
-            cart = user_cart.first()
-            cart_item = CartItem.objects.filter(cart=cart, product=product)
-            if cart_item.exists():
-                cart_item.update(quantity=quantity)
-                serializer = CartItemSerializer(cart_item.first())
-                return Response(serializer.data)
-            else:
-                return Response({"detail": "Item not found in cart"})
-        else:
-            return Response({"detail": "Cart not found for user"})
+        serializer = CartChangeSerializer(data={**request.query_params.dict(), 'op': 'set'})
+        serializer.is_valid(raise_exception=True)
+        if not self.store.set_item_quantity(request.user, serializer.validated_data['product'],
+                                            serializer.validated_data['quantity']):
+            return Response({"detail": "Item not found in cart"})
+        return self.cart_response(request)
 
     @swagger_auto_schema(query_serializer=CartSerializer)
     def destroy(self, request, pk, format=None):
@@ -194,18 +371,24 @@ class CartViewSet(viewsets.ModelViewSet):
         if not user == str(request.user.id):
             return Response('Not allowed')
         try:
-            product = Product.objects.get(id=pk)
-        except Product.DoesNotExist:
+            product_id = int(pk)
+        except ValueError:
             return Response({"detail": "Product not found"})
+        if not self.store.remove_item(request.user, product_id):
+            return Response({"detail": "Product not found in cart"})
+        return Response({"detail": "Product removed from cart"})
 
-        user_cart = Cart.objects.filter(user=request.user)
-        if user_cart.exists():
-            cart = user_cart.first()
-            try:
-                cart_item = CartItem.objects.get(cart=cart, product=product)
-                cart_item.delete()
-                return Response({"detail": "Product removed from cart"})
-            except CartItem.DoesNotExist:
-                return Response({"detail": "Product not found in cart"})
-        else:
-            return Response({"detail": "Cart not found for user"})
+    @swagger_auto_schema(request_body=CartBatchSerializer)
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Apply a list of add/set/remove changes to the cart of the
+        authenticated user in one transaction. Returns the updated cart.
+        """
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            self.store.apply_changes(request.user, serializer.validated_data['changes'])
+        except Product.DoesNotExist as error:
+            return Response({"detail": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        return self.cart_response(request)
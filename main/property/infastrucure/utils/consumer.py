@@ -1,27 +1,35 @@
-import json
 import pika
 import logging
 
-logger = logging.getLogger(__name__)
-
+from utils import envelope, routing
 
-connection = pika.BlockingConnection(
-    pika.ConnectionParameters(
-        "rabbitmq", 5672, "/", pika.PlainCredentials("guest", "guest")
-    )
-)
-channel = connection.channel()
-channel.queue_declare(queue="likes")
+logger = logging.getLogger(__name__)
 
 
 def callback(ch, method, properties, body):
-    print("Received in likes...")
+    print("Received event...")
     print(body)
-    data = json.loads(body)
-    print(data)
+    message = envelope.decode(properties, body)
+    print(message, message.payload)
+
+
+def main():
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(
+            "rabbitmq", 5672, "/", pika.PlainCredentials("guest", "guest")
+        )
+    )
+    channel = connection.channel()
+    routing.declare(channel)
+    # A temporary queue receiving a copy of every event, for debugging.
+    queue = channel.queue_declare(queue="", exclusive=True).method.queue
+    channel.queue_bind(queue=queue, exchange=routing.EXCHANGE, routing_key="#")
+
+    channel.basic_consume(queue=queue, on_message_callback=callback, auto_ack=True)
+    logging.info("Started Consuming...")
+    print("Started Consuming...")
+    channel.start_consuming()
 
 
-channel.basic_consume(queue="likes", on_message_callback=callback, auto_ack=True)
-logging.info("Started Consuming...")
-print("Started Consuming...")
-channel.start_consuming()
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,5 @@
-import json
-import pika
-
-
-def publish(method, body):
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(
-            "rabbitmq", 5672, "/", pika.PlainCredentials("guest", "guest")
-        )
-    )
-    channel = connection.channel()
-    properties = pika.BasicProperties(method)
-    channel.basic_publish(
-        exchange="", routing_key="likes", body=json.dumps(body), properties=properties
-    )
+"""
+The publisher of this service lives in `utils.producer`, this module only
+re-exports it for the imports of the old location.
+"""
+from utils.producer import CONNECTION_PARAMETERS, Publisher, publish, publisher  # noqa: F401
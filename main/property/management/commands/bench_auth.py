@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+
+from property.domain.services import seed_service
+from user import authentication
+from utils import benchmark
+
+
+class Command(BaseCommand):
+    help = "Compare the stock JWT authentication with the cached one, on the same token, per batch of requests."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=1000, help="Authentications per run.")
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        user, = seed_service.seed_users(1, "bench-password")
+        request = APIRequestFactory().get("/", HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+        stock, cached = JWTAuthentication(), authentication.CachedJWTAuthentication()
+        calls = range(options["calls"])
+
+        def cold():
+            for _ in calls:
+                authentication.tokens.clear()
+                authentication.users.clear()
+                cached.authenticate(request)
+
+        self.stdout.write(f"{options['calls']} authentications per run, {options['repeat']} runs")
+        self.stdout.write(benchmark.format_table(benchmark.compare([
+            ("JWTAuthentication", lambda: [stock.authenticate(request) for _ in calls]),
+            ("cached, cold", cold),
+            ("cached, hot", lambda: [cached.authenticate(request) for _ in calls]),
+        ], repeat=options["repeat"])))
@@ -0,0 +1,55 @@
+import json
+
+import pika
+from django.core.management.base import BaseCommand
+
+from utils import benchmark, envelope
+
+
+def sample_payloads(rows):
+    return {
+        "quote_created": {"message": "user_created"},
+        "products_changed": {"action": "updated", "ids": list(range(rows)), "count": rows},
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare the encode/decode cost and size of the event envelope codecs with the plain JSON messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100, help="Product ids in the large sample event.")
+        parser.add_argument("--messages", type=int, default=1000, help="Messages encoded per measured run.")
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        codecs = ["json"]
+        try:
+            envelope.get_codec("msgpack").msgpack
+            codecs.append("msgpack")
+        except RuntimeError as exc:
+            self.stderr.write(f"skipping msgpack: {exc}")
+
+        count, repeat = options["messages"], options["repeat"]
+        for event, payload in sample_payloads(options["rows"]).items():
+            legacy = (json.dumps(payload), pika.BasicProperties(event))
+            encoded = {}
+            for codec in codecs:
+                body, arguments = envelope.encode(envelope.Envelope(event, payload), codec)
+                encoded[codec] = (body, pika.BasicProperties(**arguments))
+
+            self.stdout.write(f"\n{event}, {count} messages, {repeat} runs")
+            self.stdout.write(f"body bytes: plain json {len(legacy[0].encode())}, " + ", ".join(
+                f"{codec} {len(body)}" for codec, (body, _) in encoded.items()))
+            self.stdout.write(benchmark.format_table(benchmark.compare([
+                ("plain json encode", lambda: [(json.dumps(payload), pika.BasicProperties(event))
+                                               for _ in range(count)]),
+                *((f"{codec} encode", lambda codec=codec: [
+                    pika.BasicProperties(**envelope.encode(envelope.Envelope(event, payload), codec)[1])
+                    for _ in range(count)]) for codec in codecs),
+            ], repeat=repeat)))
+            self.stdout.write(benchmark.format_table(benchmark.compare([
+                ("plain json decode", lambda: [json.loads(legacy[0]) for _ in range(count)]),
+                *((f"{codec} decode", lambda body=body, properties=properties: [
+                    envelope.decode(properties, body) for _ in range(count)])
+                  for codec, (body, properties) in encoded.items()),
+            ], repeat=repeat)))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from property.models import Product
+from property.serializers import ProductSerializer, product_values
+from utils import benchmark
+
+
+class Command(BaseCommand):
+    help = "Compare the ModelSerializer and the .values() fast path on a product list page."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000, help="Products per page.")
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        queryset = Product.objects.order_by("name")[:options["rows"]]
+        if not queryset.exists():
+            raise CommandError("No products to serialize, load some with import_products first.")
+        renderer = JSONRenderer()
+        instances = list(queryset)
+        rows = list(product_values.values(queryset))
+        if renderer.render(ProductSerializer(instances, many=True).data) != renderer.render(
+                product_values.to_representation(rows)):
+            raise CommandError("The fast path output differs from ProductSerializer.")
+        count, repeat = len(instances), options["repeat"]
+
+        self.stdout.write(f"{count} products, serialize only, {repeat} runs")
+        self.stdout.write(benchmark.format_table(benchmark.compare([
+            ("ModelSerializer", lambda: ProductSerializer(instances, many=True).data),
+            ("ValuesSerializer", lambda: product_values.to_representation(rows)),
+        ], repeat=repeat)))
+        self.stdout.write(f"\n{count} products, fetch + serialize + render, {repeat} runs")
+        self.stdout.write(benchmark.format_table(benchmark.compare([
+            ("ModelSerializer", lambda: renderer.render(ProductSerializer(queryset.all(), many=True).data)),
+            ("ValuesSerializer", lambda: renderer.render(product_values.serialize(queryset))),
+        ], repeat=repeat)))
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils import benchmark
+
+
+class Command(BaseCommand):
+    help = ("Measure the cold start of `manage.py check` and of the WSGI application in fresh interpreters, "
+            "next to a bare django.setup().")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        env = {**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE",
+                                                                         "my_microservice.settings")}
+
+        def run(*arguments):
+            return lambda: subprocess.run([sys.executable, *arguments], cwd=settings.BASE_DIR, env=env, check=True,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        self.stdout.write(f"cold start, {options['repeat']} runs")
+        self.stdout.write(benchmark.format_table(benchmark.compare([
+            ("django.setup()", run("-c", "import django; django.setup()")),
+            ("manage.py check", run("manage.py", "check")),
+            ("wsgi application", run("-c", "import my_microservice.wsgi")),
+        ], repeat=options["repeat"], warmup=1)))
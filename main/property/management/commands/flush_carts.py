@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from property.domain.services.cart_store import RedisCartStore, get_cart_store
+
+
+class Command(BaseCommand):
+    help = "Write the pending cart changes of the cart store to the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true",
+                            help="Then drop the carts from Redis so they are reloaded from the database.")
+
+    def handle(self, *args, **options):
+        store = get_cart_store()
+        self.stdout.write(f"Flushed {store.flush()} carts")
+        if options["rebuild"]:
+            if not isinstance(store, RedisCartStore):
+                self.stdout.write("The cart store does not keep carts in Redis, nothing to rebuild")
+                return
+            self.stdout.write(f"Dropped {store.rebuild()} keys, carts will be reloaded from the database")
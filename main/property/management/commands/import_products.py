@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from property.domain.services import import_service
+
+
+class Command(BaseCommand):
+    help = "Bulk insert or update products from a CSV or JSONL file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", dest="file_format", choices=import_service.FORMATS,
+                            help="File format, guessed from the file extension by default.")
+        parser.add_argument("--chunk-size", type=int, default=import_service.CHUNK_SIZE,
+                            help="Number of rows validated and written per transaction.")
+
+    def handle(self, *args, **options):
+        file_format = options["file_format"] or import_service.guess_format(options["path"])
+        if file_format is None:
+            raise CommandError("Cannot tell the file format, pass --format.")
+
+        def progress(report):
+            self.stdout.write(f"{report.rows} rows, {report.created} created, {report.updated} updated, "
+                              f"{report.failed} failed")
+
+        with open(options["path"], "rb") as lines:
+            report = import_service.import_products(
+                import_service.iter_rows(lines, file_format), chunk_size=options["chunk_size"], progress=progress
+            )
+        summary = report.as_dict()
+        for error in summary["errors"]:
+            self.stderr.write(f"row {error['row']}: {error['errors']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {summary['rows']} rows in {summary['seconds']}s ({summary['rows_per_second']} rows/s): "
+            f"{summary['created']} created, {summary['updated']} updated, {summary['failed']} failed"
+        ))
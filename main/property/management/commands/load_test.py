@@ -0,0 +1,38 @@
+import urllib.error
+import urllib.request
+
+from django.core.management.base import BaseCommand
+
+from utils import benchmark
+
+
+class Command(BaseCommand):
+    help = ("Send concurrent GET requests to running servers and report throughput and latency per URL, "
+            "e.g. a sync endpoint under WSGI and its async/ version under ASGI.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("urls", nargs="+")
+        parser.add_argument("--concurrency", type=int, default=64, help="Requests in flight.")
+        parser.add_argument("--requests", type=int, default=2000, help="Requests per URL.")
+        parser.add_argument("--token", help="JWT access token sent as a Bearer authorization.")
+        parser.add_argument("--timeout", type=float, default=30)
+
+    def handle(self, *args, **options):
+        headers = {"Authorization": f"Bearer {options['token']}"} if options["token"] else {}
+
+        def fetch(url):
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                            timeout=options["timeout"]) as response:
+                    response.read()
+                    return response.status == 200
+            except (urllib.error.URLError, OSError):
+                return False
+
+        self.stdout.write(f"{options['requests']} requests per URL, {options['concurrency']} concurrent")
+        self.stdout.write(f"{'url':<48} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for url in options["urls"]:
+            result = benchmark.run_load(lambda: lambda: fetch(url), options["requests"], options["concurrency"])
+            self.stdout.write(
+                f"{url[-48:]:<48} {result['throughput']:>8.1f} {result['p50_ms']:>8.1f} "
+                f"{result['p90_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['errors']:>7}")
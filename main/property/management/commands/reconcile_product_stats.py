@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from property.domain.services import stats_service
+
+TASK = "property.domain.Tasks.reconcile_product_stats"
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per category and brand product statistics from the products."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--schedule", type=int, metavar="MINUTES",
+                            help="Instead, (re)register the django_q schedule running it every MINUTES.")
+
+    def handle(self, *args, **options):
+        if options["schedule"]:
+            from django_q.models import Schedule
+
+            Schedule.objects.update_or_create(name="reconcile_product_stats", defaults={
+                "func": TASK, "schedule_type": Schedule.MINUTES, "minutes": options["schedule"], "repeats": -1,
+            })
+            self.stdout.write(f"{TASK} scheduled every {options['schedule']} minutes")
+            return
+        self.stdout.write(f"Reconciled {stats_service.reconcile()} groups")
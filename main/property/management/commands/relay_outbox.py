@@ -0,0 +1,51 @@
+import logging
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from property.domain.services import outbox_service
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Publish the outbox events to RabbitMQ in batches until stopped."
+
+    def add_arguments(self, parser):
+        config = outbox_service.get_config()
+        parser.add_argument("--batch-size", type=int, default=config["BATCH_SIZE"],
+                            help="Events published per broker transaction.")
+        parser.add_argument("--interval", type=float, default=config["POLL_INTERVAL"],
+                            help="Seconds to wait when the outbox is empty.")
+        parser.add_argument("--once", action="store_true", help="Drain the outbox once and exit.")
+
+    def handle(self, *args, **options):
+        stopping = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stopping.set())
+
+        batch_size, interval = options["batch_size"], options["interval"]
+        failures = 0
+        last_purge = 0
+        while not stopping.is_set():
+            try:
+                published = outbox_service.relay_batch(batch_size)
+            except Exception:
+                failures += 1
+                delay = min(interval * 2 ** failures, 30)
+                logger.exception("outbox relay failed, retrying in %ss", delay)
+                stopping.wait(delay)
+                continue
+            failures = 0
+            if published:
+                logger.info("published %s outbox events", published)
+            if published == batch_size:
+                continue
+            if options["once"]:
+                break
+            if time.monotonic() - last_purge > 3600:
+                outbox_service.purge_published()
+                last_purge = time.monotonic()
+            stopping.wait(interval)
@@ -0,0 +1,196 @@
+import itertools
+import json
+import platform
+import random
+import time
+from contextlib import ExitStack
+
+import django
+from django.conf import settings
+from django.db import connection, connections
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from property.domain.services import seed_service
+from property.models import Product
+from utils import benchmark
+
+PASSWORD = "bench-password"
+SCENARIOS = ("jwt_auth", "search", "product_list", "cart_add", "cart_list")
+CACHE_MODES = ("none", "locmem", "configured")
+METRICS = ("throughput", "p50_ms", "p99_ms")
+
+
+class Command(BaseCommand):
+    help = ("Seed a benchmark catalogue and measure the latency and throughput of the main endpoints at "
+            "several concurrency levels, in process (no server, no network). Results are written as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=10_000, help="Size of the catalogue (topped up).")
+        parser.add_argument("--users", type=int, default=100, help="Users, each with a cart.")
+        parser.add_argument("--items-per-cart", type=int, default=5)
+        parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and concurrency.")
+        parser.add_argument("--concurrency", default="1,8,32", help="Comma separated concurrency levels.")
+        parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+        parser.add_argument("--cache", choices=CACHE_MODES, default="none",
+                            help="none: local cache, product response cache off (measures the database path); "
+                                 "locmem: local cache, response cache on; configured: the settings as they are.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="JSON result file, benchmark-<timestamp>.json by default.")
+        parser.add_argument("--compare", help="A previous JSON result to compare with.")
+
+    def handle(self, *args, **options):
+        scenarios = options["scenarios"].split(",")
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"unknown scenarios: {', '.join(sorted(unknown))}")
+        levels = [int(level) for level in options["concurrency"].split(",")]
+
+        with ExitStack() as stack:
+            # The in process client requests "testserver", DEBUG would record every query.
+            stack.enter_context(override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"], DEBUG=False,
+            ))
+            if options["cache"] != "configured":
+                stack.enter_context(override_settings(
+                    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+                ))
+            if options["cache"] == "none":
+                stack.enter_context(override_settings(PRODUCT_CACHE={"ENABLED": False}))
+            report = self.run(options, scenarios, levels)
+
+        output = options["output"] or f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+        self.stdout.write(self.format_results(report["results"]))
+        if options["compare"]:
+            with open(options["compare"]) as file:
+                self.stdout.write("\n" + self.format_comparison(json.load(file)["results"], report["results"]))
+        self.stdout.write(f"\nresults written to {output}")
+
+    def run(self, options, scenarios, levels):
+        started = time.time()
+        self.stdout.write(f"seeding {options['products']} products, {options['users']} users and carts...")
+        seed_service.seed_products(options["products"], seed=options["seed"])
+        users = seed_service.seed_users(options["users"], PASSWORD)
+        seed_service.seed_carts(users, options["items_per_cart"], seed=options["seed"])
+        tokens = [str(RefreshToken.for_user(user).access_token) for user in users]
+        product_ids = list(Product.objects.filter(name__startswith=seed_service.PRODUCT_PREFIX)
+                           .values_list("pk", flat=True)[:10_000])
+
+        # Every thread of every run draws its requests from its own generator, derived from --seed.
+        numbers = itertools.count()
+
+        def new_rng():
+            return random.Random(options["seed"] * 1_000_003 + next(numbers))
+
+        results = []
+        for scenario in scenarios:
+            for level in levels:
+                self.stdout.write(f"{scenario} at concurrency {level}...")
+                make_call = getattr(self, f"make_{scenario}")(users, tokens, product_ids, new_rng)
+                result = benchmark.run_load(make_call, options["requests"], level,
+                                            on_thread_exit=connections.close_all)
+                results.append({"scenario": scenario, **result})
+
+        return {
+            "started_at": started,
+            "duration_s": round(time.time() - started, 3),
+            "environment": {
+                "database": connection.vendor,
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "machine": platform.machine(),
+                "cache": options["cache"],
+            },
+            "catalogue": {
+                "products": Product.objects.filter(name__startswith=seed_service.PRODUCT_PREFIX).count(),
+                "users": len(users),
+                "items_per_cart": options["items_per_cart"],
+            },
+            "results": results,
+        }
+
+    # Each make_* returns the per thread factory of the scenario's request function.
+
+    def make_jwt_auth(self, users, tokens, product_ids, new_rng):
+        def make_call():
+            client, rng = APIClient(), new_rng()
+            url = reverse("token_obtain_pair")
+            return lambda: client.post(url, {"username": rng.choice(users).username, "password": PASSWORD},
+                                       format="json").status_code == 200
+        return make_call
+
+    def _client(self, tokens, rng):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {rng.choice(tokens)}")
+        return client
+
+    def make_search(self, users, tokens, product_ids, new_rng):
+        def make_call():
+            rng = new_rng()
+            client = self._client(tokens, rng)
+            url = reverse("product-search")
+            categories = [choice for choice, _ in Product.CATEGORY_CHOICES]
+
+            def call():
+                params = {"brand": f"brand{rng.randrange(seed_service.BRANDS)}",
+                          "sort_by": rng.choice(Product.valid_sort_fields)}
+                if rng.random() < 0.5:
+                    params["category"] = rng.choice(categories)
+                return client.get(url, params).status_code == 200
+            return call
+        return make_call
+
+    def make_product_list(self, users, tokens, product_ids, new_rng):
+        def make_call():
+            rng = new_rng()
+            client = self._client(tokens, rng)
+            url = reverse("product-list")
+            return lambda: client.get(url, {"sort_by": rng.choice(Product.valid_sort_fields),
+                                            "offset": rng.randrange(100) * 10}).status_code == 200
+        return make_call
+
+    def make_cart_add(self, users, tokens, product_ids, new_rng):
+        def make_call():
+            rng = new_rng()
+            client = self._client(tokens, rng)
+            url = reverse("cart-list")
+            return lambda: client.post(
+                f"{url}?product={rng.choice(product_ids)}&quantity=1").status_code in (200, 201)
+        return make_call
+
+    def make_cart_list(self, users, tokens, product_ids, new_rng):
+        def make_call():
+            client = self._client(tokens, new_rng())
+            url = reverse("cart-list")
+            return lambda: client.get(url).status_code == 200
+        return make_call
+
+    def format_results(self, results):
+        lines = [f"{'scenario':<14} {'conc':>5} {'req/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'errors':>7}"]
+        for row in results:
+            lines.append(f"{row['scenario']:<14} {row['concurrency']:>5} {row['throughput']:>9.1f} "
+                         f"{row['p50_ms']:>9.2f} {row['p90_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['errors']:>7}")
+        return "\n".join(lines)
+
+    def format_comparison(self, previous, current):
+        """
+        Ratio of every metric to the previous run, > 1 is better.
+        """
+        before = {(row["scenario"], row["concurrency"]): row for row in previous}
+        lines = [f"{'scenario':<14} {'conc':>5} " + " ".join(f"{metric:>12}" for metric in METRICS)]
+        for row in current:
+            old = before.get((row["scenario"], row["concurrency"]))
+            if old is None:
+                continue
+            ratios = [
+                row["throughput"] / old["throughput"] if old["throughput"] else None,
+                *(old[metric] / row[metric] if row[metric] else None for metric in METRICS[1:]),
+            ]
+            lines.append(f"{row['scenario']:<14} {row['concurrency']:>5} " + " ".join(
+                f"{ratio:>11.2f}x" if ratio else f"{'-':>12}" for ratio in ratios))
+        return "\n".join(lines)
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:57
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_cart_summaries(apps, schema_editor):
+    Cart = apps.get_model('property', 'Cart')
+    CartItem = apps.get_model('property', 'CartItem')
+    money = models.DecimalField(max_digits=12, decimal_places=2)
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    count = items.annotate(total=Sum('quantity')).values('total')
+    subtotal = items.annotate(
+        total=Sum(ExpressionWrapper(F('quantity') * F('product__price'), output_field=money))
+    ).values('total')
+    Cart.objects.update(
+        item_count=Coalesce(Subquery(count), 0),
+        subtotal=Coalesce(Subquery(subtotal, output_field=money), Value(Decimal('0')), output_field=money),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('property', '0003_product_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(fill_cart_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:59
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, ExpressionWrapper, F, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def merge_duplicates(apps, schema_editor):
+    """
+    Keep one cart per user and one item per product in a cart, so the
+    constraints can be created: items of later carts move to the first one
+    and duplicate items are merged into the first with their summed quantity.
+    """
+    Cart = apps.get_model('property', 'Cart')
+    CartItem = apps.get_model('property', 'CartItem')
+
+    duplicate_users = Cart.objects.values('user').annotate(carts=Count('id')).filter(carts__gt=1)
+    for user_id in duplicate_users.values_list('user', flat=True):
+        first, *others = Cart.objects.filter(user_id=user_id).order_by('pk').values_list('pk', flat=True)
+        CartItem.objects.filter(cart_id__in=others).update(cart_id=first)
+        Cart.objects.filter(pk__in=others).delete()
+
+    duplicate_items = (
+        CartItem.objects.values('cart', 'product')
+        .annotate(items=Count('id'), total=Sum('quantity'), keep=Min('id'))
+        .filter(items__gt=1)
+    )
+    for row in duplicate_items:
+        CartItem.objects.filter(pk=row['keep']).update(quantity=row['total'])
+        CartItem.objects.filter(cart_id=row['cart'], product_id=row['product']).exclude(pk=row['keep']).delete()
+
+    money = models.DecimalField(max_digits=12, decimal_places=2)
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    count = items.annotate(total=Sum('quantity')).values('total')
+    subtotal = items.annotate(
+        total=Sum(ExpressionWrapper(F('quantity') * F('product__price'), output_field=money))
+    ).values('total')
+    Cart.objects.update(
+        item_count=Coalesce(Subquery(count), 0),
+        subtotal=Coalesce(Subquery(subtotal, output_field=money), Value(Decimal('0')), output_field=money),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('property', '0004_cart_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('user',), name='cart_unique_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='cart_item_unique_product'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('property', '0005_cart_unique_items'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('aggregate_type', models.CharField(max_length=64)),
+                ('aggregate_id', models.CharField(max_length=64)),
+                ('event_type', models.CharField(max_length=64)),
+                ('payload', models.JSONField()),
+                ('routing_key', models.CharField(default='likes', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('published_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboxevent',
+            index=models.Index(fields=['published_at', 'id'], name='outbox_pending_idx'),
+        ),
+    ]
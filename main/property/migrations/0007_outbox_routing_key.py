@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('property', '0006_outbox_event'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboxevent',
+            name='routing_key',
+            field=models.CharField(max_length=255),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:29
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+
+
+def fill_product_stats(apps, schema_editor):
+    Product = apps.get_model('property', 'Product')
+    ProductStats = apps.get_model('property', 'ProductStats')
+    for dimension in ('category', 'brand'):
+        rows = Product.objects.order_by().values(dimension).annotate(
+            product_count=Count('pk'), rating_sum=Sum('rating'), price_sum=Sum('price'),
+            price_min=Min('price'), price_max=Max('price'),
+        )
+        ProductStats.objects.bulk_create(
+            [ProductStats(dimension=dimension, value=row.pop(dimension), **row) for row in rows], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('property', '0007_outbox_routing_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('category', 'Category'), ('brand', 'Brand')], max_length=16)),
+                ('value', models.CharField(max_length=255)),
+                ('product_count', models.IntegerField(default=0)),
+                ('rating_sum', models.FloatField(default=0)),
+                ('price_sum', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('price_min', models.DecimalField(decimal_places=2, max_digits=5, null=True)),
+                ('price_max', models.DecimalField(decimal_places=2, max_digits=5, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['dimension', 'value'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='productstats',
+            constraint=models.UniqueConstraint(fields=('dimension', 'value'), name='product_stats_unique_group'),
+        ),
+        migrations.RunPython(fill_product_stats, migrations.RunPython.noop),
+    ]
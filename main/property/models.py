@@ -39,12 +39,55 @@ class Product(models.Model):
 
     valid_sort_fields = ['name', 'category', 'brand', 'rating', 'price', 'created_at']
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Keep the loaded values so writes can tell what changed (e.g. the old
+        category/brand whose cached search results must be invalidated).
+        """
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # post_save receivers have seen the previous values, the saved ones are now current.
+        self._loaded_values = {field.attname: getattr(self, field.attname) for field in self._meta.concrete_fields}
+
+    class Meta:
+        # Every (category | brand) equality filter combined with every ordering column has
+        # its own index, the plain column indexes serve unfiltered orderings and range
+        # filters. `property.tests.TestProductQueryPlans` fails when a combination falls
+        # back to a full scan or a filesort.
+        indexes = [
+            models.Index(fields=['name'], name='product_name_idx'),
+            models.Index(fields=['price'], name='product_price_idx'),
+            models.Index(fields=['rating'], name='product_rating_idx'),
+            models.Index(fields=['created_at'], name='product_created_at_idx'),
+            models.Index(fields=['category', 'name'], name='product_category_name_idx'),
+            models.Index(fields=['category', 'price'], name='product_category_price_idx'),
+            models.Index(fields=['category', 'rating'], name='product_category_rating_idx'),
+            models.Index(fields=['category', 'created_at'], name='product_category_created_idx'),
+            models.Index(fields=['brand', 'name'], name='product_brand_name_idx'),
+            models.Index(fields=['brand', 'price'], name='product_brand_price_idx'),
+            models.Index(fields=['brand', 'rating'], name='product_brand_rating_idx'),
+            models.Index(fields=['brand', 'created_at'], name='product_brand_created_idx'),
+        ]
+
 
 class Cart(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Denormalized from the items, kept current by `cart_service.refresh_cart_summaries`.
+    item_count = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'], name='cart_unique_user'),
+        ]
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
@@ -52,3 +95,68 @@ class CartItem(models.Model):
     quantity = models.PositiveIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Adding a product already in the cart upserts on this constraint, see `cart_service.add_item`.
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='cart_item_unique_product'),
+        ]
+
+
+class OutboxEvent(models.Model):
+    """
+    A domain event stored in the transaction of the change it describes and
+    published to RabbitMQ afterwards by `manage.py relay_outbox`, in `id`
+    order, so the events of an aggregate are published in the order they
+    were written.
+    """
+    aggregate_type = models.CharField(max_length=64)
+    aggregate_id = models.CharField(max_length=64)
+    event_type = models.CharField(max_length=64)
+    payload = models.JSONField()
+    routing_key = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+    published_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['published_at', 'id'], name='outbox_pending_idx'),
+        ]
+
+
+class ProductStats(models.Model):
+    """
+    Rollup of the products of one category or brand, kept current on every
+    product write by `stats_service` and rebuilt from the products by its
+    periodic reconciliation, so dashboards read it instead of aggregating
+    the whole `Product` table.
+    """
+    DIMENSION_CHOICES = (
+        ('category', 'Category'),
+        ('brand', 'Brand'),
+    )
+    dimension = models.CharField(max_length=16, choices=DIMENSION_CHOICES)
+    value = models.CharField(max_length=255)
+    product_count = models.IntegerField(default=0)
+    rating_sum = models.FloatField(default=0)
+    price_sum = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    price_min = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    price_max = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['dimension', 'value']
+        constraints = [
+            models.UniqueConstraint(fields=['dimension', 'value'], name='product_stats_unique_group'),
+        ]
+
+    @property
+    def average_rating(self):
+        return self.rating_sum / self.product_count if self.product_count else None
+
+    @property
+    def average_price(self):
+        return round(self.price_sum / self.product_count, 2) if self.product_count else None
@@ -0,0 +1,170 @@
+import base64
+import binascii
+import datetime
+import decimal
+import json
+from collections import OrderedDict
+
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor (keyset) pagination.
+
+    Pages are selected with a `WHERE (sort_field, id) > (last value, last id)`
+    condition on the ordering of the queryset, with `id` appended as tie-break, so
+    every page costs one indexed range read whatever its depth. The total count is
+    only computed when `?count=true` is passed.
+
+    Plain lists (e.g. ids ranked by the search index) are paged by position.
+    """
+
+    mode_query_param = "pagination"
+    cursor_query_param = "cursor"
+    limit_query_param = "limit"
+    count_query_param = "count"
+    default_limit = api_settings.PAGE_SIZE or 10
+    max_limit = 1000
+    invalid_cursor_message = "Invalid cursor"
+
+    @classmethod
+    def requested(cls, request):
+        return request.query_params.get(cls.mode_query_param) == "cursor" or cls.cursor_query_param in request.query_params
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.count = None
+        cursor = self.decode_cursor(request)
+        if request.query_params.get(self.count_query_param, "").lower() in ("1", "true"):
+            self.count = queryset.count() if isinstance(queryset, QuerySet) else len(queryset)
+
+        if not isinstance(queryset, QuerySet):
+            return self.paginate_list(queryset, cursor)
+
+        ordering = self.get_ordering(queryset)
+        reverse = bool(cursor and cursor.get("r"))
+        if cursor:
+            queryset = queryset.filter(self.keyset_filter(queryset.model, ordering, cursor.get("k"), reverse))
+        order_by = [("-" if descending != reverse else "") + name for name, descending in ordering]
+        rows = list(queryset.order_by(*order_by)[: self.limit + 1])
+        has_more = len(rows) > self.limit
+        rows = rows[: self.limit]
+        if reverse:
+            rows.reverse()
+
+        self.has_next = has_more if not reverse else True
+        self.has_previous = bool(cursor) if not reverse else has_more
+        self.next_cursor = self.encode_cursor({"k": self.row_key(rows[-1], ordering)}) if rows else None
+        self.previous_cursor = self.encode_cursor({"k": self.row_key(rows[0], ordering), "r": 1}) if rows else None
+        return rows
+
+    def paginate_list(self, items, cursor):
+        try:
+            start = max(int(cursor.get("p", 0)), 0) if cursor else 0
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        page = items[start:start + self.limit]
+        self.has_next = start + self.limit < len(items)
+        self.has_previous = start > 0
+        self.next_cursor = self.encode_cursor({"p": start + self.limit})
+        self.previous_cursor = self.encode_cursor({"p": max(start - self.limit, 0)})
+        return page
+
+    def get_paginated_response(self, data):
+        payload = OrderedDict()
+        if self.count is not None:
+            payload["count"] = self.count
+        payload["next"] = self.get_link(self.next_cursor) if self.has_next else None
+        payload["previous"] = self.get_link(self.previous_cursor) if self.has_previous else None
+        payload["results"] = data
+        return Response(payload)
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.default_limit
+        return min(limit, self.max_limit) if limit > 0 else self.default_limit
+
+    def get_ordering(self, queryset):
+        """
+        Return the ordering of `queryset` as (field name, descending) pairs ending with the primary key.
+        """
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        pairs = [(name.lstrip("-"), name.startswith("-")) for name in ordering]
+        pk_name = queryset.model._meta.pk.name
+        if not any(name in ("pk", pk_name) for name, _ in pairs):
+            pairs.append((pk_name, pairs[-1][1] if pairs else False))
+        return [(pk_name if name == "pk" else name, descending) for name, descending in pairs]
+
+    def keyset_filter(self, model, ordering, values, reverse):
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            values = [model._meta.get_field(name).to_python(value) for (name, _), value in zip(ordering, values)]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+        condition = Q()
+        for position, (name, descending) in enumerate(ordering):
+            lookup = "lt" if descending != reverse else "gt"
+            branch = Q(**{f"{name}__{lookup}": values[position]})
+            for previous, (previous_name, _) in enumerate(ordering[:position]):
+                branch &= Q(**{previous_name: values[previous]})
+            condition |= branch
+        return condition
+
+    def row_key(self, row, ordering):
+        if isinstance(row, dict):
+            return [self.encode_value(row[name]) for name, _ in ordering]
+        return [self.encode_value(getattr(row, name)) for name, _ in ordering]
+
+    @staticmethod
+    def encode_value(value):
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        if isinstance(value, decimal.Decimal):
+            return str(value)
+        return value
+
+    def encode_cursor(self, cursor):
+        return base64.urlsafe_b64encode(json.dumps(cursor, separators=(",", ":")).encode()).decode()
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(token.encode()))
+        except (TypeError, ValueError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(cursor, dict):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def get_link(self, cursor):
+        url = remove_query_param(self.request.build_absolute_uri(), self.count_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+
+class KeysetPaginationMixin:
+    """
+    Use `KeysetPagination` when the client asks for it with `?pagination=cursor`
+    (or sends a `cursor`), the default `pagination_class` otherwise.
+    """
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if KeysetPagination.requested(self.request):
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class() if self.pagination_class else None
+        return self._paginator
@@ -1,5 +1,8 @@
 from rest_framework import serializers
-from .models import Product, Property, Cart, CartItem
+
+from utils.fast_serializer import ValuesSerializer
+from utils.metrics import TimedSerializerMixin
+from .models import Product, ProductStats, Property, Cart, CartItem
 
 
 class PropertySerializer(serializers.ModelSerializer):
@@ -30,13 +33,15 @@ class ProductPostSerializer(serializers.ModelSerializer):
         return Product.objects.create(**validated_data)
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = '__all__'
 
 
 class ProductSearchSerializer(serializers.Serializer):
+    q = serializers.CharField(required=False)
+    name = serializers.CharField(required=False)
     category = serializers.ChoiceField(choices=Product.CATEGORY_CHOICES, required=False)
     brand = serializers.CharField(required=False)
     min_price = serializers.DecimalField(max_digits=5, decimal_places=2, required=False)
@@ -45,15 +50,80 @@ class ProductSearchSerializer(serializers.Serializer):
     max_quantity = serializers.IntegerField(required=False)
     created_at = serializers.DateTimeField(required=False)
     rating = serializers.FloatField(required=False)
+    facets = serializers.BooleanField(
+        required=False, help_text="Add the category, brand, price and rating counts of all the matches.")
+
 
+class ProductStatsSerializer(serializers.ModelSerializer):
+    average_rating = serializers.FloatField(read_only=True)
+    average_price = serializers.DecimalField(max_digits=5, decimal_places=2, read_only=True)
 
-class CartSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ProductStats
+        fields = ('dimension', 'value', 'product_count', 'average_rating', 'average_price', 'price_min', 'price_max',
+                  'updated_at')
+
+
+class CartSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Cart
         fields = '__all__'
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = CartItem
         fields = '__all__'
+
+
+class CartChangeSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=('add', 'set', 'remove'), default='add')
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=0, default=1)
+
+    def validate(self, attrs):
+        if attrs['op'] == 'add' and attrs['quantity'] < 1:
+            raise serializers.ValidationError({'quantity': ["Ensure this value is greater than or equal to 1."]})
+        return attrs
+
+
+class CartBatchSerializer(serializers.Serializer):
+    MAX_CHANGES = 100
+
+    changes = CartChangeSerializer(many=True, allow_empty=False)
+
+    def validate_changes(self, changes):
+        if len(changes) > self.MAX_CHANGES:
+            raise serializers.ValidationError(f"At most {self.MAX_CHANGES} changes per batch.")
+        return changes
+
+
+class CartProductSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Product
+        fields = ('id', 'name', 'price', 'category', 'brand', 'rating')
+
+
+class CartLineSerializer(serializers.ModelSerializer):
+    product = CartProductSerializer(read_only=True)
+    line_total = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
+
+    class Meta:
+        model = CartItem
+        fields = ('id', 'product', 'quantity', 'line_total', 'created_at', 'updated_at')
+
+
+class CartDetailSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """
+    Read model of a cart, built from the dicts of `cart_service.get_cart_detail`.
+    """
+    user = serializers.IntegerField(read_only=True)
+    items = CartLineSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Cart
+        fields = ('id', 'user', 'item_count', 'subtotal', 'created_at', 'updated_at', 'items')
+
+
+# Read-only fast paths of the list endpoints, see `utils.fast_serializer.ValuesSerializer`.
+product_values = ValuesSerializer(ProductSerializer)
@@ -1,11 +1,44 @@
+import asyncio
+import csv
+import gzip
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import unittest
+from contextlib import contextmanager
+from unittest import mock
+
+import pika
 import pytest
+from asgiref.sync import sync_to_async
+from pika.exceptions import AMQPConnectionError
+import redis
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.urls import reverse
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APITestCase, APIClient
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase, APIClient, APITransactionTestCase
 from rest_framework_simplejwt.tokens import RefreshToken
 
-from property.models import Product
+from property.domain.services import (
+    cache_service, cart_service, cart_store, facet_service, outbox_service, search_service, seed_service,
+    stats_service,
+)
+from property.filters import ProductFilter
+from property.models import Cart, CartItem, OutboxEvent, Product, ProductStats
+from property.serializers import ProductSerializer, product_values
+from utils import db_router, discovery, envelope, metrics, producer, query_plan, routing
 
 
 @pytest.mark.django_db
@@ -82,3 +115,1390 @@ class TestProductSearchView(APITestCase):
         assert len(response.data) == 2
         assert response.data[0]['name'] == 'product2'
         assert response.data[1]['name'] == 'product4'
+
+
+@pytest.mark.django_db
+class TestProductSearchIndex(APITestCase):
+
+    def setUp(self):
+        search_service.reset_search_backend()
+        self.lamp = Product.objects.create(
+            name='Desk lamp', description='Warm reading light', category='residential',
+            brand='Lumina', price=20, rating=4
+        )
+        self.chair = Product.objects.create(
+            name='Office chair', description='Ergonomic chair with lamp holder', category='commercial',
+            brand='Sitwell', price=90, rating=5
+        )
+        self.backend = search_service.get_search_backend()
+        self.url = reverse('product-search')
+        user = get_user_model().objects.create_user('searcher', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(user).access_token))
+
+    def tearDown(self):
+        search_service.reset_search_backend()
+
+    def test_prefix_and_ngram_matching(self):
+        assert self.backend.search('lam') == [self.lamp.pk, self.chair.pk]
+        assert self.backend.search('onomi') == [self.chair.pk]
+        assert self.backend.search('lamp', fields=('name',)) == [self.lamp.pk]
+        assert self.backend.search('lamp chair') == [self.chair.pk]
+        assert self.backend.search('sofa') == []
+
+    def test_index_follows_product_writes(self):
+        assert self.backend.search('chair') == [self.chair.pk]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chair.name = 'Office stool'
+            self.chair.description = 'Ergonomic stool'
+            self.chair.save()
+        assert self.backend.search('chair') == []
+        assert self.backend.search('stool') == [self.chair.pk]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lamp.delete()
+        assert self.backend.search('lamp') == []
+
+    def test_index_follows_writes_of_other_processes(self):
+        other = search_service.InvertedIndexSearchBackend()
+        other.remove_product(0)
+        assert self.backend.search('chair') == [self.chair.pk]
+
+        # Written by another process: this one gets no signal, only the published change.
+        Product.objects.filter(pk=self.chair.pk).update(name='Office stool', description='Ergonomic stool')
+        other.index_product(Product.objects.get(pk=self.chair.pk))
+        with CaptureQueriesContext(connection) as queries:
+            assert self.backend.search('stool') == [self.chair.pk]
+        # Only the changed product is reloaded.
+        assert len(queries) == 1 and ' IN (' in queries[0]['sql']
+        assert self.backend.search('chair') == []
+
+        Product.objects.filter(pk=self.lamp.pk).delete()
+        other.invalidate()
+        assert self.backend.search('lamp') == []
+
+    def test_search_view_reports_truncated_results(self):
+        with override_settings(PRODUCT_SEARCH={'OPTIONS': {'max_results': 1}}):
+            search_service.reset_search_backend()
+            truncated = self.client.get(self.url, {'q': 'lamp'})
+            complete = self.client.get(self.url, {'q': 'desk'})
+        plain = self.client.get(self.url, {'category': 'commercial'})
+
+        assert (truncated.data['count'], truncated.data['truncated']) == (1, True)
+        assert (complete.data['count'], complete.data['truncated']) == (1, False)
+        assert 'truncated' not in plain.data
+
+    def test_search_view_orders_by_relevance(self):
+        response = self.client.get(self.url, {'q': 'lamp'})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['count'] == 2
+        assert [row['name'] for row in response.data['results']] == ['Desk lamp', 'Office chair']
+
+    def test_search_view_combines_query_and_filters(self):
+        response = self.client.get(self.url, {'q': 'lamp', 'category': 'commercial'})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert [row['name'] for row in response.data['results']] == ['Office chair']
+
+
+
+@pytest.mark.django_db
+class TestProductFacets(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        for name, category, brand, price, rating in [
+            ('house', 'residential', 'brand1', 40, 4.5),
+            ('flat', 'residential', 'brand2', 120, 3.2),
+            ('villa', 'residential', 'brand1', 600, 5),
+            ('office', 'commercial', 'brand1', 75, 2.0),
+        ]:
+            Product.objects.create(
+                name=name, description='', category=category, brand=brand, price=price, rating=rating)
+        user = get_user_model().objects.create_user('facets', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(user).access_token))
+
+    def test_facets_are_counted_in_one_query(self):
+        with self.assertNumQueries(1):
+            facets = facet_service.count_facets(Product.objects.filter(category='residential'))
+
+        assert facets['category'] == [{'value': 'residential', 'count': 3}]
+        assert facets['brand'] == [{'value': 'brand1', 'count': 2}, {'value': 'brand2', 'count': 1}]
+        assert [bucket['count'] for bucket in facets['price']] == [1, 0, 1, 0, 1]
+        assert facets['price'][-1] == {'min': 500, 'max': None, 'count': 1}
+        assert [bucket['count'] for bucket in facets['rating']] == [0, 0, 0, 1, 2]
+
+    def test_search_returns_facets_of_the_filtered_products(self):
+        response = self.client.get(reverse('product-search'), {'brand': 'brand1', 'facets': 'true', 'limit': 1})
+        plain = self.client.get(reverse('product-search'), {'brand': 'brand1', 'limit': 1})
+
+        assert response.status_code == 200
+        assert len(response.data['results']) == 1
+        assert response.data['facets']['category'] == [
+            {'value': 'residential', 'count': 2}, {'value': 'commercial', 'count': 1}]
+        assert 'facets' not in plain.data
+
+
+@pytest.mark.django_db
+class TestProductStats(APITestCase):
+
+    def create(self, name, category, brand, price, rating):
+        return Product.objects.create(
+            name=name, description='', category=category, brand=brand, price=price, rating=rating)
+
+    def stats(self, dimension, value):
+        return ProductStats.objects.get(dimension=dimension, value=value)
+
+    def test_writes_update_the_rollup_incrementally(self):
+        house = self.create('house', 'residential', 'brand1', 40, 4)
+        villa = self.create('villa', 'residential', 'brand1', 600, 5)
+        self.create('office', 'commercial', 'brand2', 75, 2)
+
+        villa = Product.objects.get(pk=villa.pk)
+        villa.category, villa.price = 'commercial', 500
+        villa.save()
+        Product.objects.get(pk=house.pk).delete()
+
+        residential = self.stats('category', 'residential')
+        assert (residential.product_count, residential.price_min, residential.average_rating) == (0, None, None)
+        commercial = self.stats('category', 'commercial')
+        assert (commercial.product_count, commercial.price_min, commercial.price_max) == (2, 75, 500)
+        assert commercial.average_rating == 3.5
+        brand1 = self.stats('brand', 'brand1')
+        assert (brand1.product_count, brand1.price_min, brand1.price_max) == (1, 500, 500)
+        # The reconciliation finds nothing to fix.
+        assert stats_service.reconcile() == 0
+
+    def test_cheaper_product_lowers_the_price_bounds(self):
+        self.create('office', 'commercial', 'brand2', 75, 2)
+        self.create('kiosk', 'commercial', 'brand2', 9, 3)
+
+        commercial = self.stats('category', 'commercial')
+        assert (commercial.price_min, commercial.price_max) == (9, 75)
+        assert stats_service.reconcile() == 0
+
+    def test_bulk_writes_and_drift_are_reconciled(self):
+        seed_service.seed_products(20)
+        assert stats_service.reconcile() == 0
+        assert sum(row.product_count for row in ProductStats.objects.filter(dimension='brand')) == 20
+
+        # QuerySet.update() sends no signal, the brand and the category of the product drift.
+        Product.objects.filter(brand='brand1').update(rating=1)
+        assert stats_service.reconcile() == 2
+        assert self.stats('brand', 'brand1').average_rating == 1
+
+    def test_stats_endpoint_reads_the_rollup(self):
+        self.create('house', 'residential', 'brand1', 40, 4)
+        user = get_user_model().objects.create_user('stats', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(user).access_token))
+
+        response = self.client.get(reverse('product-stats'), {'dimension': 'category'})
+        invalid = self.client.get(reverse('product-stats'), {'dimension': 'name'})
+
+        assert response.status_code == 200
+        assert [(row['value'], row['product_count'], row['average_price']) for row in response.data] == [
+            ('residential', 1, '40.00')]
+        assert invalid.status_code == 400
+
+@pytest.mark.django_db
+class TestProductQueryPlans(APITestCase):
+    """
+    Guard against filter/ordering combinations of the product endpoints that are
+    not served by an index of `Product.Meta.indexes`.
+    """
+    equality_filters = ({}, {'category': 'residential'}, {'brand': 'brand3'},
+                        {'category': 'commercial', 'brand': 'brand3'})
+    range_filters = {
+        'price': {'min_price': 10, 'max_price': 50},
+        'rating': {'rating': 4},
+        'created_at': {'created_at': '2023-01-20T10:00:00Z'},
+    }
+    orderings = ('name', 'price', 'rating', 'created_at')
+
+    @classmethod
+    def setUpTestData(cls):
+        Product.objects.bulk_create(
+            Product(
+                name=f'product{i}',
+                description='',
+                category=('residential', 'commercial')[i % 2],
+                brand=f'brand{i % 50}',
+                price=i % 999 / 10,
+                rating=i % 5,
+            )
+            for i in range(5000)
+        )
+        query_plan.analyze(Product)
+
+    def queryset(self, data, ordering):
+        return ProductFilter(data, queryset=Product.objects.all()).qs.order_by(ordering)[:10]
+
+    def plan_problems(self, data, ordering):
+        return query_plan.plan_problems(self.queryset(data, ordering))
+
+    def index(self, *fields):
+        return next(index.name for index in Product._meta.indexes if tuple(index.fields) == fields)
+
+    def expected_indexes(self, data, *columns):
+        """
+        The indexes serving `columns` after the equality filter of `data`, with
+        both category and brand either one can lead.
+        """
+        leading = [(name,) for name in ('category', 'brand') if name in data] or [()]
+        return {self.index(*first, column) for first in leading for column in columns}
+
+    def test_unfiltered_orderings_use_indexes(self):
+        for ordering in Product.valid_sort_fields:
+            with self.subTest(ordering=ordering):
+                assert query_plan.plan_problems(Product.objects.order_by(ordering)[:10]) == []
+
+    def test_equality_filters_and_orderings_use_indexes(self):
+        for equality in self.equality_filters:
+            for ordering in self.orderings:
+                for data in (equality, {**equality, **self.range_filters.get(ordering, {})}):
+                    with self.subTest(filters=data, ordering=ordering):
+                        assert self.plan_problems(data, ordering) == []
+                        indexes = query_plan.used_indexes(self.queryset(data, ordering))
+                        assert indexes and indexes[0] in self.expected_indexes(data, ordering)
+
+    def test_ordering_by_the_filtered_column_needs_no_sort(self):
+        for column in ('category', 'brand'):
+            data = {column: 'residential' if column == 'category' else 'brand3'}
+            for extra in ({}, *self.range_filters.values()):
+                with self.subTest(filters={**data, **extra}, ordering=column):
+                    assert self.plan_problems({**data, **extra}, column) == []
+                    indexes = query_plan.used_indexes(self.queryset({**data, **extra}, column))
+                    assert indexes and indexes[0].startswith(f'product_{column}_')
+
+    def test_range_filters_use_the_filter_or_ordering_index(self):
+        # A range on another column than the ordering one is served either by
+        # walking the ordering index and skipping the rows out of range, or by
+        # sorting the rows selected through the range index, never by a scan.
+        for equality in self.equality_filters:
+            for column, extra in self.range_filters.items():
+                for ordering in self.orderings:
+                    data = {**equality, **extra}
+                    with self.subTest(filters=data, ordering=ordering):
+                        queryset = self.queryset(data, ordering)
+                        problems = query_plan.plan_problems(queryset)
+                        indexes = query_plan.used_indexes(queryset)
+                        assert [problem for problem in problems if problem.startswith('full scan')] == []
+                        assert indexes and indexes[0] in self.expected_indexes(data, ordering, column)
+                        if indexes[0] in self.expected_indexes(data, ordering):
+                            assert problems == []
+
+
+@pytest.mark.django_db
+class TestKeysetPagination(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        Product.objects.bulk_create(
+            Product(name=f'product{i:02}', description='', category='residential', brand=f'brand{i % 3}',
+                    price=i % 4, rating=i % 5)
+            for i in range(25)
+        )
+        user = get_user_model().objects.create_user('pager', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(user).access_token))
+
+    def walk(self, url, params):
+        pages = []
+        response = self.client.get(url, {**params, 'pagination': 'cursor', 'limit': 4})
+        while True:
+            assert response.status_code == status.HTTP_200_OK
+            pages.append(response.data)
+            if not response.data['next']:
+                return pages
+            response = self.client.get(response.data['next'])
+
+    def test_cursor_pages_cover_every_row_once_for_each_sort_field(self):
+        for url in (reverse('product-search'), reverse('product-list')):
+            for sort_by in Product.valid_sort_fields:
+                with self.subTest(url=url, sort_by=sort_by):
+                    pages = self.walk(url, {'sort_by': sort_by})
+                    ids = [row['id'] for page in pages for row in page['results']]
+                    expected = list(Product.objects.order_by(sort_by, 'id').values_list('id', flat=True))
+                    assert ids == expected
+                    assert 'count' not in pages[0]
+
+    def test_previous_cursor_returns_the_previous_page(self):
+        url = reverse('product-list')
+        first = self.client.get(url, {'pagination': 'cursor', 'limit': 4, 'sort_by': 'price'}).data
+        second = self.client.get(first['next']).data
+        back = self.client.get(second['previous']).data
+
+        assert [row['id'] for row in back['results']] == [row['id'] for row in first['results']]
+        assert back['previous'] is None
+
+    def test_count_is_opt_in(self):
+        response = self.client.get(reverse('product-list'), {'pagination': 'cursor', 'count': 'true'})
+
+        assert response.data['count'] == 25
+        assert 'count=' not in response.data['next']
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('product-list'), {'cursor': 'not-a-cursor'})
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestProductResponseCache(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        cache_service.stats.reset()
+        self.house = Product.objects.create(
+            name='house', description='', category='residential', brand='brand1', price=10, rating=4
+        )
+        self.office = Product.objects.create(
+            name='office', description='', category='commercial', brand='brand2', price=20, rating=3
+        )
+        self.url = reverse('product-search')
+        user = get_user_model().objects.create_user('cached', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(user).access_token))
+
+    def test_repeated_search_is_served_from_cache(self):
+        first = self.client.get(self.url, {'category': 'residential', 'min_price': '5', 'max_price': '50'})
+        # No query is left on a hit, the user comes from the authentication cache.
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url, {'max_price': '50.00', 'min_price': '5.0', 'category': 'residential'})
+
+        assert second.data == first.data
+        assert cache_service.stats.as_dict()['hits'] == 1
+        assert cache_service.stats.as_dict()['misses'] == 1
+
+    def test_product_write_only_evicts_its_category_and_brand(self):
+        self.client.get(self.url, {'category': 'residential'})
+        self.client.get(self.url, {'category': 'commercial'})
+
+        self.house.name = 'villa'
+        self.house.save()
+        residential = self.client.get(self.url, {'category': 'residential'})
+        self.client.get(self.url, {'category': 'commercial'})
+
+        assert [row['name'] for row in residential.data['results']] == ['villa']
+        assert cache_service.stats.as_dict()['hits'] == 1
+
+    def test_category_change_evicts_old_and_new_category(self):
+        self.client.get(self.url, {'category': 'residential'})
+        self.client.get(self.url, {'category': 'commercial'})
+
+        product = Product.objects.get(pk=self.house.pk)
+        product.category = 'commercial'
+        product.save()
+
+        assert self.client.get(self.url, {'category': 'residential'}).data['results'] == []
+        assert len(self.client.get(self.url, {'category': 'commercial'}).data['results']) == 2
+        assert cache_service.stats.as_dict()['hits'] == 0
+
+    def test_retrieve_is_evicted_on_update_and_delete(self):
+        url = reverse('product-detail', args=[self.office.pk])
+        self.client.get(url)
+        self.office.price = 25
+        self.office.save()
+        assert self.client.get(url).data['price'] == '25.00'
+
+        self.office.delete()
+        assert self.client.get(url).status_code == status.HTTP_404_NOT_FOUND
+
+    def test_stats_endpoint(self):
+        self.client.get(self.url)
+        self.client.get(self.url)
+        response = self.client.get(reverse('product-cache-stats'))
+
+        assert response.data['hits'] == 1
+        assert response.data['misses'] == 1
+        assert response.data['hit_ratio'] == 0.5
+
+    def test_unreachable_cache_is_bypassed(self):
+        down = {'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': 'redis://127.0.0.1:1/1',
+                'OPTIONS': {'SOCKET_CONNECT_TIMEOUT': 0.1, 'SOCKET_TIMEOUT': 0.1}}
+        with override_settings(CACHES={**settings.CACHES, 'down': down}, PRODUCT_CACHE={'ALIAS': 'down'}):
+            response = self.client.get(self.url, {'category': 'residential'})
+            product = Product.objects.create(
+                name='shed', description='', category='residential', brand='brand1', price=5, rating=2
+            )
+
+        assert [row['name'] for row in response.data['results']] == ['house']
+        assert Product.objects.filter(pk=product.pk).exists()
+        assert ProductStats.objects.get(dimension='category', value='residential').product_count == 2
+        assert stats_service.reconcile() == 0
+
+
+@pytest.mark.django_db
+class TestProductImport(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.house = Product.objects.create(
+            name='house', description='', category='residential', brand='brand1', price=10, rating=4
+        )
+        self.url = reverse('product-import')
+        user = get_user_model().objects.create_user('importer', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(user).access_token))
+
+    def test_csv_upload_creates_updates_and_reports_errors(self):
+        content = (
+            'id,name,description,price,category,brand,rating\n'
+            f'{self.house.pk},manor,big,99.50,residential,brand1,5\n'
+            ',office,desk,20,commercial,brand2,3\n'
+            ',broken,desk,not-a-price,commercial,brand2,3\n'
+        ).encode()
+        upload = SimpleUploadedFile('products.csv', content, content_type='text/csv')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'{self.url}?chunk_size=2', {'file': upload}, format='multipart')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert (response.data['rows'], response.data['created'], response.data['updated']) == (3, 1, 1)
+        assert response.data['failed'] == 1
+        assert response.data['errors'][0]['row'] == 3
+        assert 'price' in response.data['errors'][0]['errors']
+        self.house.refresh_from_db()
+        assert (self.house.name, str(self.house.price)) == ('manor', '99.50')
+        assert Product.objects.filter(name='office', category='commercial').exists()
+
+    def test_jsonl_body_is_streamed(self):
+        content = '\n'.join([
+            json.dumps({'name': 'flat', 'description': 'small', 'price': '5', 'category': 'residential',
+                        'brand': 'brand3', 'rating': 2}),
+            '{not json',
+            '',
+        ])
+        response = self.client.generic('POST', self.url, content, content_type='application/x-ndjson')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert (response.data['created'], response.data['failed']) == (1, 1)
+        assert response.data['errors'][0]['row'] == 2
+        assert Product.objects.filter(name='flat', brand='brand3').exists()
+
+    def test_unknown_format_is_rejected(self):
+        response = self.client.generic('POST', self.url, 'a;b', content_type='text/plain')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_management_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as file:
+            for index in range(5):
+                file.write(json.dumps({'name': f'lot {index}', 'description': 'plot', 'price': index + 1,
+                                       'category': 'commercial', 'brand': 'brand4', 'rating': 1}) + '\n')
+        self.addCleanup(os.remove, file.name)
+        out = io.StringIO()
+        call_command('import_products', file.name, '--chunk-size', '2', stdout=out)
+
+        assert Product.objects.filter(brand='brand4').count() == 5
+        assert '5 created' in out.getvalue()
+
+
+@pytest.mark.django_db
+class TestProductExport(APITestCase):
+
+    def setUp(self):
+        self.house = Product.objects.create(
+            name='house', description='a "big" one', category='residential', brand='brand1', price=10, rating=4
+        )
+        self.office = Product.objects.create(
+            name='office', description='desk', category='commercial', brand='brand2', price=20, rating=3
+        )
+        self.url = reverse('product-export')
+        user = get_user_model().objects.create_user('exporter', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(user).access_token))
+
+    def test_jsonl_matches_serializer_output(self):
+        response = self.client.get(self.url, {'category': 'residential'})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response['Content-Type'] == 'application/x-ndjson'
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        assert rows == [json.loads(json.dumps(ProductSerializer(self.house).data))]
+
+    def test_gzipped_csv(self):
+        response = self.client.get(self.url, {'type': 'csv'}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        assert response['Content-Encoding'] == 'gzip'
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(b''.join(response.streaming_content)).decode())))
+        assert [row['name'] for row in rows] == ['house', 'office']
+        assert rows[0]['description'] == 'a "big" one'
+        assert rows[1]['price'] == '20.00'
+
+    def test_invalid_filter_is_rejected(self):
+        assert self.client.get(self.url, {'min_price': 'cheap'}).status_code == status.HTTP_400_BAD_REQUEST
+        assert self.client.get(self.url, {'type': 'xml'}).status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestValuesSerializer(APITestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('reader', password='test')
+        self.products = [
+            Product.objects.create(name=f'lot {index}', description='déjà "vu"', category=category, brand='brand1',
+                                   price=price, rating=rating)
+            for index, (category, price, rating) in enumerate(
+                [('residential', 10, 4), ('commercial', '999.99', 0.1), ('residential', '0.5', 3)])
+        ]
+
+    def test_output_is_identical_to_model_serializer(self):
+        renderer = JSONRenderer()
+        queryset = Product.objects.order_by('name')
+        expected = renderer.render(ProductSerializer(queryset, many=True).data)
+        assert renderer.render(product_values.serialize(queryset)) == expected
+
+        with timezone.override('Asia/Kolkata'):
+            expected = renderer.render(ProductSerializer(queryset, many=True).data)
+            assert renderer.render(product_values.serialize(queryset)) == expected
+
+    def test_list_endpoint(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.user).access_token))
+        response = self.client.get(reverse('product-list'), {'sort_by': 'price'})
+
+        assert response.data['results'] == ProductSerializer(Product.objects.order_by('price'), many=True).data
+
+
+@pytest.mark.django_db
+class TestCartReadModel(APITestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='test')
+        self.house = Product.objects.create(
+            name='house', description='big', category='residential', brand='brand1', price=10, rating=4
+        )
+        self.office = Product.objects.create(
+            name='office', description='desk', category='commercial', brand='brand2', price='2.50', rating=3
+        )
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.user).access_token))
+
+    def test_summary_follows_item_and_price_changes(self):
+        cart = Cart.objects.create(user=self.user)
+        item = CartItem.objects.create(cart=cart, product=self.house, quantity=2)
+        CartItem.objects.create(cart=cart, product=self.office, quantity=4)
+        cart.refresh_from_db()
+        assert (cart.item_count, str(cart.subtotal)) == (6, '30.00')
+
+        self.house.price = 11
+        self.house.save()
+        item.delete()
+        cart.refresh_from_db()
+        assert (cart.item_count, str(cart.subtotal)) == (4, '10.00')
+
+    def test_cart_is_read_in_one_query(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.house, quantity=2)
+        CartItem.objects.create(cart=cart, product=self.office, quantity=1)
+
+        with self.assertNumQueries(1):
+            detail = cart_service.get_cart_detail(self.user)
+        assert [item['product']['name'] for item in detail['items']] == ['house', 'office']
+
+        response = self.client.get(reverse('cart-list'))
+        assert response.data['item_count'] == 3
+        assert response.data['subtotal'] == '22.50'
+        assert response.data['items'][0]['line_total'] == '20.00'
+        assert response.data['items'][1]['product']['price'] == '2.50'
+
+    def test_empty_and_missing_cart(self):
+        assert self.client.get(reverse('cart-list')).data == {'detail': 'Cart not found for user'}
+
+        Cart.objects.create(user=self.user)
+        response = self.client.get(reverse('cart-list'))
+        assert (response.data['item_count'], response.data['subtotal'], response.data['items']) == (0, '0.00', [])
+
+
+
+@pytest.mark.django_db
+class TestProductBulkWrites(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('bulk', password='test')
+        self.house = Product.objects.create(
+            name='house', description='big', category='residential', brand='brand1', price=10, rating=4
+        )
+        self.office = Product.objects.create(
+            name='office', description='desk', category='commercial', brand='brand2', price=3, rating=3
+        )
+        self.url = reverse('product-bulk')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.user).access_token))
+
+    def product(self, name, price=5):
+        return {'name': name, 'description': 'bulk', 'category': 'commercial', 'brand': 'brand3', 'price': price,
+                'rating': 4}
+
+    def test_create_batch_is_written_at_once_or_rejected_with_item_errors(self):
+        invalid = self.client.post(self.url, [self.product('a'), {'name': 'b'}], format='json')
+        assert invalid.status_code == status.HTTP_400_BAD_REQUEST
+        assert [error['index'] for error in invalid.data['errors']] == [1]
+        assert 'price' in invalid.data['errors'][0]['errors']
+
+        response = self.client.post(self.url, [self.product(name) for name in 'abc'], format='json')
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.data['created'] == 3
+        created = dict(Product.objects.filter(brand='brand3').values_list('name', 'pk'))
+        assert response.data['ids'] == [created[name] for name in 'abc']
+        assert ProductStats.objects.get(dimension='brand', value='brand3').product_count == 3
+        assert OutboxEvent.objects.get().payload == {'action': 'created', 'ids': response.data['ids'], 'count': 3}
+        assert self.client.get(reverse('product-detail', args=[created['b']])).data['name'] == 'b'
+
+    def test_update_batch_applies_partial_changes(self):
+        cart_service.add_item(self.user, self.house.pk, 2)
+        self.client.get(reverse('product-list'))
+
+        missing = self.client.patch(self.url, [{'id': self.house.pk, 'price': 1}, {'id': 999, 'price': 1}],
+                                    format='json')
+        assert [error['index'] for error in missing.data['errors']] == [1]
+        response = self.client.patch(self.url, [
+            {'id': self.house.pk, 'price': 20},
+            {'id': self.office.pk, 'category': 'residential'},
+        ], format='json')
+
+        assert response.data['updated'] == 2
+        assert Product.objects.get(pk=self.house.pk).price == 20
+        assert Product.objects.get(pk=self.office.pk).category == 'residential'
+        assert Cart.objects.get(user=self.user).subtotal == 40
+        assert ProductStats.objects.get(dimension='category', value='commercial').product_count == 0
+        listed = self.client.get(reverse('product-list'))
+        assert {row['name']: row['price'] for row in listed.data['results']} == {'house': '20.00', 'office': '3.00'}
+        assert OutboxEvent.objects.get().payload == {
+            'action': 'updated', 'ids': [self.house.pk, self.office.pk], 'count': 2}
+
+    def test_delete_batch_removes_products_and_their_cart_items(self):
+        cart_service.add_item(self.user, self.house.pk, 2)
+        cart_service.add_item(self.user, self.office.pk, 1)
+
+        # Two DELETE ... IN and the cart, stats and outbox writes, whatever the size of the batch.
+        with self.assertNumQueries(15):
+            response = self.client.delete(self.url, {'ids': [self.house.pk]}, format='json')
+
+        assert response.data == {'deleted': 1}
+        assert list(Product.objects.values_list('name', flat=True)) == ['office']
+        cart = Cart.objects.get(user=self.user)
+        assert (cart.item_count, cart.subtotal) == (1, 3)
+        assert ProductStats.objects.get(dimension='brand', value='brand1').product_count == 0
+        assert OutboxEvent.objects.get().payload == {'action': 'deleted', 'ids': [self.house.pk], 'count': 1}
+
+@pytest.mark.django_db
+class TestCartMutations(APITestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('buyer', password='test')
+        self.house = Product.objects.create(
+            name='house', description='big', category='residential', brand='brand1', price=10, rating=4
+        )
+        self.office = Product.objects.create(
+            name='office', description='desk', category='commercial', brand='brand2', price=3, rating=3
+        )
+        self.url = reverse('cart-list')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.user).access_token))
+
+    def test_adding_a_product_twice_increments_one_row(self):
+        self.client.post(f'{self.url}?product={self.house.pk}&quantity=2')
+        response = self.client.post(f'{self.url}?product={self.house.pk}&quantity=3')
+
+        assert Cart.objects.filter(user=self.user).count() == 1
+        assert list(CartItem.objects.values_list('product', 'quantity')) == [(self.house.pk, 5)]
+        assert (response.data['item_count'], response.data['subtotal']) == (5, '50.00')
+
+    def test_unknown_product_and_invalid_quantity(self):
+        response = self.client.post(f'{self.url}?product=999')
+        assert response.data == {'detail': 'Product not found'}
+        assert not CartItem.objects.exists()
+
+        response = self.client.post(f'{self.url}?product={self.house.pk}&quantity=-1')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+        # Adding nothing would store an empty line, setting 0 removes the product.
+        response = self.client.post(f'{self.url}?product={self.house.pk}&quantity=0')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        response = self.client.post(reverse('cart-batch'), {'changes': [
+            {'op': 'add', 'product': self.house.pk, 'quantity': 0}]}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert not CartItem.objects.exists()
+
+    def test_update_and_destroy(self):
+        cart_service.add_item(self.user, self.house.pk, 2)
+        url = reverse('cart-detail', args=[self.house.pk])
+
+        response = self.client.put(f'{url}?product={self.house.pk}&quantity=7')
+        assert response.data['items'][0]['quantity'] == 7
+        assert self.client.put(f'{url}?product={self.office.pk}&quantity=1').data == {
+            'detail': 'Item not found in cart'}
+
+        assert self.client.delete(f'{url}?user={self.user.pk}').data == {'detail': 'Product removed from cart'}
+        assert Cart.objects.get(user=self.user).item_count == 0
+
+        cart_service.add_item(self.user, self.house.pk, 2)
+        response = self.client.put(f'{url}?product={self.house.pk}&quantity=0')
+        assert response.data['items'] == []
+
+    def test_batch_is_applied_in_one_transaction(self):
+        cart_service.add_item(self.user, self.office.pk, 1)
+        url = reverse('cart-batch')
+        changes = [
+            {'op': 'add', 'product': self.house.pk, 'quantity': 2},
+            {'op': 'add', 'product': self.house.pk, 'quantity': 1},
+            {'op': 'set', 'product': self.office.pk, 'quantity': 4},
+        ]
+        response = self.client.post(url, {'changes': changes}, format='json')
+        assert {item['product']['name']: item['quantity'] for item in response.data['items']} == {
+            'house': 3, 'office': 4}
+        assert response.data['subtotal'] == '42.00'
+
+        changes = [{'op': 'remove', 'product': self.office.pk}, {'op': 'add', 'product': 999}]
+        response = self.client.post(url, {'changes': changes}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert CartItem.objects.filter(product=self.office).exists()
+        assert Cart.objects.get(user=self.user).item_count == 7
+
+
+@pytest.mark.django_db
+class TestRedisCartStore(APITestCase):
+    store_settings = {
+        'BACKEND': 'property.domain.services.cart_store.RedisCartStore',
+        'OPTIONS': {
+            'url': f'redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/15',
+            'key_prefix': 'test-cart',
+            'flush_task': None,
+        },
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        # Against fakeredis, or a real server with TEST_REDIS_URL=redis://host:port/db.
+        url = os.environ.get('TEST_REDIS_URL')
+        if url:
+            cls.store_settings = {**cls.store_settings, 'OPTIONS': {**cls.store_settings['OPTIONS'], 'url': url}}
+            try:
+                redis.StrictRedis.from_url(url, socket_connect_timeout=1).ping()
+            except redis.RedisError:
+                raise unittest.SkipTest('Redis is not reachable')
+        else:
+            import fakeredis
+
+            server = fakeredis.FakeServer()
+            patcher = mock.patch.object(
+                redis.StrictRedis, 'from_url', lambda url, **kwargs: fakeredis.FakeStrictRedis(server=server))
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+    def setUp(self):
+        override = override_settings(CART_STORE=self.store_settings)
+        override.enable()
+        self.addCleanup(override.disable)
+        cart_store.reset_cart_store()
+        self.addCleanup(cart_store.reset_cart_store)
+        self.store = cart_store.get_cart_store()
+        for key in self.store.client.scan_iter(match='test-cart:*'):
+            self.store.client.delete(key)
+
+        self.user = get_user_model().objects.create_user('hot', password='test')
+        self.house = Product.objects.create(
+            name='house', description='big', category='residential', brand='brand1', price=10, rating=4
+        )
+        self.office = Product.objects.create(
+            name='office', description='desk', category='commercial', brand='brand2', price=3, rating=3
+        )
+        self.url = reverse('cart-list')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.user).access_token))
+
+    def test_changes_are_written_behind(self):
+        self.client.post(f'{self.url}?product={self.house.pk}&quantity=2')
+        response = self.client.post(f'{self.url}?product={self.house.pk}&quantity=1')
+
+        assert (response.data['item_count'], response.data['subtotal']) == (3, '30.00')
+        assert not CartItem.objects.exists()
+
+        assert self.store.flush() == 1
+        cart = Cart.objects.get(user=self.user)
+        assert list(cart.cartitem_set.values_list('product', 'quantity')) == [(self.house.pk, 3)]
+        assert (cart.item_count, str(cart.subtotal)) == (3, '30.00')
+        assert self.store.flush() == 0
+
+    def test_flush_is_idempotent_and_applies_removals(self):
+        self.store.apply_changes(self.user, [{'op': 'add', 'product': self.house.pk, 'quantity': 1},
+                                             {'op': 'set', 'product': self.office.pk, 'quantity': 5}])
+        self.store.flush_users([self.user.pk])
+        self.store.flush_users([self.user.pk])
+        assert CartItem.objects.count() == 2
+
+        assert self.store.remove_item(self.user, self.office.pk)
+        self.store.flush()
+        assert list(CartItem.objects.values_list('product', flat=True)) == [self.house.pk]
+
+    def test_rebuild_reloads_carts_from_the_database(self):
+        cart_service.add_item(self.user, self.office.pk, 4)
+        assert self.store.get_cart_detail(self.user)['item_count'] == 4
+
+        self.store.add_item(self.user, self.house.pk, 1)
+        assert self.store.rebuild() > 0
+        assert not self.store.client.exists(self.store.cart_key(self.user.pk))
+
+        detail = self.store.get_cart_detail(self.user)
+        assert {item['product']['name']: item['quantity'] for item in detail['items']} == {'office': 4, 'house': 1}
+
+
+class RecordingPublisher:
+    """
+    Collects what `relay_batch` publishes, in place of the RabbitMQ publisher.
+    """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.pending = []
+        self.published = []
+
+    @contextmanager
+    def batch(self):
+        self.pending = []
+        yield self
+        if self.fail:
+            raise ConnectionError('broker down')
+        self.published.extend(self.pending)
+
+    def publish(self, method, body, routing_key='likes', exchange='', properties=None):
+        self.pending.append((method, body, routing_key, properties))
+
+
+@pytest.mark.django_db
+class TestOutbox(APITestCase):
+
+    def test_events_are_rolled_back_with_their_transaction(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            outbox_service.enqueue('product_created', {'id': 1}, aggregate_type='product', aggregate_id=1)
+            raise RuntimeError
+        outbox_service.enqueue('product_created', {'id': 2}, aggregate_type='product', aggregate_id=2)
+
+        assert list(OutboxEvent.objects.values_list('payload', flat=True)) == [{'id': 2}]
+
+    def test_relay_publishes_in_order_and_marks_events(self):
+        events = [outbox_service.enqueue('product_changed', {'n': n}, 'product', 7) for n in range(3)]
+        publisher = RecordingPublisher()
+
+        assert outbox_service.relay_batch(2, publisher) == 2
+        assert outbox_service.relay_batch(2, publisher) == 1
+        assert outbox_service.relay_batch(2, publisher) == 0
+
+        assert [body.payload for _, body, _, _ in publisher.published] == [{'n': 0}, {'n': 1}, {'n': 2}]
+        assert publisher.published[0][1].id == str(events[0].pk)
+        assert publisher.published[0][2] == 'default.product_changed'
+        assert publisher.published[0][3]['headers'] == {'aggregate_type': 'product', 'aggregate_id': '7'}
+        assert not OutboxEvent.objects.filter(published_at__isnull=True).exists()
+
+    def test_failed_relay_keeps_events_pending(self):
+        outbox_service.enqueue('product_changed', {'n': 0}, 'product', 7)
+
+        with self.assertRaises(ConnectionError):
+            outbox_service.relay_batch(10, RecordingPublisher(fail=True))
+
+        event = OutboxEvent.objects.get()
+        assert (event.published_at, event.attempts) == (None, 1)
+        assert 'broker down' in event.last_error
+        assert outbox_service.relay_batch(10, RecordingPublisher()) == 1
+
+
+class TestEventEnvelope(APITestCase):
+
+    def setUp(self):
+        self.registry = envelope.SchemaRegistry()
+        self.registry.register('price_changed', 1, {'price': str})
+        self.registry.register('price_changed', 2, {'price': str, 'currency': str},
+                               upgrade=lambda payload: {**payload, 'currency': 'EUR'})
+
+    def round_trip(self, message, codec):
+        body, arguments = envelope.encode(message, codec, self.registry, delivery_mode=2, headers={'source': 'test'})
+        properties = pika.BasicProperties(**arguments)
+        assert (properties.type, properties.headers) == (message.event, {'source': 'test', 'version': message.version})
+        return envelope.decode(properties, body, self.registry)
+
+    def test_round_trip_and_plain_json_messages(self):
+        message = envelope.Envelope('price_changed', {'price': '10.00', 'currency': 'USD'}, 2, occurred_at=1650000000)
+        assert self.round_trip(message, 'json') == message
+        if importlib.util.find_spec('msgpack'):
+            assert self.round_trip(message, 'msgpack') == message
+
+        legacy = envelope.decode(pika.BasicProperties('quote_created'), b'{"message": "user_created"}')
+        assert (legacy.event, legacy.version, legacy.payload) == ('quote_created', 1, {'message': 'user_created'})
+
+    def test_old_versions_are_upgraded_and_invalid_payloads_rejected(self):
+        message = self.round_trip(envelope.Envelope('price_changed', {'price': '10.00'}), 'json')
+        assert (message.version, message.payload) == (2, {'price': '10.00', 'currency': 'EUR'})
+
+        with self.assertRaises(envelope.SchemaError):
+            envelope.encode(envelope.Envelope('price_changed', {'price': 10}), 'json', self.registry)
+
+    def test_router_dispatches_by_event(self):
+        router = envelope.EventRouter(self.registry)
+        router.route('price_changed')(lambda message: message.payload['currency'])
+        body, arguments = envelope.encode(envelope.Envelope('price_changed', {'price': '1.00'}), 'json', self.registry)
+
+        assert router(pika.BasicProperties(**arguments), body) == 'EUR'
+        assert router(pika.BasicProperties('unknown_event'), b'{}') is None
+
+    def test_benchmark_samples_match_their_schemas(self):
+        out = io.StringIO()
+        call_command('bench_envelope', rows=5, messages=2, repeat=1, stdout=out, stderr=io.StringIO())
+
+        assert 'products_changed, 2 messages, 1 runs' in out.getvalue()
+
+
+class RecordingChannel:
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda **kwargs: self.calls.append((name, kwargs))
+
+
+class TestEventRouting(APITestCase):
+
+    def test_routing_keys_and_lanes(self):
+        assert routing.routing_key('quote_created') == 'default.quote_created'
+        assert routing.routing_key('user_created') == 'priority.user_created'
+        assert routing.routing_key('user_created', routing.DEFAULT_LANE) == 'default.user_created'
+
+        outbox_service.enqueue('user_created', {})
+        assert OutboxEvent.objects.get().routing_key == 'priority.user_created'
+
+    def test_every_event_is_bound_to_a_queue(self):
+        bound = {key for queue in routing.QUEUES for key in queue.bindings}
+        events = envelope.schemas.events | set(routing.EMAIL_EVENTS)
+
+        assert {routing.routing_key(event) for event in events} <= bound
+
+    def test_queues_are_declared_with_bindings_and_dead_letter_queue(self):
+        channel = RecordingChannel()
+        routing.declare(channel, [routing.get_queue('notifications.email.priority')])
+
+        declared = {kwargs['queue']: kwargs.get('arguments') for name, kwargs in channel.calls
+                    if name == 'queue_declare'}
+        assert declared == {
+            'notifications.email.priority.dead': None,
+            'notifications.email.priority': {'x-dead-letter-exchange': routing.DEAD_LETTER_EXCHANGE,
+                                             'x-dead-letter-routing-key': 'notifications.email.priority'},
+        }
+        bindings = {(kwargs['exchange'], kwargs['routing_key']) for name, kwargs in channel.calls
+                    if name == 'queue_bind' and kwargs['queue'] == 'notifications.email.priority'}
+        assert bindings == {(routing.EXCHANGE, 'priority.user_created'), (routing.EXCHANGE, 'priority.quote_created')}
+
+    def test_queues_without_consumer_are_bounded(self):
+        channel = RecordingChannel()
+        routing.declare(channel, [routing.get_queue('catalog.products')])
+
+        declared = {kwargs['queue']: kwargs.get('arguments') for name, kwargs in channel.calls
+                    if name == 'queue_declare'}
+        for queue in ('catalog.products', 'catalog.products.dead'):
+            assert declared[queue]['x-message-ttl'] == 24 * 3600 * 1000
+            assert declared[queue]['x-max-length'] == 100_000
+
+
+class FakeBroker:
+    """
+    Stands for RabbitMQ behind `pika.BlockingConnection`, the next `failures`
+    publishes break their connection.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.connections = []
+        self.published = []
+        self.commits = 0
+
+    def connect(self, parameters):
+        connection = FakeConnection(self)
+        self.connections.append(connection)
+        return connection
+
+
+class FakeConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_closed = False
+
+    @property
+    def is_open(self):
+        return not self.is_closed
+
+    def channel(self):
+        return FakeAMQPChannel(self)
+
+    def process_data_events(self, time_limit=None):
+        pass
+
+    def close(self):
+        self.is_closed = True
+
+
+class FakeAMQPChannel(RecordingChannel):
+    def __init__(self, connection):
+        super().__init__()
+        self.connection = connection
+        self.is_closed = False
+        self.transaction = None
+
+    def tx_select(self):
+        self.transaction = []
+
+    def tx_commit(self):
+        self.connection.broker.published.extend(self.transaction)
+        self.connection.broker.commits += 1
+        self.transaction = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        broker = self.connection.broker
+        if broker.failures:
+            broker.failures -= 1
+            self.connection.is_closed = self.is_closed = True
+            raise AMQPConnectionError('connection reset')
+        (broker.published if self.transaction is None else self.transaction).append(routing_key)
+
+
+class TestPublisher(APITestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        patcher = mock.patch.object(pika, 'BlockingConnection', self.broker.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.publisher = producer.Publisher(pool_size=1, acquire_timeout=0.01)
+        self.addCleanup(self.publisher.close)
+
+    def test_connection_is_reused(self):
+        for _ in range(3):
+            self.publisher.publish('quote_created', {'message': 'hello'})
+
+        assert self.broker.published == ['default.quote_created'] * 3
+        assert len(self.broker.connections) == 1
+
+    def test_failed_publish_is_retried_on_a_new_connection(self):
+        self.broker.failures = 1
+        self.publisher.publish('user_created', {})
+        assert self.broker.published == ['priority.user_created']
+        assert [connection.is_closed for connection in self.broker.connections] == [True, False]
+
+        self.broker.failures = 2
+        with self.assertRaises(AMQPConnectionError):
+            self.publisher.publish('user_created', {})
+        # The connection slot is given back, the next publish reconnects.
+        self.publisher.publish('user_created', {})
+        assert self.broker.published == ['priority.user_created'] * 2
+        assert len(self.broker.connections) == 4
+
+    def test_batch_is_flushed_in_one_transaction(self):
+        with self.publisher.batch():
+            self.publisher.publish('quote_created', {'message': 'a'})
+            with self.publisher.batch():
+                self.publisher.publish('user_created', {})
+            assert self.broker.published == []
+
+        assert self.broker.published == ['default.quote_created', 'priority.user_created']
+        assert self.broker.commits == 1
+
+        with self.assertRaises(RuntimeError), self.publisher.batch():
+            self.publisher.publish('quote_created', {'message': 'dropped'})
+            raise RuntimeError
+        assert self.broker.commits == 1
+
+    def test_pool_size_bounds_the_connections(self):
+        with self.publisher.connection():
+            with self.assertRaises(AMQPConnectionError):
+                self.publisher.publish('quote_created', {'message': 'hello'})
+        self.publisher.publish('quote_created', {'message': 'hello'})
+
+        assert len(self.broker.connections) == 1
+
+
+class TestDiscovery(APITestCase):
+    config = {'SERVER': 'registry:8761', 'APP_NAME': 'test_service', 'INSTANCE_PORT': 8000,
+              'RETRY_DELAY': 5, 'MAX_RETRY_DELAY': 12}
+
+    def setUp(self):
+        import py_eureka_client.eureka_client as eureka_client
+
+        self.calls, self.sleeps, self.failures = [], [], 0
+
+        def init(**kwargs):
+            self.calls.append(kwargs)
+            if len(self.calls) <= self.failures:
+                raise ConnectionError('registry down')
+
+        for patcher in (mock.patch.object(eureka_client, 'init', init),
+                        mock.patch.object(discovery.time, 'sleep', self.sleeps.append),
+                        mock.patch.object(discovery, '_thread', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_registration_runs_once_in_the_background(self):
+        thread = discovery.start_registration(self.config)
+        assert discovery.start_registration(self.config) is thread
+        thread.join(5)
+
+        assert thread.daemon and not thread.is_alive()
+        assert self.calls == [{'eureka_server': 'registry:8761', 'app_name': 'test_service', 'instance_port': 8000}]
+        assert self.sleeps == []
+
+    def test_failed_registration_is_retried_with_a_capped_backoff(self):
+        self.failures = 3
+        discovery.start_registration(self.config).join(5)
+
+        assert len(self.calls) == 4
+        assert self.sleeps == [5, 10, 12]
+
+
+@pytest.mark.django_db(transaction=True)
+class TestAsyncProductViews(APITransactionTestCase):
+    # The async views query from their own threads, which only see committed rows.
+
+    def setUp(self):
+        cache.clear()
+        user = get_user_model().objects.create_user('async', password='test')
+        self.token = str(RefreshToken.for_user(user).access_token)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        self.house = Product.objects.create(
+            name='house', description='big', category='residential', brand='brand1', price=10, rating=4
+        )
+        Product.objects.create(name='office', description='desk', category='commercial', brand='brand2', price=3,
+                               rating=3)
+
+    async def test_async_views_answer_like_the_sync_views(self):
+        pairs = [
+            (reverse('async-product-search') + '?brand=brand1', reverse('product-search') + '?brand=brand1'),
+            (reverse('async-product-list'), reverse('product-list')),
+            (reverse('async-product-detail', args=[self.house.pk]), reverse('product-detail', args=[self.house.pk])),
+        ]
+        for async_url, sync_url in pairs:
+            # Django 3.2's AsyncClient takes the ASGI header names, not the WSGI environ ones.
+            response = await self.async_client.get(async_url, authorization=f'Bearer {self.token}')
+            expected = await asyncio.get_running_loop().run_in_executor(None, self.client.get, sync_url)
+            assert response.status_code == status.HTTP_200_OK
+            assert json.loads(response.content) == json.loads(expected.content.replace(sync_url.encode(), async_url.encode()))
+
+        response = await self.async_client.get(reverse('async-product-list'))
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.django_db
+class TestBenchmarkSuite(APITestCase):
+
+    def test_run_benchmarks_seeds_and_writes_json_results(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            options = dict(products=30, users=2, items_per_cart=2, requests=3, concurrency='1', stdout=io.StringIO())
+            call_command('run_benchmarks', output=output, **options)
+            call_command('run_benchmarks', output=output, compare=output, **options)
+            with open(output) as file:
+                report = json.load(file)
+
+        assert report['catalogue'] == {'products': 30, 'users': 2, 'items_per_cart': 2}
+        assert Cart.objects.count() == 2
+        assert [row['scenario'] for row in report['results']] == [
+            'jwt_auth', 'search', 'product_list', 'cart_add', 'cart_list']
+        for row in report['results']:
+            assert (row['requests'], row['concurrency'], row['errors']) == (3, 1, 0)
+            assert row['p50_ms'] <= row['p99_ms']
+
+
+async def slow_view(request):
+    await asyncio.sleep(0.2)
+    return HttpResponse('ok')
+
+
+urlpatterns = [path('slow/', slow_view, name='slow')]
+
+
+@override_settings(METRICS={'SAMPLE_RATE': 1})
+class TestRequestMetrics(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        Product.objects.create(
+            name='house', description='', category='residential', brand='brand1', price=10, rating=4
+        )
+        user = get_user_model().objects.create_user('measured', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(user).access_token))
+
+    def test_sampled_request_reports_server_timing(self):
+        self.client.get(reverse('product-search'), {'category': 'residential'})
+        response = self.client.get(reverse('product-search'), {'category': 'residential'})
+
+        timing = response['Server-Timing']
+        assert timing.startswith('total;dur=')
+        # The search was cached by the first request and the user by the authentication.
+        assert 'desc="0 queries, 0 repeated"' in timing
+        assert timing.endswith('cache;desc="1 hits, 0 misses"')
+
+    def test_repeated_statements_are_counted(self):
+        request_metrics = metrics.RequestMetrics(sampled=True)
+        with connection.execute_wrapper(request_metrics):
+            for product in Product.objects.all():
+                for _ in range(3):
+                    Product.objects.filter(pk=product.pk).exists()
+
+        assert request_metrics.sql_count == 4
+        assert request_metrics.duplicate_queries == 2
+
+    def test_metrics_endpoint_exports_prometheus_text(self):
+        self.client.get(reverse('product-search'))
+        response = self.client.get(reverse('metrics'))
+
+        assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+        body = response.content.decode()
+        assert '# TYPE http_request_duration_seconds histogram' in body
+        assert 'http_requests_total{method="GET",status="200",view="product-search"}' in body
+        assert 'http_request_sql_queries_count{view="product-search"}' in body
+
+    @override_settings(ROOT_URLCONF='property.tests')
+    async def test_async_views_are_served_concurrently(self):
+        started = asyncio.get_running_loop().time()
+        responses = await asyncio.gather(*(self.async_client.get('/slow/') for _ in range(4)))
+        elapsed = asyncio.get_running_loop().time() - started
+
+        # Serialized on the sync thread, the four requests would take 0.8s.
+        assert elapsed < 0.6
+        assert all(response.status_code == 200 for response in responses)
+        assert all(response['Server-Timing'].startswith('total;dur=') for response in responses)
+        assert 'http_requests_total{method="GET",status="200",view="slow"}' in metrics.registry.render()
+
+
+
+class LaggingMonitor(db_router.ReplicaMonitor):
+
+    def __init__(self, lags):
+        super().__init__()
+        self.lags = lags
+
+    def lag(self, alias):
+        return self.lags[alias]
+
+
+@pytest.mark.django_db
+class TestReplicaRouting(APITestCase):
+    databases = {'default', 'replica_test'}
+    config = {'ALIASES': ['replica1', 'replica2'], 'MAX_LAG': 5, 'CHECK_INTERVAL': 5, 'PIN_SECONDS': 5}
+    # A database of its own (see settings.py), it only holds the rows the tests copy to it.
+    replica = {**config, 'ALIASES': ['replica_test']}
+
+    def setUp(self):
+        cache.clear()
+        db_router.monitor.mark('replica_test', healthy=True)
+        self.user = get_user_model().objects.create_user('replicated', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.user).access_token))
+
+    def test_reads_use_the_replica_until_the_request_writes(self):
+        router = db_router.ReplicaRouter()
+        seen = []
+
+        def view(request):
+            db_router.monitor.mark('replica1', healthy=True)
+            with override_settings(DATABASE_REPLICAS={**self.config, 'ALIASES': ['replica1']}):
+                db_router.use_replica(None)
+            seen.append(router.db_for_read(Product))
+            seen.append(router.db_for_write(Product))
+            seen.append(router.db_for_read(Product))
+
+        db_router.ReplicaRoutingMiddleware(view)(None)
+
+        assert seen == ['replica1', None, None]
+        assert router.db_for_read(Product) is None
+
+    def test_lagging_and_unreachable_replicas_are_skipped(self):
+        monitor = LaggingMonitor({'replica1': 60, 'replica2': 1})
+        assert monitor.pick(self.config) == 'replica2'
+
+        monitor.lags['replica2'] = float('inf')
+        # The last state is kept for CHECK_INTERVAL seconds.
+        assert monitor.pick(self.config) == 'replica2'
+        assert monitor.pick({**self.config, 'CHECK_INTERVAL': 0}) is None
+
+    def create_product(self, price=10):
+        # The replica holds a copy of the row as last replicated.
+        product = Product.objects.create(
+            name='house', description='big', category='residential', brand='brand1', price=price, rating=4)
+        Product.objects.using('replica_test').bulk_create([Product(
+            pk=product.pk, name='house', description='big', category='residential', brand='brand1', price=price,
+            rating=4)])
+        return product
+
+    def listed_prices(self, client=None):
+        response = (client or self.client).get(reverse('product-list'))
+        return [row['price'] for row in response.data['results']]
+
+    @override_settings(DATABASE_REPLICAS=replica)
+    def test_users_who_wrote_read_from_the_primary(self):
+        product = self.create_product()
+        # Only the primary has the change.
+        Product.objects.filter(pk=product.pk).update(price=15)
+
+        assert self.listed_prices() == ['10.00']
+        assert cache.get(db_router.pin_key(self.user.pk)) is None
+
+        response = self.client.patch(reverse('product-bulk'), [{'id': product.pk, 'price': 20}], format='json')
+        assert response.data['results'][0]['price'] == '20.00'
+        assert cache.get(db_router.pin_key(self.user.pk)) == 1
+        assert self.listed_prices() == ['20.00']
+        assert Product.objects.using('replica_test').get().price == 10
+
+    @override_settings(DATABASE_REPLICAS=replica)
+    def test_responses_cached_from_the_replica_are_not_served_to_pinned_users(self):
+        product = self.create_product()
+        reader = APIClient()
+        other = get_user_model().objects.create_user('reader', password='test')
+        reader.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(other).access_token))
+
+        self.client.patch(reverse('product-bulk'), [{'id': product.pk, 'price': 20}], format='json')
+        # Cached under the tag versions of the write, from the lagging replica.
+        assert self.listed_prices(reader) == ['10.00']
+        assert self.listed_prices(reader) == ['10.00']
+
+        assert self.listed_prices() == ['20.00']
+
+    @override_settings(DATABASE_REPLICAS=replica)
+    def test_search_index_is_read_from_the_primary(self):
+        search_service.reset_search_backend()
+        self.addCleanup(search_service.reset_search_backend)
+        other = search_service.InvertedIndexSearchBackend()
+        other.remove_product(0)
+        house = self.create_product()
+        self.client.get(reverse('product-search'), {'q': 'house'})
+
+        # Created by another process, the replica has not caught up yet.
+        office = Product.objects.create(
+            name='office', description='desk', category='commercial', brand='brand2', price=3, rating=3)
+        other.index_product(office)
+        self.client.get(reverse('product-search'), {'q': 'office'})
+
+        backend = search_service.get_search_backend()
+        assert backend.search('house') == [house.pk]
+        assert backend.search('office') == [office.pk]
+
+    @override_settings(DATABASE_REPLICAS=replica)
+    def test_lagging_replica_is_skipped(self):
+        self.create_product()
+        Product.objects.update(price=15)
+
+        with mock.patch.object(db_router, 'monitor', LaggingMonitor({'replica_test': 60})):
+            assert self.listed_prices() == ['15.00']
+
+    @override_settings(DATABASE_REPLICAS=replica)
+    def test_failing_replica_falls_back_to_the_primary(self):
+        self.create_product()
+        Product.objects.update(price=15)
+        with connections['replica_test'].cursor() as cursor:
+            # Rolled back with the test, SQLite schema changes are transactional.
+            cursor.execute('DROP TABLE property_product')
+
+        with self.assertLogs('utils.db_router', 'WARNING'):
+            assert self.listed_prices() == ['15.00']
+        assert not db_router.monitor.is_healthy('replica_test', {**self.replica, 'CHECK_INTERVAL': 60})
+
+    @override_settings(DATABASE_REPLICAS=replica)
+    async def test_async_requests_that_wrote_pin_their_user(self):
+        product = await sync_to_async(self.create_product)()
+        authorization = self.client._credentials['HTTP_AUTHORIZATION']
+
+        response = await self.async_client.patch(
+            reverse('product-bulk'), [{'id': product.pk, 'price': 20}], content_type='application/json',
+            AUTHORIZATION=authorization)
+
+        assert response.status_code == 200
+        assert await sync_to_async(cache.get)(db_router.pin_key(self.user.pk)) == 1
+        assert await sync_to_async(self.listed_prices)() == ['20.00']
@@ -1,6 +1,9 @@
 from django.urls import path
 
-from property.domain.views import ProductSearchView
+from property.domain import async_views
+from property.domain.views import (
+    ProductCacheStatsView, ProductExportView, ProductImportView, ProductSearchView, ProductStatsView
+)
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -9,6 +12,13 @@ from rest_framework_simplejwt.views import (
 
 urlpatterns = [
     path('search/', ProductSearchView.as_view(), name='product-search'),
+    path('async/search/', async_views.product_search, name='async-product-search'),
+    path('async/product/', async_views.product_list, name='async-product-list'),
+    path('async/product/<int:pk>/', async_views.product_detail, name='async-product-detail'),
+    path('products/export/', ProductExportView.as_view(), name='product-export'),
+    path('products/import/', ProductImportView.as_view(), name='product-import'),
+    path('products/stats/', ProductStatsView.as_view(), name='product-stats'),
+    path('cache/stats/', ProductCacheStatsView.as_view(), name='product-cache-stats'),
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/token/verify/', TokenVerifyView.as_view(), name='token_verify'),
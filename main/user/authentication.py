@@ -0,0 +1,112 @@
+"""
+JWT authentication with the verified tokens and their users cached in process.
+
+The stock `JWTAuthentication` verifies the HS256 signature of the access
+token and selects its `User` on every request. `CachedJWTAuthentication`
+keeps the validated tokens, keyed by the raw token so that only the exact
+bytes that were verified are trusted, until their `exp`, and the users in a
+small LRU for `USER_TTL` seconds. Saving or deleting a user drops it from the
+cache of the process doing it; the other processes see the change after at
+most `USER_TTL` seconds.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from utils import metrics
+
+
+def get_config():
+    return {"TOKENS": 10_000, "USERS": 1_000, "USER_TTL": 60, **getattr(settings, "JWT_AUTH_CACHE", {})}
+
+
+class LRUCache:
+    """
+    Thread safe mapping of at most `size` entries, each valid until its own
+    expiry time.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires):
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+tokens = LRUCache(get_config()["TOKENS"])
+users = LRUCache(get_config()["USERS"])
+
+LOOKUPS = metrics.registry.counter("jwt_auth_cache_total", "Token and user cache lookups of the JWT authentication.")
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+
+    def get_validated_token(self, raw_token):
+        token = tokens.get(raw_token)
+        if token is not None:
+            LOOKUPS.inc(cache="token", result="hit")
+            return token
+        LOOKUPS.inc(cache="token", result="miss")
+        token = super().get_validated_token(raw_token)
+        tokens.set(raw_token, token, token["exp"])
+        return token
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        user = users.get(user_id) if user_id is not None else None
+        if user is None:
+            LOOKUPS.inc(cache="user", result="miss")
+            user = super().get_user(validated_token)
+            users.set(user_id, user, time.time() + get_config()["USER_TTL"])
+        else:
+            LOOKUPS.inc(cache="user", result="hit")
+            if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(
+                    api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+        # Requests may annotate their user (permission caches...), they get their own copy.
+        return copy.copy(user)
+
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def forget_user(sender, instance, **kwargs):
+    users.pop(getattr(instance, api_settings.USER_ID_FIELD))
@@ -1 +1,58 @@
-# Create your tests here.
+import pytest
+from django.contrib.auth import get_user_model
+from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.tokens import AccessToken
+
+from user import authentication
+
+
+@pytest.mark.django_db
+class TestCachedJWTAuthentication(APITestCase):
+
+    def setUp(self):
+        authentication.tokens.clear()
+        authentication.users.clear()
+        self.user = get_user_model().objects.create_user('cached', password='test')
+        self.token = str(AccessToken.for_user(self.user))
+        self.auth = authentication.CachedJWTAuthentication()
+
+    def authenticate(self, token):
+        return self.auth.authenticate(APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {token}'))
+
+    def test_known_token_is_authenticated_without_queries(self):
+        first, _ = self.authenticate(self.token)
+        with self.assertNumQueries(0):
+            second, validated = self.authenticate(self.token)
+
+        assert first == second == self.user
+        assert second is not first
+        assert validated['user_id'] == self.user.pk
+
+    def test_saved_user_is_reloaded(self):
+        self.authenticate(self.token)
+        self.user.is_active = False
+        self.user.save()
+
+        with pytest.raises(AuthenticationFailed):
+            self.authenticate(self.token)
+
+    def test_only_the_verified_token_is_cached(self):
+        self.authenticate(self.token)
+        header, payload, signature = self.token.split('.')
+        tampered = '.'.join([header, payload, signature[:-4] + ('AAAA' if signature[-4:] != 'AAAA' else 'BBBB')])
+
+        with pytest.raises(InvalidToken):
+            self.authenticate(tampered)
+
+    def test_lru_cache_evicts_least_recently_used_and_expired_entries(self):
+        cache = authentication.LRUCache(2)
+        cache.set('a', 1, expires=100)
+        cache.set('b', 2, expires=200)
+        assert cache.get('a', now=50) == 1
+        cache.set('c', 3, expires=300)
+
+        assert cache.get('b', now=50) is None
+        assert cache.get('a', now=150) is None
+        assert cache.get('c', now=150) == 3
+        assert len(cache) == 1
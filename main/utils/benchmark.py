@@ -0,0 +1,128 @@
+import gc
+import itertools
+import logging
+import statistics
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def measure(function, repeat=20, warmup=2):
+    """
+    Call `function` `warmup` + `repeat` times and return the timings of the
+    measured calls in milliseconds. The garbage collector is paused while
+    measuring so that collections do not land on a random run.
+    """
+    for _ in range(warmup):
+        function()
+    timings = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - started) * 1000)
+    finally:
+        if enabled:
+            gc.enable()
+    return {
+        "runs": repeat,
+        "best_ms": min(timings),
+        "median_ms": statistics.median(timings),
+        "mean_ms": statistics.fmean(timings),
+    }
+
+
+def compare(candidates, repeat=20, warmup=2):
+    """
+    Measure every (name, function) of `candidates` and return one row per
+    candidate, with its median speedup over the first one.
+    """
+    rows = []
+    for name, function in candidates:
+        rows.append({"name": name, **measure(function, repeat=repeat, warmup=warmup)})
+    baseline = rows[0]["median_ms"] if rows else None
+    for row in rows:
+        row["speedup"] = baseline / row["median_ms"] if row["median_ms"] else None
+    return rows
+
+
+def format_table(rows):
+    lines = [f"{'name':<24} {'best ms':>10} {'median ms':>10} {'mean ms':>10} {'speedup':>8}"]
+    for row in rows:
+        speedup = f"{row['speedup']:.2f}x" if row["speedup"] else "-"
+        lines.append(f"{row['name']:<24} {row['best_ms']:>10.2f} {row['median_ms']:>10.2f} "
+                     f"{row['mean_ms']:>10.2f} {speedup:>8}")
+    return "\n".join(lines)
+
+
+def percentile(timings, fraction):
+    """
+    The `fraction` percentile of the sorted `timings`.
+    """
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def run_load(make_call, requests=200, concurrency=1, on_thread_exit=None):
+    """
+    Make `requests` calls from `concurrency` threads and return the
+    throughput and the latency percentiles in milliseconds.
+
+    Every thread calls its own function, made by `make_call()` (e.g. with its
+    own HTTP client), until the requests are spent, then `on_thread_exit()`.
+    A call fails when it raises or returns False. With a concurrency of 1
+    the calls are made on the calling thread.
+    """
+    counter = itertools.count()
+    timings = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        call = make_call()
+        local_timings, local_errors = [], 0
+        while next(counter) < requests:
+            started = time.perf_counter()
+            try:
+                ok = call() is not False
+            except Exception:
+                logger.warning("benchmark call failed", exc_info=True)
+                ok = False
+            local_timings.append((time.perf_counter() - started) * 1000)
+            local_errors += not ok
+        with lock:
+            timings.extend(local_timings)
+            errors.append(local_errors)
+
+    def thread_main():
+        try:
+            worker()
+        finally:
+            if on_thread_exit is not None:
+                on_thread_exit()
+
+    started = time.perf_counter()
+    if concurrency == 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=thread_main, name=f"load-{n}") for n in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    seconds = time.perf_counter() - started
+
+    timings.sort()
+    return {
+        "requests": len(timings),
+        "concurrency": concurrency,
+        "errors": sum(errors),
+        "seconds": round(seconds, 3),
+        "throughput": round(len(timings) / seconds, 2) if seconds else None,
+        "p50_ms": round(percentile(timings, 0.50), 3) if timings else None,
+        "p90_ms": round(percentile(timings, 0.90), 3) if timings else None,
+        "p99_ms": round(percentile(timings, 0.99), 3) if timings else None,
+        "max_ms": round(timings[-1], 3) if timings else None,
+    }
@@ -0,0 +1,266 @@
+"""
+Read replica routing.
+
+The replicas of `default` are the aliases of `DATABASE_REPLICAS["ALIASES"]`.
+Only the views using `ReplicaReadMixin` read from them, for their safe
+requests; everything else, and every write, goes to `default`:
+
+- a request is pinned to the primary from its first write on (including
+  `select_for_update()`), and its user for `PIN_SECONDS` afterwards (in the
+  shared cache), so users read their own writes;
+- replicas that cannot be reached or lag more than `MAX_LAG` seconds are
+  skipped, their state is checked at most every `CHECK_INTERVAL` seconds
+  per process, and a view failing on a replica is run again on the
+  primary.
+
+Without replicas the router sends everything to `default` as before.
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, connections
+from rest_framework.permissions import SAFE_METHODS
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+REQUESTS = metrics.registry.counter("db_replica_requests_total",
+                                    "Replica eligible requests by the database serving their reads.")
+
+
+def get_config():
+    return {
+        "ALIASES": [], "MAX_LAG": 5, "CHECK_INTERVAL": 5, "PIN_SECONDS": 5,
+        **getattr(settings, "DATABASE_REPLICAS", {}),
+    }
+
+
+class ReplicaMonitor:
+    """
+    Health of the replicas as last checked by this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = {}
+
+    def mark(self, alias, healthy):
+        with self._lock:
+            self._status[alias] = (healthy, time.monotonic())
+
+    def is_healthy(self, alias, config):
+        with self._lock:
+            healthy, checked = self._status.get(alias, (True, None))
+            if checked is not None and time.monotonic() - checked < config["CHECK_INTERVAL"]:
+                return healthy
+            # Other requests keep the last known state while this one checks.
+            self._status[alias] = (healthy, time.monotonic())
+        healthy = self.check(alias, config)
+        self.mark(alias, healthy)
+        return healthy
+
+    def check(self, alias, config):
+        try:
+            lag = self.lag(alias)
+        except DatabaseError as error:
+            logger.warning("replica %s is unavailable: %s", alias, error)
+            return False
+        if lag is not None and lag > config["MAX_LAG"]:
+            logger.warning("replica %s lags %s seconds", alias, lag)
+            return False
+        return True
+
+    def lag(self, alias):
+        """
+        Seconds the replica `alias` is behind its source, None when unknown.
+        """
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            if connection.vendor != "mysql":
+                cursor.execute("SELECT 1")
+                return None
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+                column = "Seconds_Behind_Source"
+            except DatabaseError:
+                cursor.execute("SHOW SLAVE STATUS")
+                column = "Seconds_Behind_Master"
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            lag = dict(zip([description[0] for description in cursor.description], row)).get(column)
+        # NULL: the replication is stopped.
+        return float("inf") if lag is None else lag
+
+    def pick(self, config):
+        healthy = [alias for alias in config["ALIASES"] if self.is_healthy(alias, config)]
+        return random.choice(healthy) if healthy else None
+
+
+monitor = ReplicaMonitor()
+
+
+class RoutingState:
+    def __init__(self):
+        self.replica = None
+        self.replica_used = False
+        self.wrote = False
+
+
+_state = contextvars.ContextVar("db_routing", default=None)
+
+
+def pin_key(user_id):
+    return f"db-pin:{user_id}"
+
+
+def use_replica(user):
+    """
+    Send the reads of the current request to a healthy replica unless it
+    wrote already or its user has written in the last `PIN_SECONDS`.
+    """
+    state, config = _state.get(), get_config()
+    if state is None or state.wrote or not config["ALIASES"]:
+        return None
+    if user is not None and user.is_authenticated:
+        try:
+            pinned = caches["default"].get(pin_key(user.pk))
+        except Exception:
+            logger.exception("cannot read the primary pin of user %s", user.pk)
+            pinned = True
+        if pinned:
+            REQUESTS.inc(database="primary", reason="pinned")
+            return None
+    state.replica = monitor.pick(config)
+    REQUESTS.inc(database="replica" if state.replica else "primary",
+                 reason="healthy" if state.replica else "unavailable")
+    return state.replica
+
+
+def use_primary():
+    state = _state.get()
+    if state is not None:
+        state.replica = None
+
+
+def read_replica():
+    """
+    The replica the next reads of the current request go to, None for the
+    primary.
+    """
+    state = _state.get()
+    return state.replica if state is not None and not state.wrote else None
+
+
+def replica_in_use():
+    """
+    The replica the current request has read from, if any.
+    """
+    state = _state.get()
+    return state.replica if state is not None and state.replica_used else None
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state.replica is None or state.wrote:
+            return None
+        state.replica_used = True
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return False if db in get_config()["ALIASES"] else None
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Give every request its routing state, and pin the users of the requests
+    that wrote to the primary for `PIN_SECONDS`. Runs in the mode of the
+    handler, WSGI or ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if state.wrote and get_config()["ALIASES"]:
+            self.pin(request)
+        return response
+
+    async def __acall__(self, request):
+        state = RoutingState()
+        # The sync code of the request runs in copies of this context.
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        if state.wrote and get_config()["ALIASES"]:
+            # The user may still be lazy, and the cache client is sync.
+            await sync_to_async(self.pin)(request)
+        return response
+
+    def pin(self, request):
+        user = getattr(request, "user", None)
+        if user is None or not user.is_authenticated:
+            return
+        try:
+            caches["default"].set(pin_key(user.pk), 1, get_config()["PIN_SECONDS"])
+        except Exception:
+            logger.exception("cannot pin user %s to the primary", user.pk)
+
+
+class ReplicaReadMixin:
+    """
+    Serve the safe requests of the view, or of its `replica_actions`, from a
+    read replica.
+    """
+    replica_actions = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and (
+                self.replica_actions is None or getattr(self, "action", None) in self.replica_actions):
+            use_replica(request.user)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except DatabaseError:
+            alias = replica_in_use()
+            if alias is None:
+                raise
+            logger.warning("replica %s failed, answering from the primary", alias, exc_info=True)
+            monitor.mark(alias, healthy=False)
+            use_primary()
+            return super().dispatch(request, *args, **kwargs)
@@ -0,0 +1,42 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_thread = None
+
+
+def start_registration(config):
+    """
+    Register the service in Eureka from a daemon thread and return at once.
+
+    Called by the WSGI/ASGI application, not at settings import, so that
+    management commands, tests and workers never wait for the registry. A
+    failed registration is retried with a growing delay, once registered the
+    Eureka client sends its heartbeats from its own thread.
+    """
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_register, args=(config,), name="eureka-registration", daemon=True)
+            _thread.start()
+    return _thread
+
+
+def _register(config):
+    import py_eureka_client.eureka_client as eureka_client
+
+    delay = config["RETRY_DELAY"]
+    while True:
+        try:
+            eureka_client.init(eureka_server=config["SERVER"], app_name=config["APP_NAME"],
+                               instance_port=config["INSTANCE_PORT"])
+        except Exception:
+            logger.warning("Eureka registration failed, retrying in %ss", delay, exc_info=True)
+            time.sleep(delay)
+            delay = min(delay * 2, config["MAX_RETRY_DELAY"])
+            continue
+        logger.info("registered %s in Eureka", config["APP_NAME"])
+        return
@@ -0,0 +1,223 @@
+import json
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaError(ValueError):
+    pass
+
+
+class Envelope:
+    """
+    An event sent between the services: its name, the version of its payload
+    schema, a unique id and when it happened, in epoch seconds. Delivery is at
+    least once, a redelivered event keeps its id.
+
+    On the wire the payload is the message body, encoded by a codec, and the
+    rest is carried by the AMQP properties (type, message_id, timestamp and a
+    `version` header), see `encode()`.
+    """
+
+    __slots__ = ("event", "payload", "version", "id", "occurred_at")
+
+    def __init__(self, event, payload, version=1, id=None, occurred_at=None):
+        self.event = event
+        self.payload = payload
+        self.version = version
+        self.id = id or uuid.uuid4().hex
+        self.occurred_at = time.time() if occurred_at is None else occurred_at
+
+    def __eq__(self, other):
+        return isinstance(other, Envelope) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f"<Envelope {self.event} v{self.version} {self.id}>"
+
+
+class JSONCodec:
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, payload):
+        return json.dumps(payload, separators=(",", ":")).encode()
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    """
+    Smaller and faster than JSON for the same payloads. Needs the `msgpack`
+    package, it is only imported when the codec is first used.
+    """
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def __init__(self):
+        self._msgpack = None
+
+    @property
+    def msgpack(self):
+        if self._msgpack is None:
+            try:
+                import msgpack
+            except ImportError as exc:
+                raise RuntimeError("the msgpack codec requires the msgpack package") from exc
+            self._msgpack = msgpack
+        return self._msgpack
+
+    def encode(self, payload):
+        return self.msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec(), MsgpackCodec())}
+
+
+def get_codec(name):
+    """
+    Return a codec by its name or its content type, None when unknown.
+    """
+    codec = CODECS.get(name)
+    if codec is None:
+        codec = next((codec for codec in CODECS.values() if codec.content_type == name), None)
+    return codec
+
+
+class SchemaRegistry:
+    """
+    The payload schemas of the events, by name and version.
+
+    A schema lists the required payload fields with their type. A version may
+    come with an `upgrade` function turning a payload of the previous version
+    into its own, consumers then receive every event at its latest version.
+    Events without a registered schema are passed through unchecked.
+    """
+
+    def __init__(self):
+        self._schemas = {}
+
+    def register(self, event, version=1, fields=None, upgrade=None):
+        self._schemas.setdefault(event, {})[version] = (dict(fields or {}), upgrade)
+
+    @property
+    def events(self):
+        return set(self._schemas)
+
+    def validate(self, envelope):
+        schema = self._schemas.get(envelope.event, {}).get(envelope.version)
+        if schema is None:
+            if envelope.event in self._schemas:
+                raise SchemaError(f"unknown version {envelope.version} of {envelope.event}")
+            return envelope
+        if not isinstance(envelope.payload, dict):
+            raise SchemaError(f"{envelope.event} payload must be an object")
+        for name, kind in schema[0].items():
+            if name not in envelope.payload:
+                raise SchemaError(f"{envelope.event} v{envelope.version} payload misses {name}")
+            if not isinstance(envelope.payload[name], kind):
+                raise SchemaError(f"{envelope.event} v{envelope.version} {name} must be a {kind.__name__}")
+        return envelope
+
+    def upgrade(self, envelope):
+        """
+        Return `envelope` upgraded to the latest version of its schema.
+        """
+        versions = self._schemas.get(envelope.event)
+        if not versions:
+            return envelope
+        payload, version = envelope.payload, envelope.version
+        while version < max(versions):
+            version += 1
+            if version not in versions or versions[version][1] is None:
+                raise SchemaError(f"no upgrade of {envelope.event} to version {version}")
+            payload = versions[version][1](payload)
+        upgraded = Envelope(envelope.event, payload, version, envelope.id, envelope.occurred_at)
+        return self.validate(upgraded)
+
+
+schemas = SchemaRegistry()
+schemas.register("quote_created", 1, {"message": str})
+schemas.register("user_created", 1, {})
+schemas.register("products_changed", 1, {"action": str, "ids": list, "count": int})
+
+
+def encode(envelope, codec="json", registry=schemas, **properties):
+    """
+    Return the body and the `pika.BasicProperties` arguments of `envelope`.
+    `properties` are extra arguments (delivery_mode, headers...), the headers
+    are merged with the envelope ones.
+    """
+    codec = get_codec(codec)
+    registry.validate(envelope)
+    headers = {**(properties.pop("headers", None) or {}), "version": envelope.version}
+    return codec.encode(envelope.payload), {
+        **properties,
+        "content_type": codec.content_type,
+        "type": envelope.event,
+        "message_id": envelope.id,
+        "timestamp": int(envelope.occurred_at),
+        "headers": headers,
+    }
+
+
+def decode(properties, body, registry=schemas):
+    """
+    Return the envelope of a received message, upgraded to the latest
+    version of its schema.
+
+    Messages published before the envelope carried the event name as content
+    type and a JSON body, they are read as version 1 of that event.
+    """
+    codec = get_codec(properties.content_type)
+    if codec is None:
+        envelope = Envelope(properties.content_type, json.loads(body), 1, properties.message_id,
+                            properties.timestamp)
+    else:
+        headers = properties.headers or {}
+        envelope = Envelope(properties.type, codec.decode(body), headers.get("version", 1), properties.message_id,
+                            properties.timestamp)
+    return registry.upgrade(envelope)
+
+
+class EventRouter:
+    """
+    A consumer handler dispatching the decoded envelopes to the handler of
+    their event:
+
+        router = EventRouter()
+
+        @router.route("user_created")
+        def send_welcome(envelope):
+            ...
+
+    Events without a handler are acked and dropped, or passed to `default`.
+    The router is called with (properties, body), like the handlers of
+    `ConsumerRuntime`, and returns what the event handler returned.
+    """
+
+    def __init__(self, registry=schemas, default=None):
+        self.registry = registry
+        self.default = default
+        self.handlers = {}
+
+    def route(self, *events):
+        def decorator(handler):
+            for event in events:
+                self.handlers[event] = handler
+            return handler
+        return decorator
+
+    def __call__(self, properties, body):
+        envelope = decode(properties, body, self.registry)
+        handler = self.handlers.get(envelope.event, self.default)
+        if handler is None:
+            logger.info("ignoring %s event", envelope.event)
+            return None
+        return handler(envelope)
@@ -0,0 +1,143 @@
+import decimal
+
+from rest_framework import fields, relations
+from rest_framework.settings import api_settings
+
+from utils import metrics
+
+
+def _identity(value):
+    return value
+
+
+def _to_str(value):
+    return value if type(value) is str else str(value)
+
+
+def _choice(field):
+    choices = field.choice_strings_to_values
+
+    def convert(value):
+        if value == "":
+            return value
+        return choices.get(_to_str(value), value)
+
+    return convert
+
+
+def _decimal(field):
+    coerce_to_string = getattr(field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING)
+    if not coerce_to_string or field.localize or field.decimal_places is None:
+        return field.to_representation
+    exponent = -field.decimal_places
+
+    def convert(value):
+        # Database values already have the column scale, quantize() would be a no-op.
+        if isinstance(value, decimal.Decimal) and value.as_tuple().exponent == exponent:
+            return "{:f}".format(value)
+        return field.to_representation(value)
+
+    return convert
+
+
+def _datetime(field):
+    output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+    if output_format is None or output_format.lower() != fields.ISO_8601:
+        return field.to_representation
+
+    def bind():
+        field_timezone = getattr(field, "timezone", field.default_timezone())
+        if field_timezone is None:
+            return field.to_representation
+
+        def convert(value):
+            if value.tzinfo is None:
+                return field.to_representation(value)
+            value = value.astimezone(field_timezone).isoformat()
+            if value.endswith("+00:00"):
+                value = value[:-6] + "Z"
+            return value
+
+        return convert
+
+    # The current time zone can change between requests, resolve it for each call.
+    bind.per_call = True
+    return bind
+
+
+def compile_converter(field):
+    """
+    Return a function with the same result as `field.to_representation` for
+    the raw column value read by `.values()`, with the field options resolved
+    once instead of on every call.
+    """
+    if isinstance(field, relations.PrimaryKeyRelatedField) and field.pk_field is None:
+        return _identity
+    if isinstance(field, fields.ReadOnlyField):
+        return _identity
+    if isinstance(field, fields.ChoiceField):
+        return _choice(field)
+    if type(field) in (fields.CharField, fields.EmailField, fields.SlugField, fields.URLField):
+        return _to_str
+    if type(field) is fields.IntegerField:
+        return int
+    if type(field) is fields.FloatField:
+        return float
+    if type(field) is fields.DecimalField:
+        return _decimal(field)
+    if type(field) is fields.DateTimeField:
+        return _datetime(field)
+    return field.to_representation
+
+
+class ValuesSerializer:
+    """
+    Read-only fast path of a `ModelSerializer`.
+
+    The fields of `serializer_class` are compiled once into (output name,
+    `.values()` key, converter) triples, rows are then read with
+    `queryset.values()` and turned into dicts without model instances,
+    `get_attribute()` lookups or per-field introspection. The output is the
+    same as `serializer_class(instances, many=True).data`.
+    """
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self._compiled = None
+
+    def compile(self):
+        if self._compiled is None:
+            compiled = []
+            for name, field in self.serializer_class().fields.items():
+                if field.write_only:
+                    continue
+                if field.source == "*" or isinstance(field, (fields.SerializerMethodField, relations.ManyRelatedField)):
+                    raise TypeError(f"{self.serializer_class.__name__}.{name} cannot be read from .values()")
+                compiled.append((name, field.source.replace(".", "__"), compile_converter(field)))
+            self._compiled = compiled
+        return self._compiled
+
+    @property
+    def sources(self):
+        return [source for _, source, _ in self.compile()]
+
+    def values(self, queryset):
+        return queryset.values(*self.sources)
+
+    def to_representation(self, rows):
+        compiled = [
+            (name, source, converter() if getattr(converter, "per_call", False) else converter)
+            for name, source, converter in self.compile()
+        ]
+        data = []
+        with metrics.timed("serialize"):
+            for row in rows:
+                item = {}
+                for name, source, converter in compiled:
+                    value = row[source]
+                    item[name] = None if value is None else converter(value)
+                data.append(item)
+        return data
+
+    def serialize(self, queryset):
+        return self.to_representation(self.values(queryset))
@@ -1,15 +1,203 @@
-import json
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
 import pika
+from pika.exceptions import AMQPChannelError, AMQPConnectionError
+
+from utils import envelope, routing
+
+logger = logging.getLogger(__name__)
+
+CONNECTION_PARAMETERS = pika.ConnectionParameters(
+    "rabbitmq",
+    5672,
+    "/",
+    pika.PlainCredentials("guest", "guest"),
+    heartbeat=60,
+    blocked_connection_timeout=30,
+)
+
+# Errors after which a pooled connection is dropped and the publish retried on a new one.
+RECONNECT_ERRORS = (AMQPConnectionError, AMQPChannelError, ConnectionError, OSError)
+
+
+class PooledConnection:
+    """
+    A long-lived connection with one channel in publisher confirm mode, used for
+    single messages, and one transactional channel, used to flush batches.
+    """
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.connection = None
+        self.confirm_channel = None
+        self.tx_channel = None
+        self.last_used = 0
+
+    def open(self):
+        if self.connection is None or self.connection.is_closed:
+            self.connection = pika.BlockingConnection(self.parameters)
+            self.confirm_channel = self.tx_channel = None
+            channel = self.connection.channel()
+            routing.declare(channel)
+            channel.close()
+        elif time.monotonic() - self.last_used > self.parameters.heartbeat / 2:
+            # An idle blocking connection only answers heartbeats when it is used.
+            self.connection.process_data_events(time_limit=0)
+        self.last_used = time.monotonic()
+        return self.connection
+
+    def get_confirm_channel(self):
+        connection = self.open()
+        if self.confirm_channel is None or self.confirm_channel.is_closed:
+            self.confirm_channel = connection.channel()
+            self.confirm_channel.confirm_delivery()
+        return self.confirm_channel
+
+    def get_tx_channel(self):
+        connection = self.open()
+        if self.tx_channel is None or self.tx_channel.is_closed:
+            self.tx_channel = connection.channel()
+            self.tx_channel.tx_select()
+        return self.tx_channel
+
+    def close(self):
+        connection, self.connection = self.connection, None
+        self.confirm_channel = self.tx_channel = None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except RECONNECT_ERRORS:
+                logger.warning("error closing RabbitMQ connection", exc_info=True)
+
+
+class Publisher:
+    """
+    Thread-safe RabbitMQ publisher backed by a pool of persistent connections.
+
+    Connections are opened lazily, reused across calls and replaced when they
+    break, a failed publish is retried once on a fresh connection. Single
+    messages are confirmed by the broker; inside `batch()` messages are
+    collected and flushed with one transaction commit.
+    """
+
+    def __init__(self, parameters=CONNECTION_PARAMETERS, pool_size=4, acquire_timeout=5, retries=1, codec="json"):
+        self.parameters = parameters
+        self.codec = codec
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        self.retries = retries
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def connection(self):
+        pooled = self._checkout()
+        try:
+            yield pooled
+        except RECONNECT_ERRORS:
+            pooled.close()
+            raise
+        finally:
+            self._idle.put(pooled)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                return PooledConnection(self.parameters)
+        try:
+            return self._idle.get(timeout=self.acquire_timeout)
+        except queue.Empty:
+            raise AMQPConnectionError("no RabbitMQ connection available in the publisher pool")
+
+    def publish(self, method, body, routing_key=None, exchange=routing.EXCHANGE, properties=None, lane=None):
+        """
+        Publish `body` as the payload of a `method` event, or `body` itself when
+        it already is an `Envelope`, encoded with the publisher codec.
+
+        The event goes to the topic exchange with the routing key of its
+        `lane` (see `routing.routing_key`) unless `routing_key` is given.
+        `properties` are extra `pika.BasicProperties` arguments (delivery_mode,
+        headers...).
+        """
+        if not isinstance(body, envelope.Envelope):
+            body = envelope.Envelope(method, body)
+        if routing_key is None:
+            routing_key = routing.routing_key(body.event, lane)
+        data, arguments = envelope.encode(body, self.codec, **(properties or {}))
+        message = (exchange, routing_key, data, pika.BasicProperties(**arguments))
+        pending = getattr(self._local, "batch", None)
+        if pending is not None:
+            pending.append(message)
+            return
+        self._with_retries(self._publish_confirmed, message)
+
+    def _publish_confirmed(self, pooled, message):
+        exchange, routing_key, body, properties = message
+        pooled.get_confirm_channel().basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                                   properties=properties)
+
+    @contextmanager
+    def batch(self):
+        """
+        Collect every `publish()` of the block and send them in one flush when
+        it exits without error.
+        """
+        if getattr(self._local, "batch", None) is not None:
+            yield self
+            return
+        self._local.batch = messages = []
+        try:
+            yield self
+        finally:
+            self._local.batch = None
+        if messages:
+            self.flush(messages)
+
+    def flush(self, messages):
+        self._with_retries(self._publish_transaction, messages)
+
+    def _publish_transaction(self, pooled, messages):
+        channel = pooled.get_tx_channel()
+        for exchange, routing_key, body, properties in messages:
+            channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+        channel.tx_commit()
+
+    def _with_retries(self, send, payload):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as pooled:
+                    return send(pooled, payload)
+            except RECONNECT_ERRORS:
+                if attempt == self.retries:
+                    raise
+                logger.warning("RabbitMQ publish failed, reconnecting", exc_info=True)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+
+publisher = Publisher(codec=os.environ.get("EVENT_CODEC", "json"))
+atexit.register(publisher.close)
 
 
 def publish(method, body):
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(
-            "rabbitmq", 5672, "/", pika.PlainCredentials("guest", "guest")
-        )
-    )
-    channel = connection.channel()
-    properties = pika.BasicProperties(method)
-    channel.basic_publish(
-        exchange="", routing_key="likes", body=json.dumps(body), properties=properties
-    )
+    publisher.publish(method, body)
@@ -0,0 +1,82 @@
+import re
+
+from django.db import connections, router
+
+SQLITE_FULL_SCAN = re.compile(r"^SCAN (TABLE )?\S+$")
+SQLITE_SORT = re.compile(r"^USE TEMP B-TREE FOR (RIGHT PART OF )?ORDER BY")
+SQLITE_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+POSTGRESQL_INDEX = re.compile(r"Index (?:Only )?Scan (?:Backward )?using (\w+)")
+
+
+def explain(queryset):
+    """
+    Run EXPLAIN for `queryset` and return the plan as a list of dicts.
+    """
+    using = queryset.db or router.db_for_read(queryset.model)
+    connection = connections[using]
+    sql, params = queryset.query.sql_with_params()
+    prefix = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def plan_problems(queryset):
+    """
+    Return a description of every full table scan or filesort in the plan of
+    `queryset`, an empty list means the query is fully served by indexes.
+    """
+    vendor = connections[queryset.db].vendor
+    problems = []
+    for row in explain(queryset):
+        if vendor == "mysql":
+            extra = row.get("Extra") or ""
+            if row.get("type") == "ALL":
+                problems.append(f"full scan of {row.get('table')}")
+            if "Using filesort" in extra:
+                problems.append(f"filesort on {row.get('table')}")
+        elif vendor == "sqlite":
+            detail = row.get("detail", "")
+            if SQLITE_FULL_SCAN.match(detail):
+                problems.append(f"full scan: {detail}")
+            if SQLITE_SORT.match(detail):
+                problems.append(f"filesort: {detail}")
+        elif vendor == "postgresql":
+            line = next(iter(row.values()))
+            if "Seq Scan" in line:
+                problems.append(f"full scan: {line.strip()}")
+            if re.search(r"\bSort\b", line):
+                problems.append(f"filesort: {line.strip()}")
+    return problems
+
+
+def used_indexes(queryset):
+    """
+    Return the names of the indexes in the plan of `queryset`, in plan order.
+    """
+    vendor = connections[queryset.db].vendor
+    indexes = []
+    for row in explain(queryset):
+        if vendor == "mysql":
+            name = row.get("key")
+        else:
+            line = row.get("detail", "") if vendor == "sqlite" else next(iter(row.values()))
+            match = (SQLITE_INDEX if vendor == "sqlite" else POSTGRESQL_INDEX).search(line)
+            name = match and match.group(1)
+        if name:
+            indexes.append(name)
+    return indexes
+
+
+def analyze(model, using="default"):
+    """
+    Refresh the optimizer statistics of `model`'s table.
+    """
+    connection = connections[using]
+    table = connection.ops.quote_name(model._meta.db_table)
+    statement = f"ANALYZE TABLE {table}" if connection.vendor == "mysql" else f"ANALYZE {table}"
+    with connection.cursor() as cursor:
+        cursor.execute(statement)
+        if connection.vendor == "mysql":
+            cursor.fetchall()
@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
+from utils import discovery
+
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "my_microservice.settings")
 
 application = get_asgi_application()
+
+discovery.start_registration(settings.EUREKA)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -38,6 +39,7 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     # apps
+    "notification",
     # packages
     "rest_framework",
     "drf_yasg",
@@ -45,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "utils.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -147,10 +150,48 @@ Q_CLUSTER = {
 
 REST_FRAMEWORK = {"EXCEPTION_HANDLER": "utils.utils.custom_exception_handler"}
 
-import py_eureka_client.eureka_client as eureka_client
+# Set EMAIL_BACKEND to "django.core.mail.backends.filebased.EmailBackend" to write the
+# emails to EMAIL_FILE_PATH, or to the SMTP backend in production.
+EMAIL_BACKEND = os.environ.get("EMAIL_BACKEND", "django.core.mail.backends.console.EmailBackend")
+EMAIL_FILE_PATH = os.environ.get("EMAIL_FILE_PATH", BASE_DIR / "sent_emails")
+DEFAULT_FROM_EMAIL = "no-reply@property-hunt.local"
+
+# Notification emails are sent in batches of up to BATCH_SIZE, or after BATCH_WINDOW seconds. The
+# mail connection is closed after IDLE_TIMEOUT seconds without emails, keep it below the server's.
+NOTIFICATION_EMAIL = {
+    "BATCH_SIZE": 50,
+    "BATCH_WINDOW": 1.0,
+    "IDLE_TIMEOUT": 30.0,
+    "DEFAULT_RECIPIENT": "omer@property-hunt.local",
+}
+
+# `manage.py consume_events` defaults. PREFETCH bounds the messages in flight: keep it at least
+# WORKERS, and at least NOTIFICATION_EMAIL["BATCH_SIZE"] for batches to fill up.
+# One consumer process per queue of `utils.routing.QUEUES`, e.g. a second one
+# with --queue notifications.email.priority for the priority lane. The consumer serves its
+# metrics (email batches...) on METRICS_PORT, give every process of a host its own port.
+NOTIFICATION_CONSUMER = {
+    "QUEUE": "notifications.email",
+    "PREFETCH": 64,
+    "WORKERS": 8,
+    "METRICS_PORT": int(os.environ.get("CONSUMER_METRICS_PORT", 8002)),
+}
 
-your_rest_server_port = 8001
-# The flowing code will register your server to eureka server and also start to send heartbeat every 30 seconds
-eureka_client.init(eureka_server="service-registry:8761",
-                   app_name="django_notification_service",
-                   instance_port=your_rest_server_port)
+# Request metrics of `utils.metrics`, served on /metrics. A SAMPLE_RATE share of the requests also
+# counts its SQL, cache and serializer time and answers with a Server-Timing header; a statement
+# repeated DUPLICATE_THRESHOLD times in one request is logged as a likely N+1.
+METRICS = {
+    "SAMPLE_RATE": float(os.environ.get("METRICS_SAMPLE_RATE", 0.1)),
+    "SERVER_TIMING": True,
+    "DUPLICATE_THRESHOLD": 5,
+}
+
+# Eureka registration, started in the background by the WSGI/ASGI application (see
+# `utils.discovery`), the client then sends a heartbeat every 30 seconds.
+EUREKA = {
+    "SERVER": "service-registry:8761",
+    "APP_NAME": "django_notification_service",
+    "INSTANCE_PORT": 8001,
+    "RETRY_DELAY": 5,
+    "MAX_RETRY_DELAY": 60,
+}
@@ -1 +1,7 @@
-urlpatterns = []
+from django.urls import path
+
+from utils.metrics import metrics_view
+
+urlpatterns = [
+    path("metrics/", metrics_view, name="metrics"),
+]
@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
+from utils import discovery
+
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "my_microservice.settings")
 
 application = get_wsgi_application()
+
+discovery.start_registration(settings.EUREKA)
@@ -0,0 +1,242 @@
+import logging
+import queue
+import smtplib
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.template.loader import get_template
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+BATCHES = metrics.registry.counter("email_batches_total", "Delivered email batches by outcome.")
+EMAILS = metrics.registry.counter("email_notifications_total", "Notifications of the delivered batches by outcome.")
+BATCH_SIZE = metrics.registry.histogram("email_batch_size", "Notifications per email batch.", metrics.COUNT_BUCKETS)
+BATCH_SECONDS = metrics.registry.histogram("email_batch_send_seconds", "Time to render and send an email batch.")
+BATCH_WAIT = metrics.registry.histogram("email_batch_wait_seconds",
+                                        "Time the oldest notification of a batch waited for it.")
+
+
+class EmailNotification:
+    def __init__(self, event, recipient, context=None):
+        self.event = event
+        self.recipient = recipient
+        self.context = context or {}
+        self.created_at = time.monotonic()
+        self.future = Future()
+
+
+class BatchMetrics:
+    """
+    Size and latency of the delivered batches, also counted in the metrics
+    registry (see `manage.py consume_events --metrics-port`).
+    """
+
+    def __init__(self, history=100):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.emails = 0
+        self.failures = 0
+        self.recent = deque(maxlen=history)
+
+    def record(self, size, send_seconds, wait_seconds, failed=False):
+        with self._lock:
+            self.batches += 1
+            self.emails += size
+            self.failures += int(failed)
+            self.recent.append((size, send_seconds, wait_seconds))
+        outcome = "failed" if failed else "sent"
+        BATCHES.inc(outcome=outcome)
+        EMAILS.inc(size, outcome=outcome)
+        BATCH_SIZE.observe(size)
+        BATCH_SECONDS.observe(send_seconds)
+        BATCH_WAIT.observe(wait_seconds)
+        logger.info("email batch of %s sent in %.1fms (oldest waited %.1fms)%s",
+                    size, send_seconds * 1000, wait_seconds * 1000, " FAILED" if failed else "")
+
+    def as_dict(self):
+        with self._lock:
+            recent = list(self.recent)
+            batches, emails, failures = self.batches, self.emails, self.failures
+        sizes = [size for size, _, _ in recent] or [0]
+        send_times = [send for _, send, _ in recent] or [0]
+        return {
+            "batches": batches,
+            "emails": emails,
+            "failures": failures,
+            "avg_batch_size": sum(sizes) / len(sizes),
+            "max_batch_size": max(sizes),
+            "avg_batch_seconds": sum(send_times) / len(send_times),
+            "max_batch_seconds": max(send_times),
+        }
+
+
+class EmailBatcher:
+    """
+    Collect notifications and deliver them in batches.
+
+    A batch is flushed when it holds `batch_size` notifications or when its
+    oldest one waited `batch_window` seconds. The templates of every event in a
+    batch are loaded once and all messages go through one mail backend
+    connection, kept open between batches and closed after `idle_timeout`
+    seconds without notifications, before the mail server drops it. A batch
+    sent on a connection the server closed anyway is sent again once on a new
+    one. `submit()` returns a future resolved once the batch containing the
+    notification was handed to the backend.
+    """
+
+    def __init__(self, batch_size=50, batch_window=1.0, backend=None, idle_timeout=30.0):
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self.metrics = BatchMetrics()
+        self._queue = queue.Queue()
+        self._connection = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, notification):
+        if self._closed:
+            raise RuntimeError("EmailBatcher is closed")
+        self._start()
+        self._queue.put(notification)
+        return notification.future
+
+    def close(self):
+        """
+        Deliver the pending notifications and stop the batching thread.
+        """
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="email-batcher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                first = self._queue.get(timeout=self.idle_timeout if self._connection is not None else None)
+            except queue.Empty:
+                self._reset_connection()
+                continue
+            if first is None:
+                break
+            batch = [first]
+            deadline = first.created_at + self.batch_window
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.deliver(batch)
+
+    def deliver(self, batch):
+        started = time.monotonic()
+        wait_seconds = started - min(notification.created_at for notification in batch)
+        messages, rendered = self.render(batch)
+        failed = False
+        if messages:
+            try:
+                self.send(messages)
+            except Exception as error:
+                failed = True
+                self._reset_connection()
+                for notification in rendered:
+                    notification.future.set_exception(error)
+            else:
+                for notification in rendered:
+                    notification.future.set_result(True)
+        self.metrics.record(len(batch), time.monotonic() - started, wait_seconds, failed=failed)
+
+    def render(self, batch):
+        """
+        Build the messages of `batch`, loading the templates once per event.
+        Notifications that cannot be rendered fail on their own.
+        """
+        templates = {}
+        messages, rendered = [], []
+        for notification in batch:
+            try:
+                if notification.event not in templates:
+                    templates[notification.event] = (
+                        get_template(f"notification/{notification.event}_subject.txt"),
+                        get_template(f"notification/{notification.event}.txt"),
+                    )
+                subject, body = templates[notification.event]
+                context = {"recipient": notification.recipient, **notification.context}
+                messages.append(EmailMessage(
+                    subject=subject.render(context).strip(),
+                    body=body.render(context),
+                    from_email=settings.DEFAULT_FROM_EMAIL,
+                    to=[notification.recipient],
+                ))
+                rendered.append(notification)
+            except Exception as error:
+                logger.error("cannot render %s notification", notification.event, exc_info=True)
+                notification.future.set_exception(error)
+        return messages, rendered
+
+    def send(self, messages):
+        try:
+            self.get_connection().send_messages(messages)
+        except smtplib.SMTPServerDisconnected:
+            logger.info("the mail server closed the connection, sending the batch on a new one")
+            self._reset_connection()
+            self.get_connection().send_messages(messages)
+
+    def get_connection(self):
+        if self._connection is None:
+            self._connection = get_connection(self.backend)
+            self._connection.open()
+        return self._connection
+
+    def _reset_connection(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                logger.warning("error closing the mail connection", exc_info=True)
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher():
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            config = settings.NOTIFICATION_EMAIL
+            _batcher = EmailBatcher(batch_size=config["BATCH_SIZE"], batch_window=config["BATCH_WINDOW"],
+                                    idle_timeout=config["IDLE_TIMEOUT"])
+        return _batcher
+
+
+def close_batcher():
+    global _batcher
+    with _batcher_lock:
+        if _batcher is not None:
+            _batcher.close()
+            _batcher = None
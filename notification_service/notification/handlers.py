@@ -0,0 +1,21 @@
+import logging
+
+from django.conf import settings
+
+from notification.email_service import EmailNotification, get_batcher
+from utils.envelope import EventRouter
+from utils.routing import EMAIL_EVENTS
+
+logger = logging.getLogger(__name__)
+
+handle_message = EventRouter()
+
+
+@handle_message.route(*EMAIL_EVENTS)
+def send_email(message):
+    """
+    Queue the email of a notification event, the returned future completes
+    when its batch was delivered so the message is only acked after that.
+    """
+    recipient = message.payload.get("email") or settings.NOTIFICATION_EMAIL["DEFAULT_RECIPIENT"]
+    return get_batcher().submit(EmailNotification(message.event, recipient, message.payload))
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from notification.email_service import close_batcher
+from notification.handlers import handle_message
+from utils import metrics, routing
+from utils.consumer import ConsumerRuntime
+
+
+class Command(BaseCommand):
+    help = "Consume notification events from RabbitMQ with a pool of workers."
+
+    def add_arguments(self, parser):
+        config = settings.NOTIFICATION_CONSUMER
+        parser.add_argument("--queue", default=config["QUEUE"])
+        parser.add_argument("--prefetch", type=int, default=config["PREFETCH"],
+                            help="Maximum number of unacknowledged messages (basic_qos prefetch_count).")
+        parser.add_argument("--workers", type=int, default=config["WORKERS"],
+                            help="Number of handler threads.")
+        parser.add_argument("--metrics-port", type=int, default=config.get("METRICS_PORT"),
+                            help="Port serving the metrics of the consumer, 0 to disable.")
+
+    def handle(self, *args, **options):
+        spec = routing.get_queue(options["queue"])
+        if spec is None:
+            raise CommandError(f"unknown queue {options['queue']}, see utils.routing.QUEUES")
+        unhandled = set(spec.events) - set(handle_message.handlers)
+        if unhandled:
+            raise CommandError(f"{spec.name} is bound to events without handler: {', '.join(sorted(unhandled))}")
+        if options["metrics_port"]:
+            try:
+                metrics.serve(options["metrics_port"])
+            except OSError as error:
+                self.stderr.write(f"cannot serve metrics on port {options['metrics_port']}: {error}")
+        runtime = ConsumerRuntime(queue=options["queue"], handler=handle_message, prefetch=options["prefetch"],
+                                  workers=options["workers"])
+        try:
+            runtime.run()
+        finally:
+            close_batcher()
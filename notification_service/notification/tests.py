@@ -0,0 +1,296 @@
+import queue
+import smtplib
+import threading
+import time
+from unittest import mock
+
+import pika
+from pika.exceptions import AMQPConnectionError, ConnectionWrongStateError
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.urls import reverse
+from pika.spec import Basic
+from rest_framework.test import APITestCase
+
+from notification.email_service import EmailBatcher, EmailNotification
+from utils import consumer
+
+
+class FakeBroker:
+    """
+    Stands for RabbitMQ behind `pika.BlockingConnection`: every connection
+    consumes `messages`, (body, redelivered) pairs, in turn.
+    """
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.connections = []
+        self.acked = []
+        self.nacked = []
+
+    def connect(self, parameters):
+        connection = FakeConnection(self)
+        self.connections.append(connection)
+        return connection
+
+
+class FakeConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.drop = False
+        self.channels = []
+        self._callbacks = queue.Queue()
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def channel(self):
+        channel = FakeChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        if not self.is_open:
+            raise ConnectionWrongStateError("connection is closed")
+        self._callbacks.put(callback)
+
+    def process_data_events(self, time_limit=0):
+        if self.drop:
+            self.is_open = False
+            raise AMQPConnectionError("connection reset")
+        try:
+            self._callbacks.get(timeout=min(time_limit, 0.01))()
+        except queue.Empty:
+            pass
+        for channel in self.channels:
+            channel.deliver()
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_closed = False
+        self.prefetch = None
+        self.on_message = None
+        self.cancelled = False
+        self.unacked = set()
+        self.tag = 0
+
+    def __getattr__(self, name):
+        # exchange_declare, queue_declare, queue_bind...
+        return lambda **kwargs: None
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        self.on_message = on_message_callback
+        return "consumer-1"
+
+    def basic_cancel(self, consumer_tag):
+        self.cancelled = True
+
+    def deliver(self):
+        broker = self.connection.broker
+        while self.on_message and not self.cancelled and broker.messages and len(self.unacked) < self.prefetch:
+            body, redelivered = broker.messages.pop(0)
+            self.tag += 1
+            self.unacked.add(self.tag)
+            self.on_message(self, Basic.Deliver(delivery_tag=self.tag, redelivered=redelivered),
+                            pika.BasicProperties(), body)
+
+    def basic_ack(self, delivery_tag):
+        self.unacked.discard(delivery_tag)
+        self.connection.broker.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue):
+        self.unacked.discard(delivery_tag)
+        self.connection.broker.nacked.append((delivery_tag, requeue))
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+
+class TestConsumerRuntime(APITestCase):
+
+    def start(self, messages, handler, **options):
+        self.broker = FakeBroker(messages)
+        patcher = mock.patch.object(pika, "BlockingConnection", self.broker.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.runtime = consumer.ConsumerRuntime(handler=handler, reconnect_delay=0, **options)
+        self.thread = threading.Thread(target=self.runtime.run, kwargs={"install_signal_handlers": False}, daemon=True)
+        self.thread.start()
+        self.addCleanup(self.runtime.stop)
+
+    def stop(self):
+        self.runtime.stop()
+        self.thread.join(5)
+        assert not self.thread.is_alive()
+
+    def test_handled_messages_are_acked_and_failed_ones_nacked(self):
+        def handler(properties, body):
+            if body == b"bad":
+                raise ValueError(body)
+
+        self.start([(b"good", False), (b"bad", False), (b"bad", True)], handler)
+        wait_until(lambda: len(self.broker.acked) + len(self.broker.nacked) == 3)
+        self.stop()
+
+        assert self.broker.acked == [1]
+        # Requeued the first time, dropped once redelivered.
+        assert sorted(self.broker.nacked) == [(2, True), (3, False)]
+
+    def test_prefetch_bounds_the_messages_in_flight(self):
+        lock, running, peak = threading.Lock(), [0], [0]
+
+        def handler(properties, body):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        self.start([(b"%d" % n, False) for n in range(12)], handler, prefetch=3, workers=8)
+        wait_until(lambda: len(self.broker.acked) == 12)
+        self.stop()
+
+        assert peak[0] == 3
+
+    def test_stop_drains_the_messages_in_flight(self):
+        release = threading.Event()
+        self.start([(b"%d" % n, False) for n in range(5)], lambda properties, body: release.wait(5), prefetch=2)
+        wait_until(lambda: len(self.runtime._in_flight) == 2)
+
+        self.runtime.stop()
+        time.sleep(0.05)
+        assert self.thread.is_alive()
+        release.set()
+        self.thread.join(5)
+
+        assert not self.thread.is_alive()
+        assert sorted(self.broker.acked) == [1, 2]
+        # The consumer was cancelled, the rest stays in the queue.
+        assert len(self.broker.messages) == 3
+
+    def test_lost_connection_does_not_block_the_shutdown(self):
+        release = threading.Event()
+        self.start([(b"slow", False)], lambda properties, body: release.wait(5))
+        wait_until(lambda: self.runtime._in_flight)
+
+        self.broker.connections[0].drop = True
+        wait_until(lambda: len(self.broker.connections) == 2)
+        release.set()
+        self.stop()
+
+        assert self.broker.acked == []
+        assert not self.runtime._in_flight
+
+
+class FailingEmailBackend(EmailBackend):
+    def send_messages(self, messages):
+        raise ConnectionError("mail server down")
+
+
+class DisconnectedEmailBackend(EmailBackend):
+    """
+    Its first connection was closed by the server while idle.
+    """
+    connections = 0
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        DisconnectedEmailBackend.connections += 1
+        self.dropped = DisconnectedEmailBackend.connections == 1
+
+    def send_messages(self, messages):
+        if self.dropped:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        return super().send_messages(messages)
+
+
+class TestEmailBatcher(APITestCase):
+
+    def batcher(self, backend="django.core.mail.backends.locmem.EmailBackend", **options):
+        batcher = EmailBatcher(backend=backend, **options)
+        self.addCleanup(batcher.close)
+        return batcher
+
+    def notify(self, batcher, event, recipient, **context):
+        return batcher.submit(EmailNotification(event, recipient, context))
+
+    def test_notifications_are_sent_in_batches(self):
+        batcher = self.batcher(batch_size=2, batch_window=5)
+        futures = [self.notify(batcher, "user_created", f"user{n}@example.com", name=f"user{n}") for n in range(3)]
+        # The first two fill a batch, the last one goes out on close.
+        assert futures[0].result(5) and futures[1].result(5)
+        assert not futures[2].done()
+        batcher.close()
+
+        assert futures[2].result(0)
+        assert [message.to for message in mail.outbox] == [[f"user{n}@example.com"] for n in range(3)]
+        assert mail.outbox[0].subject == "Welcome to Property Hunt"
+        assert mail.outbox[0].body.startswith("Dear user0, thanks for joining us.")
+        stats = batcher.metrics.as_dict()
+        assert (stats["batches"], stats["emails"], stats["max_batch_size"]) == (2, 3, 2)
+
+    def test_batch_window_flushes_a_partial_batch(self):
+        batcher = self.batcher(batch_size=50, batch_window=0.05)
+        future = self.notify(batcher, "quote_created", "buyer@example.com", quote_id=7)
+
+        assert future.result(5)
+        assert mail.outbox[0].body.startswith("Dear buyer@example.com, your quote was created (#7).")
+
+    def test_failures_complete_their_notifications_only(self):
+        batcher = self.batcher(batch_size=2, batch_window=5)
+        missing = self.notify(batcher, "unknown_event", "a@example.com")
+        sent = self.notify(batcher, "user_created", "b@example.com")
+
+        assert sent.result(5)
+        assert missing.exception(5) is not None
+        assert len(mail.outbox) == 1
+
+        failing = self.batcher(backend="notification.tests.FailingEmailBackend", batch_size=1)
+        with self.assertRaises(ConnectionError):
+            self.notify(failing, "user_created", "c@example.com").result(5)
+        assert failing.metrics.as_dict()["failures"] == 1
+
+    def test_batch_is_sent_again_on_a_new_connection_after_a_disconnect(self):
+        DisconnectedEmailBackend.connections = 0
+        batcher = self.batcher(backend="notification.tests.DisconnectedEmailBackend", batch_size=1)
+
+        assert self.notify(batcher, "user_created", "e@example.com", name="e").result(5)
+        assert DisconnectedEmailBackend.connections == 2
+        assert len(mail.outbox) == 1
+        assert batcher.metrics.as_dict()["failures"] == 0
+
+    def test_idle_connection_is_closed(self):
+        batcher = self.batcher(batch_size=1, idle_timeout=0.05)
+        self.notify(batcher, "user_created", "f@example.com", name="f").result(5)
+
+        wait_until(lambda: batcher._connection is None)
+        assert self.notify(batcher, "user_created", "g@example.com", name="g").result(5)
+        assert len(mail.outbox) == 2
+
+    def test_batches_are_exported_on_the_metrics_endpoint(self):
+        batcher = self.batcher(batch_size=1)
+        self.notify(batcher, "user_created", "d@example.com").result(5)
+
+        response = self.client.get(reverse("metrics"))
+
+        assert response.status_code == 200
+        body = response.content.decode()
+        assert 'email_batches_total{outcome="sent"}' in body
+        assert "email_batch_size_bucket" in body
+        assert "email_batch_wait_seconds_count" in body
@@ -1,31 +1,155 @@
-import json
-import pika
 import logging
+import signal
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+import pika
+from pika.exceptions import AMQPChannelError, AMQPConnectionError, ConnectionWrongStateError
+
+from utils import envelope, routing
 
 logger = logging.getLogger(__name__)
 
-connection = pika.BlockingConnection(
-    pika.ConnectionParameters(
-        "rabbitmq", 5672, "/", pika.PlainCredentials("guest", "guest")
-    )
+CONNECTION_PARAMETERS = pika.ConnectionParameters(
+    "rabbitmq",
+    5672,
+    "/",
+    pika.PlainCredentials("guest", "guest"),
+    heartbeat=60,
+    blocked_connection_timeout=30,
 )
-channel = connection.channel()
-channel.queue_declare(queue="likes")
 
 
-def callback(ch, method, properties, body):
-    print("Received in likes...")
-    print(body)
-    data = json.loads(body)
-    print(data)
-    send_email()
+def callback(properties, body):
+    logger.info("Received: %s", body)
+    message = envelope.decode(properties, body)
+    logger.info("%s: %s", message.event, message.payload)
+
+
+class ConsumerRuntime:
+    """
+    Consume a queue with manual acknowledgements and a pool of worker threads.
+    A queue of `routing.QUEUES` is declared with its bindings and dead letter
+    queue first.
+
+    The broker never sends more than `prefetch` unacknowledged messages, each
+    one is handled on a worker thread and acked once the handler returned, or
+    rejected when it raised: requeued the first time, dropped (dead-lettered if
+    the queue has a dead letter exchange) when it already was redelivered.
+    A handler may also return a `Future` (e.g. of a batched delivery), the
+    message is then settled when that future completes. A message whose
+    handler did not finish is redelivered after a crash, and after a lost
+    connection: its handler still runs, but it is no longer waited for.
+
+    `stop()` (also bound to SIGINT/SIGTERM) cancels the consumer, lets the
+    in-flight handlers finish, settles them and closes the connection.
+    """
+
+    def __init__(self, queue="notifications.email", handler=callback, prefetch=16, workers=8, parameters=CONNECTION_PARAMETERS,
+                 reconnect_delay=5):
+        self.queue = queue
+        self.handler = handler
+        self.prefetch = prefetch
+        self.workers = workers
+        self.parameters = parameters
+        self.reconnect_delay = reconnect_delay
+        self._stopping = threading.Event()
+        # Future of each message being handled -> the connection it came from.
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def run(self, install_signal_handlers=True):
+        if install_signal_handlers:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *args: self.stop())
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="consumer") as executor:
+            self.executor = executor
+            while not self._stopping.is_set():
+                try:
+                    self._consume()
+                except (AMQPConnectionError, AMQPChannelError):
+                    if self._stopping.is_set():
+                        break
+                    logger.warning("RabbitMQ connection lost, reconnecting in %ss", self.reconnect_delay,
+                                   exc_info=True)
+                    self._stopping.wait(self.reconnect_delay)
+        logger.info("Consumer stopped")
+
+    def stop(self):
+        self._stopping.set()
+
+    def _consume(self):
+        connection = pika.BlockingConnection(self.parameters)
+        try:
+            channel = connection.channel()
+            spec = routing.get_queue(self.queue)
+            if spec is None:
+                channel.queue_declare(queue=self.queue)
+            else:
+                routing.declare(channel, [spec])
+            channel.basic_qos(prefetch_count=self.prefetch)
+            consumer_tag = channel.basic_consume(
+                queue=self.queue, on_message_callback=partial(self._on_message, connection), auto_ack=False
+            )
+            logger.info("Started consuming %s (prefetch=%s, workers=%s)", self.queue, self.prefetch, self.workers)
+            while not self._stopping.is_set():
+                connection.process_data_events(time_limit=1)
+
+            channel.basic_cancel(consumer_tag)
+            while self._pending():
+                connection.process_data_events(time_limit=0.1)
+        finally:
+            self._forget(connection)
+            if connection.is_open:
+                connection.close()
+
+    def _pending(self):
+        with self._lock:
+            return bool(self._in_flight)
+
+    def _forget(self, connection):
+        """
+        Stop waiting for the messages of `connection`, the broker redelivers
+        them once it is closed.
+        """
+        with self._lock:
+            for future in [future for future, source in self._in_flight.items() if source is connection]:
+                del self._in_flight[future]
+
+    def _on_message(self, connection, channel, method, properties, body):
+        future = self.executor.submit(self.handler, properties, body)
+        with self._lock:
+            self._in_flight[future] = connection
+
+        def done(outcome):
+            if outcome.exception() is None and isinstance(outcome.result(), Future):
+                outcome.result().add_done_callback(done)
+                return
+            try:
+                connection.add_callback_threadsafe(partial(self._settle, channel, method, future, outcome))
+            except ConnectionWrongStateError:
+                logger.warning("connection closed before message %s was settled", method.delivery_tag)
+                with self._lock:
+                    self._in_flight.pop(future, None)
 
+        future.add_done_callback(done)
 
-def send_email():
-    print("Sending email: Dear Omer, thanks for joining us")
+    def _settle(self, channel, method, future, outcome):
+        with self._lock:
+            self._in_flight.pop(future, None)
+        if channel.is_closed:
+            # The broker redelivers the messages of a closed channel.
+            return
+        error = outcome.exception()
+        if error is None:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        logger.error("Handler failed for message %s", method.delivery_tag, exc_info=error)
+        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=not method.redelivered)
 
 
-channel.basic_consume(queue="likes", on_message_callback=callback, auto_ack=True)
-logging.info("Started Consuming...")
-print("Started Consuming...")
-channel.start_consuming()
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    ConsumerRuntime().run()
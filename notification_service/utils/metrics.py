@@ -0,0 +1,346 @@
+"""
+Per request cost accounting, exported as `Server-Timing` headers and in the
+Prometheus text format on /metrics.
+
+Every request is counted with its wall time. A sample of them, `SAMPLE_RATE`
+of `settings.METRICS`, is also measured in detail: SQL query count and time,
+repeated statements (a query run once per row, N+1, shows as the same SQL
+run many times), cache hits and misses, and serializer time. Only sampled
+requests pay for counting their SQL, and only they get a `Server-Timing`
+header. The middleware runs in the mode of the handler, WSGI or ASGI, so it
+never forces async views onto the sync thread.
+
+The metrics are kept per process, like the cache and batch statistics. The
+processes without a web server, like the event consumers, export them with
+`serve()`.
+"""
+import collections
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def get_config():
+    return {"SAMPLE_RATE": 0.1, "SERVER_TIMING": True, "DUPLICATE_THRESHOLD": 5, **getattr(settings, "METRICS", {})}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = collections.defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] += amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_labels(labels)} {value:g}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # labels -> [count per bucket..., count, sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        for labels, counts in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_labels(labels, le=f'{bound:g}')} {count}"
+            yield f"{self.name}_bucket{_labels(labels, le='+Inf')} {counts[-2]}"
+            yield f"{self.name}_count{_labels(labels)} {counts[-2]}"
+            yield f"{self.name}_sum{_labels(labels)} {counts[-1]:g}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.counter("http_requests_total", "Requests by view, method and status.")
+REQUEST_SECONDS = registry.histogram("http_request_duration_seconds", "Wall time of the requests by view.")
+SAMPLED = registry.counter("http_requests_sampled_total", "Requests measured in detail, by view.")
+SQL_QUERIES = registry.histogram("http_request_sql_queries", "SQL queries per sampled request.", COUNT_BUCKETS)
+SQL_SECONDS = registry.histogram("http_request_sql_seconds", "SQL time per sampled request.")
+SQL_DUPLICATES = registry.counter("http_request_sql_duplicate_queries_total",
+                                  "Repeated SQL statements of the sampled requests.")
+SERIALIZE_SECONDS = registry.histogram("http_request_serialize_seconds",
+                                       "Serializer time per sampled request, SQL excluded.")
+CACHE = registry.counter("http_request_cache_total", "Response cache lookups by view and result.")
+
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    def __init__(self, sampled):
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.statements = collections.Counter()
+        self.cache = collections.Counter()
+        self.timers = collections.defaultdict(float)
+        self._depth = collections.Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        # Called by `_count_sql` for the queries of the sampled requests.
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_seconds += time.perf_counter() - started
+            self.sql_count += 1
+            self.statements[sql] += 1
+
+    @property
+    def duplicate_queries(self):
+        return sum(count - 1 for count in self.statements.values())
+
+    def server_timing(self, total):
+        parts = [
+            f"total;dur={total * 1000:.1f}",
+            f'sql;dur={self.sql_seconds * 1000:.1f};desc="{self.sql_count} queries, '
+            f'{self.duplicate_queries} repeated"',
+        ]
+        for name, seconds in sorted(self.timers.items()):
+            parts.append(f"{name};dur={seconds * 1000:.1f}")
+        if self.cache:
+            parts.append(f'cache;desc="{self.cache["hit"]} hits, {self.cache["miss"]} misses"')
+        return ", ".join(parts)
+
+    def finish(self, request, response, config):
+        total = time.perf_counter() - self.started
+        match = getattr(request, "resolver_match", None)
+        view = (match.view_name or match.route) if match else "unmatched"
+        REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        REQUEST_SECONDS.observe(total, view=view)
+        for result, amount in self.cache.items():
+            CACHE.inc(amount, view=view, result=result)
+        if not self.sampled:
+            return
+
+        SAMPLED.inc(view=view)
+        SQL_QUERIES.observe(self.sql_count, view=view)
+        SQL_SECONDS.observe(self.sql_seconds, view=view)
+        SQL_DUPLICATES.inc(self.duplicate_queries, view=view)
+        SERIALIZE_SECONDS.observe(self.timers.get("serialize", 0.0), view=view)
+        if self.statements:
+            sql, count = self.statements.most_common(1)[0]
+            if count >= config["DUPLICATE_THRESHOLD"]:
+                logger.warning("%s ran the same query %s times (N+1?): %s", view, count, sql[:300])
+        if config["SERVER_TIMING"]:
+            response["Server-Timing"] = self.server_timing(total)
+
+
+def current():
+    """
+    The metrics of the request being served on this thread, if any.
+    """
+    return _current.get()
+
+
+def record_cache(hit):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.cache["hit" if hit else "miss"] += 1
+
+
+@contextmanager
+def timed(name):
+    """
+    Add the time of the block, minus the SQL run in it, to the `name` timer
+    of the current request. Nested blocks of the same name count once.
+    """
+    metrics = _current.get()
+    if metrics is None or not metrics.sampled or metrics._depth[name]:
+        yield
+        return
+    metrics._depth[name] += 1
+    started, sql_seconds = time.perf_counter(), metrics.sql_seconds
+    try:
+        yield
+    finally:
+        metrics._depth[name] -= 1
+        metrics.timers[name] += time.perf_counter() - started - (metrics.sql_seconds - sql_seconds)
+
+
+def _count_sql(execute, sql, params, many, context):
+    """
+    Execute wrapper of every connection, counting the query for the request
+    of the current context when it is sampled. Under ASGI the sync views of
+    all requests share one thread and its connections, the context tells
+    their queries apart.
+    """
+    metrics = _current.get()
+    if metrics is None or not metrics.sampled:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+def _install(connection):
+    if _count_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_sql)
+
+
+@receiver(connection_created)
+def install_sql_counter(sender, connection, **kwargs):
+    _install(connection)
+
+
+@contextmanager
+def sql_counted():
+    """
+    Count the SQL run by this thread in the block, when the current request
+    is sampled. Connections are per thread and most get the counter when
+    they connect, this also covers the ones opened before this module was
+    imported.
+    """
+    metrics = _current.get()
+    if metrics is not None and metrics.sampled:
+        for connection in connections.all():
+            _install(connection)
+    yield
+
+
+class TimedSerializerMixin:
+    """
+    Counts `to_representation` as serializer time of the current request.
+    """
+
+    def to_representation(self, instance):
+        with timed("serialize"):
+            return super().to_representation(instance)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        config = get_config()
+        metrics = RequestMetrics(sampled=random.random() < config["SAMPLE_RATE"])
+        token = _current.set(metrics)
+        try:
+            with sql_counted():
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        metrics.finish(request, response, config)
+        return response
+
+    async def __acall__(self, request):
+        config = get_config()
+        metrics = RequestMetrics(sampled=random.random() < config["SAMPLE_RATE"])
+        # The sync code of the request runs in copies of this context.
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        metrics.finish(request, response, config)
+        return response
+
+
+def metrics_view(request):
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="0.0.0.0"):
+    """
+    Serve the metrics of this process on `port` from a background thread.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,83 @@
+EXCHANGE = "events"
+DEAD_LETTER_EXCHANGE = "events.dead"
+
+DEFAULT_LANE = "default"
+PRIORITY_LANE = "priority"
+
+# Events published on the priority lane unless the publisher picks one, their
+# queues are consumed apart so a backlog of regular events does not delay them.
+PRIORITY_EVENTS = {"user_created"}
+
+
+def routing_key(event, lane=None):
+    """
+    Return the topic routing key of `event`: "<lane>.<event>".
+    """
+    if lane is None:
+        lane = PRIORITY_LANE if event in PRIORITY_EVENTS else DEFAULT_LANE
+    return f"{lane}.{event}"
+
+
+class QueueSpec:
+    """
+    A durable queue bound to the routing keys of `events` on `lane`.
+
+    Messages a consumer rejects without requeueing go to its dead letter
+    queue, "<name>.dead", to be inspected or shovelled back. `limits`, like
+    x-message-ttl or x-max-length, bound both queues: the messages expired
+    or dropped from the queue are dead lettered too.
+    """
+
+    def __init__(self, name, events, lane=DEFAULT_LANE, arguments=None, limits=None):
+        self.name = name
+        self.events = tuple(events)
+        self.lane = lane
+        self.arguments = arguments or {}
+        self.limits = limits or {}
+
+    @property
+    def dead_letter_queue(self):
+        return f"{self.name}.dead"
+
+    @property
+    def bindings(self):
+        return [routing_key(event, self.lane) for event in self.events]
+
+
+EMAIL_EVENTS = ("user_created", "quote_created")
+# Batched product writes, for the consumers keeping product data (search, caches...).
+CATALOG_EVENTS = ("products_changed",)
+
+# Every event published has to be bound to one of these queues, the exchange drops the others.
+QUEUES = [
+    QueueSpec("notifications.email", EMAIL_EVENTS),
+    QueueSpec("notifications.email.priority", EMAIL_EVENTS, lane=PRIORITY_LANE),
+    # No consumer reads it yet, it keeps the last day of changes for the first ones.
+    QueueSpec("catalog.products", CATALOG_EVENTS, limits={"x-message-ttl": 24 * 3600 * 1000, "x-max-length": 100_000}),
+]
+
+
+def get_queue(name):
+    return next((queue for queue in QUEUES if queue.name == name), None)
+
+
+def declare(channel, queues=None):
+    """
+    Declare the exchanges, `queues` (all of `QUEUES` by default) with their
+    dead letter queues, and their bindings. Declaring is idempotent, both the
+    publishers and the consumers declare at startup so no event published
+    before a consumer first ran is dropped as unroutable.
+    """
+    channel.exchange_declare(exchange=EXCHANGE, exchange_type="topic", durable=True)
+    channel.exchange_declare(exchange=DEAD_LETTER_EXCHANGE, exchange_type="direct", durable=True)
+    for queue in QUEUES if queues is None else queues:
+        channel.queue_declare(queue=queue.dead_letter_queue, durable=True, arguments=queue.limits or None)
+        channel.queue_bind(queue=queue.dead_letter_queue, exchange=DEAD_LETTER_EXCHANGE, routing_key=queue.name)
+        channel.queue_declare(queue=queue.name, durable=True, arguments={
+            "x-dead-letter-exchange": DEAD_LETTER_EXCHANGE,
+            "x-dead-letter-routing-key": queue.name,
+            **queue.limits,
+            **queue.arguments,
+        })
+        for key in queue.bindings:
+            channel.queue_bind(queue=queue.name, exchange=EXCHANGE, routing_key=key)